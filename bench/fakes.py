@@ -0,0 +1,374 @@
+"""
+Stand-ins for YouTube and Discord, so the cogs can be benchmarked and load tested without touching the network.
+
+FakeYoutubeDL answers extract_info the way yt-dlp would, after a configurable delay and with a configurable failure
+rate.  FakeVoiceClient plays sources on a thread of its own, 20 ms a frame, the way nextcord's AudioPlayer does, and
+the guild, channel and interaction fakes record what the cogs send.  offline() wires all of it up.
+"""
+import contextlib
+import itertools
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+# the bench runs in a scratch directory, and modules loaded lazily later still have to be found
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+import nextcord
+import yt_dlp
+import ytwrapper
+from playlist import playlist_writer
+from videoid import canonical_video_id, video_url
+
+FRAME_SECONDS = 0.02
+# 20 ms of 48 kHz 16-bit stereo, what FFmpegPCMAudio hands the voice client per read
+SILENT_FRAME = b"\0" * 3840
+
+
+def bench_video_id(number):
+    """An id that canonical_video_id accepts, so fake songs go through the same paths as real ones."""
+    return f"bench{number:06d}"
+
+
+def bench_song_url(number):
+    return video_url(bench_video_id(number))
+
+
+def bench_playlist_url(name="bench"):
+    return f"https://www.youtube.com/playlist?list={name}"
+
+
+class FakeYoutubeDL(object):
+    """
+    Answers like yt-dlp: a watch url is a track of *duration* seconds, and a url with list= is a playlist of
+    *playlist_size* tracks.  Each call sleeps *latency* seconds (give or take half) and fails with *failure_rate*.
+    Media urls point at *audio_path* when there is one, so real FFmpeg sources can be built from the results.
+    """
+
+    def __init__(self, latency=0.05, failure_rate=0.0, duration=180, playlist_size=50, audio_path=None, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.duration = duration
+        self.playlist_size = playlist_size
+        self.audio_path = audio_path
+        self._random = random.Random(seed)
+
+    def extract_info(self, url, download=True):
+        if self.latency:
+            time.sleep(self.latency * self._random.uniform(0.5, 1.5))
+        if self._random.random() < self.failure_rate:
+            raise yt_dlp.utils.DownloadError(f"fake extraction failure for {url}")
+        if "list=" in url:
+            return {'_type': 'playlist', 'title': url, 'entries': [self._entry(bench_video_id(number)) for number in range(self.playlist_size)]}
+        return self._entry(canonical_video_id(url))
+
+    def prepare_filename(self, data):
+        return self.audio_path or os.path.join("audio", f"{data['id']}.opus")
+
+    def _entry(self, video_id):
+        return {
+            'id': video_id,
+            'title': f"Bench track {video_id}",
+            'uploader': "Bench",
+            'duration': self.duration,
+            'webpage_url': video_url(video_id),
+            'url': self.audio_path or f"https://media.invalid/{video_id}",
+            'acodec': 'opus',
+        }
+
+
+class SilentAudio(nextcord.AudioSource):
+    """*seconds* of PCM silence."""
+
+    def __init__(self, seconds):
+        self.frames_left = int(seconds / FRAME_SECONDS)
+
+    def read(self):
+        if self.frames_left <= 0:
+            return b""
+        self.frames_left -= 1
+        return SILENT_FRAME
+
+
+class FakeTrack(ytwrapper.FirstFrameMixin, SilentAudio):
+    """What YTDLSource.from_data builds under offline() when there's no audio file: silence, no FFmpeg."""
+
+    def __init__(self, data, seconds):
+        super().__init__(seconds)
+        self.data = data
+        self.title = data.get('title')
+        self.url = data.get('url')
+
+
+class FakeVoiceClient(object):
+    """
+    Plays one source at a time on its own thread, reading a frame every 20 ms (divided by *speed*), and calls after=
+    once the source runs dry or is stopped.  Records when each track started producing audio and when it ended, and
+    how many frames came out late, which is what a listener hears as stutter.  With *encode*, PCM frames are opus
+    encoded as the real voice client would (that needs libopus).
+    """
+
+    def __init__(self, guild, channel, speed=1.0, encode=False):
+        self.guild = guild
+        self.channel = channel
+        self.speed = speed
+        self.encoder = nextcord.opus.Encoder() if encode else None
+        self.frames = 0
+        self.late_frames = 0
+        # (event, perf_counter time), event being 'first_frame' or 'end'
+        self.events = []
+        self._thread = None
+        self._stop = threading.Event()
+
+    def is_connected(self):
+        return True
+
+    def is_playing(self):
+        return self._thread is not None and self._thread.is_alive() and not self._stop.is_set()
+
+    def is_paused(self):
+        return False
+
+    def play(self, source, *, after=None):
+        if self.is_playing():
+            raise nextcord.ClientException("Already playing audio.")
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._play, args=(source, after, self._stop), name=f"voice-{self.guild.id}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    async def disconnect(self, *, force=False):
+        self.stop()
+        self.guild.voice_client = None
+
+    def _play(self, source, after, stop):
+        started = time.perf_counter()
+        frames = 0
+        error = None
+        try:
+            while not stop.is_set():
+                data = source.read()
+                if not data:
+                    break
+                if self.encoder is not None and not source.is_opus():
+                    self.encoder.encode(data, self.encoder.SAMPLES_PER_FRAME)
+                if frames == 0:
+                    self.events.append(('first_frame', time.perf_counter()))
+                frames += 1
+                self.frames += 1
+                delay = started + frames * FRAME_SECONDS / self.speed - time.perf_counter()
+                if delay > 0:
+                    stop.wait(delay)
+                elif frames > 1 and -delay > FRAME_SECONDS / self.speed:
+                    self.late_frames += 1
+        except Exception as e:
+            error = e
+        finally:
+            # like AudioPlayer, stop before calling after=, so is_playing() is already False when the next track starts
+            stop.set()
+            source.cleanup()
+            self.events.append(('end', time.perf_counter()))
+            if after is not None:
+                after(error)
+
+
+class FakeMessage(object):
+
+    def __init__(self, channel, content):
+        self.channel = channel
+        self.content = content
+        self.edits = 0
+
+    async def edit(self, *, content=None, **kwargs):
+        self.content = content
+        self.edits += 1
+        return self
+
+
+class _Typing(object):
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class FakeTextChannel(object):
+
+    _ids = itertools.count(1)
+
+    def __init__(self, guild, name="general"):
+        self.id = next(self._ids)
+        self.guild = guild
+        self.name = name
+        self.messages = []
+
+    async def send(self, content=None, **kwargs):
+        message = FakeMessage(self, content)
+        self.messages.append(message)
+        return message
+
+    def typing(self):
+        return _Typing()
+
+    def __str__(self):
+        return f"#{self.name}"
+
+
+class FakeVoiceChannel(object):
+
+    def __init__(self, guild, name="voice", speed=1.0, encode=False):
+        self.id = next(FakeTextChannel._ids)
+        self.guild = guild
+        self.name = name
+        self.speed = speed
+        self.encode = encode
+        # the bot and one listener, so GuildPlayer doesn't leave an empty channel
+        self.voice_states = {0: None, 1: None}
+
+    async def connect(self, **kwargs):
+        self.guild.voice_client = FakeVoiceClient(self.guild, self, self.speed, self.encode)
+        return self.guild.voice_client
+
+
+class FakeGuild(object):
+
+    _ids = itertools.count(10_000)
+
+    def __init__(self, speed=1.0, encode=False):
+        self.id = next(self._ids)
+        self.name = f"bench guild {self.id}"
+        self.voice_client = None
+        self.text_channel = FakeTextChannel(self)
+        self.voice_channel = FakeVoiceChannel(self, speed=speed, encode=encode)
+
+
+class FakeUser(object):
+
+    _ids = itertools.count(1)
+
+    def __init__(self, voice_channel=None):
+        self.id = next(self._ids)
+        self.name = f"bench user {self.id}"
+        self.mention = f"<@{self.id}>"
+        self.voice = FakeVoiceState(voice_channel) if voice_channel is not None else None
+
+
+class FakeVoiceState(object):
+
+    def __init__(self, channel):
+        self.channel = channel
+
+
+class FakeResponse(object):
+
+    def __init__(self, interaction):
+        self._interaction = interaction
+        self._done = False
+
+    def is_done(self):
+        return self._done
+
+    async def send_message(self, content=None, **kwargs):
+        self._done = True
+        self._interaction._record(content)
+
+    async def defer(self, **kwargs):
+        self._done = True
+
+
+class FakeFollowup(object):
+
+    def __init__(self, interaction):
+        self._interaction = interaction
+
+    async def send(self, content=None, *, wait=False, **kwargs):
+        self._interaction._record(content)
+        return FakeMessage(self._interaction.channel, content)
+
+
+class FakeInteraction(object):
+    """A slash command invocation: what the cogs read off a nextcord.Interaction, plus a log of every reply."""
+
+    _tokens = itertools.count(1)
+
+    def __init__(self, guild, user=None, channel=None, client=None):
+        self.client = client
+        self.guild = guild
+        self.guild_id = guild.id
+        self.user = user or FakeUser(guild.voice_channel)
+        self.channel = channel or guild.text_channel
+        self.token = f"bench-{next(self._tokens)}"
+        self.attached = nextcord.interactions.InteractionAttached()
+        self.application_command = None
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.created = time.perf_counter()
+        # (seconds since the interaction was created, content)
+        self.replies = []
+
+    async def edit_original_message(self, *, content=None, **kwargs):
+        self._record(content)
+
+    def _set_application_command(self, command):
+        self.application_command = command
+
+    def _record(self, content):
+        self.replies.append((time.perf_counter() - self.created, content))
+
+
+class FakeBot(object):
+    """Enough of a bot for cogs that only keep a reference to it."""
+
+    def __init__(self):
+        self.voice_clients = []
+
+
+@contextlib.contextmanager
+def offline(latency=0.05, failure_rate=0.0, track_seconds=2.0, playlist_size=50, audio_path=None, seed=None):
+    """
+    Runs the block in a scratch directory (playlists, caches and audio all land there) with FakeYoutubeDL behind the
+    extraction scheduler.  Without *audio_path* every source is a FakeTrack of *track_seconds* seconds of silence;
+    with one, real FFmpeg sources play that file.  Metrics serving, warm up and audio cache downloads are turned off.
+    """
+    seeds = itertools.count(seed) if seed is not None else itertools.repeat(None)
+    env = {
+        'TOBY_METRICS': '0',
+        'TOBY_WARM_UP': '0',
+        'TOBY_AUDIO_CACHE_AFTER_PLAYS': str(10 ** 9),
+    }
+    saved_env = {key: os.environ.get(key) for key in env}
+    saved_factory = ytwrapper.extraction_scheduler.ytdl_factory
+    saved_from_data = ytwrapper.YTDLSource.__dict__['from_data']
+    saved_cwd = os.getcwd()
+    scratch = tempfile.mkdtemp(prefix="toby-bench-")
+    if audio_path is not None:
+        audio_path = os.path.abspath(audio_path)
+    os.environ.update(env)
+    ytwrapper.extraction_scheduler.ytdl_factory = lambda: FakeYoutubeDL(latency, failure_rate, track_seconds, playlist_size, audio_path, next(seeds))
+    if audio_path is None:
+        ytwrapper.YTDLSource.from_data = classmethod(lambda cls, data, *, mode=None: FakeTrack(data, track_seconds))
+    os.chdir(scratch)
+    try:
+        yield scratch
+    finally:
+        # anything still waiting to be written belongs in the scratch directory, not wherever we were started from
+        playlist_writer.flush_sync()
+        os.chdir(saved_cwd)
+        ytwrapper.YTDLSource.from_data = saved_from_data
+        ytwrapper.extraction_scheduler.ytdl_factory = saved_factory
+        for key, value in saved_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        shutil.rmtree(scratch, ignore_errors=True)
@@ -0,0 +1,239 @@
+"""
+Load tests a real TobyTrack with simulated guilds, to find how many concurrently playing guilds one process handles
+before voice degrades.
+
+The bot's cogs are driven through LocalGateway, which invokes the registered slash commands with nextcord's own
+checks and hooks, just as an interaction from the gateway would be, but nothing connects to Discord.  At each step
+of --guilds every guild joins voice, starts playing and then issues play/next/stream/songs/roll at the --rate given
+(per guild, per minute, with random arrivals).  For each step it reports event loop lag, CPU per guild, memory,
+late voice frames and command latency percentiles.  Stepping stops early once loop lag or late frames pass the
+limits, and the last step within them is reported as the capacity.
+
+Sources are fake silence unless --audio names a local file, which then plays through FFmpeg like a real track; add
+--encode (needs libopus) to also pay for opus encoding in pcm mode.
+
+Usage: python -m bench.loadsim [--guilds 1 5 10 20 40] [--duration 30] [--rate play=0.2 next=1 roll=6 ...]
+                               [--audio song.opus] [--json results.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import time
+
+from bench.fakes import FakeGuild, FakeInteraction, bench_playlist_url, bench_song_url, offline
+from bench.report import latency_summary, write_json
+from logs import configure_logging
+import discordbot
+
+RATES = {'play': 0.2, 'next': 1.0, 'stream': 0.1, 'songs': 0.2, 'roll': 6.0}
+DICE = ("1d20+5", "4d6kh3", "8d6", "2d20kh1+7", "10d6e6")
+LAG_INTERVAL = 0.05
+
+
+class LocalGateway(object):
+    """Delivers simulated slash commands to *bot* through the same invoke path real interactions take."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        bot.add_all_application_commands()
+        self.commands = {command.name: command for command in bot.get_all_application_commands()}
+
+    async def invoke(self, guild, command, /, **options):
+        """Runs /command with *options* in *guild*.  Returns the interaction, with the replies the bot sent."""
+        interaction = FakeInteraction(guild, client=self.bot)
+        await self.commands[command].invoke_callback_with_hooks(self.bot._connection, interaction, kwargs=options)
+        return interaction
+
+
+def _options(command, guild_songs):
+    if command == 'play':
+        return {'playlist_name': "bench"}
+    if command == 'stream':
+        return {'url': bench_song_url(random.randrange(guild_songs))}
+    if command == 'songs':
+        return {'name': "bench"}
+    if command == 'roll':
+        return {'dice': random.choice(DICE)}
+    return {}
+
+
+def _cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return round(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20, 1)
+    except OSError:
+        # peak rather than current, but it's what there is off linux
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+class Simulation(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.bot = discordbot.TobyTrack()
+        self.gateway = LocalGateway(self.bot)
+        self.guilds = []
+        self.latencies = {}
+        self.lags = []
+        self._in_flight = set()
+
+    async def warm_up(self):
+        """What the bot does after connecting, plus starting the dice worker pool, so the first step doesn't pay for it."""
+        await self.bot._warm_up()
+        await self.gateway.invoke(FakeGuild(), 'roll', dice=DICE[-1])
+
+    async def add_guild(self):
+        guild = FakeGuild(encode=self.args.encode)
+        await self.gateway.invoke(guild, 'create_playlist', name="bench")
+        await self.gateway.invoke(guild, 'add_songs_from_playlist', playlist_name="bench", playlist_url=bench_playlist_url())
+        await self.gateway.invoke(guild, 'join')
+        await self.gateway.invoke(guild, 'play', playlist_name="bench")
+        self.guilds.append(guild)
+
+    async def step(self, guild_count):
+        while len(self.guilds) < guild_count:
+            await self.add_guild()
+        self.latencies = {command: [] for command in self.args.rate}
+        self.lags = []
+        errors_before = sum(discordbot.COMMAND_ERRORS.value(command=command) for command in self.args.rate)
+        frames_before = sum(self._voice(guild, 'frames') for guild in self.guilds)
+        late_before = sum(self._voice(guild, 'late_frames') for guild in self.guilds)
+        cpu_before, wall_before = _cpu_seconds(), time.perf_counter()
+
+        probe = asyncio.ensure_future(self._probe_lag())
+        users = [asyncio.ensure_future(self._user(guild, command, rate))
+                 for guild in self.guilds for command, rate in self.args.rate.items() if rate > 0]
+        await asyncio.sleep(self.args.duration)
+        for task in users:
+            task.cancel()
+        # let the commands already sent finish, so their latency counts
+        if self._in_flight:
+            await asyncio.wait(list(self._in_flight), timeout=30)
+        probe.cancel()
+
+        wall = time.perf_counter() - wall_before
+        cpu = _cpu_seconds() - cpu_before
+        frames = sum(self._voice(guild, 'frames') for guild in self.guilds) - frames_before
+        late = sum(self._voice(guild, 'late_frames') for guild in self.guilds) - late_before
+        return {
+            'guilds': guild_count,
+            'seconds': round(wall, 2),
+            'commands': sum(len(samples) for samples in self.latencies.values()),
+            'errors': sum(discordbot.COMMAND_ERRORS.value(command=command) for command in self.args.rate) - errors_before,
+            'loop_lag': latency_summary(self.lags),
+            'cpu_percent': round(100 * cpu / wall, 1),
+            'cpu_percent_per_guild': round(100 * cpu / wall / guild_count, 2),
+            'rss_mb': _rss_mb(),
+            'voice_frames': frames,
+            'late_frame_percent': round(100 * late / frames, 3) if frames else None,
+            'latency': {command: latency_summary(samples) for command, samples in self.latencies.items()},
+        }
+
+    async def close(self):
+        for guild in self.guilds:
+            await self.gateway.invoke(guild, 'leave')
+        for cog in list(self.bot.cogs.values()):
+            unload = getattr(cog, 'cog_unload', None)
+            if unload is not None:
+                unload()
+
+    async def _user(self, guild, command, rate):
+        """Issues /command in *guild* at random, *rate* times a minute on average."""
+        while True:
+            await asyncio.sleep(random.expovariate(rate / 60))
+            task = asyncio.ensure_future(self._timed(guild, command))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _timed(self, guild, command):
+        started = time.perf_counter()
+        await self.gateway.invoke(guild, command, **_options(command, self.args.playlist_size))
+        self.latencies[command].append(time.perf_counter() - started)
+
+    async def _probe_lag(self):
+        while True:
+            expected = time.perf_counter() + LAG_INTERVAL
+            await asyncio.sleep(LAG_INTERVAL)
+            self.lags.append(max(0.0, time.perf_counter() - expected))
+
+    @staticmethod
+    def _voice(guild, counter):
+        return getattr(guild.voice_client, counter, 0) if guild.voice_client is not None else 0
+
+
+def _degraded(result, args):
+    lag = result['loop_lag'].get('p99_ms') or 0
+    late = result['late_frame_percent'] or 0
+    return lag > args.max_lag_ms or late > args.max_late_percent
+
+
+async def run(args):
+    simulation = Simulation(args)
+    simulation.bot.loop_monitor.start()
+    await simulation.warm_up()
+    steps = []
+    capacity = None
+    try:
+        for guild_count in args.guilds:
+            result = await simulation.step(guild_count)
+            steps.append(result)
+            latency = ", ".join(f"{command} p95 {summary['p95_ms']}ms" for command, summary in result['latency'].items() if summary['count'])
+            print(f"{guild_count:>4} guilds: loop lag p99 {result['loop_lag'].get('p99_ms')}ms, "
+                  f"cpu {result['cpu_percent_per_guild']}%/guild, rss {result['rss_mb']}MB, "
+                  f"late frames {result['late_frame_percent']}%, {result['commands']} commands ({latency or 'none'})")
+            if _degraded(result, args):
+                print(f"degraded at {guild_count} guilds, stopping")
+                break
+            capacity = guild_count
+    finally:
+        simulation.bot.loop_monitor.stop()
+        await simulation.close()
+    return {'capacity': capacity, 'steps': steps}
+
+
+def _rate(text):
+    command, _, rate = text.partition("=")
+    if command not in RATES:
+        raise argparse.ArgumentTypeError(f"can't simulate {command}, only {', '.join(RATES)}")
+    return command, float(rate)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find how many playing guilds one Toby process can handle.")
+    parser.add_argument('--guilds', type=int, nargs='+', default=[1, 5, 10, 20, 40], help="guild counts to step through")
+    parser.add_argument('--duration', type=float, default=30, help="seconds to run each step for")
+    parser.add_argument('--rate', type=_rate, nargs='+', default=[], metavar="COMMAND=PER_MINUTE",
+                        help=f"how often each guild sends each command, defaults {' '.join(f'{c}={r:g}' for c, r in RATES.items())}")
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds each fake extraction takes, on average")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="share of fake extractions that fail")
+    parser.add_argument('--track-seconds', type=float, default=30, help="length of each fake track")
+    parser.add_argument('--playlist-size', type=int, default=30, help="songs in each guild's playlist")
+    parser.add_argument('--audio', default=None, help="play this local file through FFmpeg instead of fake silence")
+    parser.add_argument('--encode', action='store_true', help="opus encode PCM frames like the voice client (needs libopus)")
+    parser.add_argument('--max-lag-ms', type=float, default=50, help="p99 loop lag past which a step counts as degraded")
+    parser.add_argument('--max-late-percent', type=float, default=1.0, help="late voice frames past which a step counts as degraded")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', default=None, help="write the results to this file")
+    args = parser.parse_args()
+    args.rate = {**RATES, **dict(args.rate)}
+
+    random.seed(args.seed)
+    configure_logging(os.getenv('TOBY_LOG_LEVEL', 'WARNING'))
+    with offline(args.latency, args.failure_rate, args.track_seconds, args.playlist_size, args.audio, args.seed):
+        results = asyncio.run(run(args))
+    print(json.dumps({'capacity': results['capacity']}))
+    if args.json:
+        write_json(args.json, results, vars(args))
+
+
+if __name__ == "__main__":
+    main()
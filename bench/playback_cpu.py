@@ -0,0 +1,102 @@
+"""
+Compares CPU cost per concurrent voice connection between the 'pcm' and 'opus' playback modes.
+
+Each simulated connection reads 20 ms frames from its own source in real time on its own thread, the way the voice
+client's AudioPlayer does.  In pcm mode the frames are opus-encoded in process just like the voice client would.
+CPU time is counted for this process and for the FFmpeg children, network and encryption are left out.
+Each mode runs at its default volume, which is what the bot does unless TOBY_VOLUME is set, and opus mode runs once
+more at pcm mode's volume, where FFmpeg has to decode and re-encode instead of passing opus input straight through.
+
+Usage: python -m bench.playback_cpu <audio file> [--connections 1 5 10] [--seconds 20] [--json results.json]
+"""
+import argparse
+import json
+import os
+import resource
+import threading
+import time
+
+import nextcord
+from ytwrapper import YTDLSource
+
+FRAME_SECONDS = 0.02
+# (mode, volume) pairs to measure, None meaning the mode's default
+CASES = (('pcm', None), ('opus', None), ('opus', YTDLSource.VOLUME))
+
+
+def _cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _drive(source, frames, encoder, counts, index):
+    start = time.perf_counter()
+    for frame in range(frames):
+        data = source.read()
+        if not data:
+            break
+        if encoder is not None:
+            encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+        counts[index] += 1
+        delay = start + (frame + 1) * FRAME_SECONDS - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def run(path, mode, connections, seconds, acodec, volume=None):
+    data = {'title': os.path.basename(path), 'filepath': path, 'acodec': acodec}
+    frames = int(seconds / FRAME_SECONDS)
+    sources = [YTDLSource.from_data(data, mode=mode, volume=volume) for _ in range(connections)]
+    encoders = [None if source.is_opus() else nextcord.opus.Encoder() for source in sources]
+    counts = [0] * connections
+    threads = [threading.Thread(target=_drive, args=(source, frames, encoder, counts, index))
+               for index, (source, encoder) in enumerate(zip(sources, encoders))]
+    cpu_before = _cpu_seconds()
+    wall_before = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for source in sources:
+        # reaps FFmpeg, so its CPU time shows up under RUSAGE_CHILDREN
+        source.cleanup()
+    wall = time.perf_counter() - wall_before
+    cpu = _cpu_seconds() - cpu_before
+    audio_seconds = sum(counts) * FRAME_SECONDS
+    return {
+        'mode': mode,
+        'volume': sources[0].volume,
+        'connections': connections,
+        'wall_seconds': round(wall, 3),
+        'cpu_seconds': round(cpu, 3),
+        'audio_seconds': round(audio_seconds, 3),
+        'cpu_percent_per_connection': round(100 * cpu / wall / connections, 2),
+        'cpu_per_audio_second': round(cpu / audio_seconds, 5) if audio_seconds else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare playback CPU cost between pcm and opus modes.")
+    parser.add_argument('path', help="local audio file to play, at least --seconds long")
+    parser.add_argument('--connections', type=int, nargs='+', default=[1, 5, 10])
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--acodec', default=None, help="codec of the input, defaults to opus for .opus/.ogg/.webm")
+    parser.add_argument('--json', default=None, help="also write the results to this file")
+    args = parser.parse_args()
+
+    acodec = args.acodec or ('opus' if args.path.endswith(('.opus', '.ogg', '.webm')) else None)
+    results = []
+    for connections in args.connections:
+        for mode, volume in CASES:
+            result = run(args.path, mode, connections, args.seconds, acodec, volume)
+            print(f"{mode:>4} @{result['volume']:<4} x{connections:<3} {result['cpu_percent_per_connection']:>6}% cpu per connection "
+                  f"({result['cpu_seconds']}s cpu over {result['wall_seconds']}s)")
+            results.append(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
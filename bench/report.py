@@ -0,0 +1,88 @@
+"""Summaries, JSON output and baseline comparison shared by the benchmark and load test scripts."""
+import datetime
+import json
+import platform
+import sys
+
+from utils import get_version
+
+
+def latency_summary(seconds):
+    """count, mean and percentiles (in ms) of a list of durations in seconds."""
+    if not seconds:
+        return {'count': 0}
+    ordered = sorted(seconds)
+
+    def percentile(p):
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000, 3)
+    return {
+        'count': len(ordered),
+        'mean_ms': round(sum(ordered) / len(ordered) * 1000, 3),
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'max_ms': round(ordered[-1] * 1000, 3),
+    }
+
+
+def environment():
+    try:
+        version = get_version().strip()
+    except OSError:
+        version = None
+    return {
+        'version': version,
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+    }
+
+
+def write_json(path, results, config):
+    with open(path, "w") as f:
+        json.dump({'environment': environment(), 'config': config, 'results': results}, f, indent=2)
+
+
+def _flatten(results, prefix=""):
+    for key, value in results.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            yield from _flatten(value, name)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, value
+
+
+def _direction(name):
+    """+1 if a bigger value is worse, -1 if a smaller one is, 0 if it isn't a performance number."""
+    leaf = name.rsplit(".", 1)[-1]
+    if leaf.endswith("per_second"):
+        return -1
+    if leaf.endswith(("_ms", "seconds")) or leaf.startswith("cpu"):
+        return 1
+    return 0
+
+
+# timings this small are mostly noise, so they never count as regressions
+NOISE_FLOOR_MS = 1.0
+
+
+def compare(results, baseline_path, tolerance):
+    """
+    Compares *results* with the results saved in *baseline_path*.  Returns the regressions, as (name, baseline, now),
+    that got worse by more than *tolerance* (0.25 is 25%).
+    """
+    with open(baseline_path) as f:
+        baseline = dict(_flatten(json.load(f)['results']))
+    regressions = []
+    for name, value in _flatten(results):
+        direction = _direction(name)
+        before = baseline.get(name)
+        if not direction or not before:
+            continue
+        floor = NOISE_FLOOR_MS if name.endswith("_ms") else NOISE_FLOOR_MS / 1000 if name.endswith("seconds") else 0
+        if max(value, before) <= floor:
+            continue
+        change = (value - before) / before * direction
+        if change > tolerance:
+            regressions.append((name, before, value))
+    return regressions
@@ -0,0 +1,223 @@
+"""
+Offline benchmarks for the music, dice and playlist code paths, run against a fake yt-dlp and a fake voice client.
+
+Nothing touches the network or the real playlists; everything runs in a scratch directory (see bench.fakes.offline).
+Each benchmark reports throughput and latency.  --json saves the results, and --baseline compares them with an
+earlier run's and exits non-zero if anything got worse by more than --tolerance, so regressions show up between builds.
+
+Usage: python -m bench.suite [--only dice bulk_import ...] [--latency 0.05] [--failure-rate 0.0] [--json results.json]
+                             [--baseline previous.json] [--tolerance 0.25]
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+from bench.fakes import FakeBot, FakeGuild, FakeInteraction, bench_playlist_url, bench_song_url, offline
+from bench.report import compare, latency_summary, write_json
+from dice_cog import Dice
+from logs import configure_logging
+from music_cog import Music
+from playlist import JsonPlaylistStore, ServerPlaylist, SqlitePlaylistStore, playlist_writer
+
+# the last two are expensive enough to go to the dice worker pool
+DICE_EXPRESSIONS = ("1d20+5", "4d6kh3", "8d6+2d8", "2d20kh1+7", "4d6ro<3", "200d6", "10d6e6")
+
+
+async def _timed(awaitable):
+    started = time.perf_counter()
+    await awaitable
+    return time.perf_counter() - started
+
+
+async def _wait_for_frames(voice_client, count, timeout):
+    """Waits until *voice_client* has started *count* tracks.  Returns when the last of them produced its first frame."""
+    deadline = time.perf_counter() + timeout
+    while True:
+        starts = [at for event, at in list(voice_client.events) if event == 'first_frame']
+        if len(starts) >= count:
+            return starts[count - 1]
+        if time.perf_counter() > deadline:
+            raise TimeoutError(f"only {len(starts)} of {count} tracks started within {timeout:g}s")
+        await asyncio.sleep(0.002)
+
+
+def _track_gaps(events):
+    gaps = []
+    ended = None
+    for event, at in events:
+        if event == 'end':
+            ended = at
+        elif ended is not None:
+            gaps.append(at - ended)
+            ended = None
+    return gaps
+
+
+async def _music_guild(cog, songs, speed=1.0):
+    guild = FakeGuild(speed=speed)
+    data = await cog.guild_playlists.get(guild.id)
+    data.add_playlist("bench")
+    for number in range(songs):
+        data.add_to_playlist("bench", bench_song_url(number))
+    return guild, data
+
+
+async def bench_playlist_mutations(args):
+    """Adding and removing songs with each store, and waiting for each store's writes to land."""
+    results = {}
+    for name, store in (('json', JsonPlaylistStore()), ('sqlite', SqlitePlaylistStore(os.path.join("playlists", "bench.db")))):
+        data = await ServerPlaylist.open(f"bench-mutations-{name}", store)
+        data.add_playlist("bench")
+        adds, removes = [], []
+        started = time.perf_counter()
+        for number in range(args.songs):
+            began = time.perf_counter()
+            data.add_to_playlist("bench", bench_song_url(number))
+            adds.append(time.perf_counter() - began)
+        for number in range(0, args.songs, 2):
+            began = time.perf_counter()
+            data.remove_from_playlist("bench", bench_song_url(number))
+            removes.append(time.perf_counter() - began)
+        elapsed = time.perf_counter() - started
+        results[name] = {
+            'add': latency_summary(adds),
+            'remove': latency_summary(removes),
+            'ops_per_second': round((len(adds) + len(removes)) / elapsed),
+            'flush_seconds': round(await _timed(store.flush(data)), 4),
+        }
+    return results
+
+
+async def bench_song_listing(args):
+    """/songs on a playlist, cold (every song goes to the extractor) and warm (from the metadata cache)."""
+    cog = Music(FakeBot())
+    guild, _ = await _music_guild(cog, args.listing_songs)
+    results = {}
+    for run in ('cold', 'warm'):
+        interaction = FakeInteraction(guild)
+        seconds = await _timed(Music.songs.callback(cog, interaction, "bench", None))
+        results[run] = {
+            'seconds': round(seconds, 4),
+            'songs_per_second': round(args.listing_songs / seconds),
+            'first_reply_ms': round(interaction.replies[0][0] * 1000, 3),
+        }
+    cog.cog_unload()
+    return results
+
+
+async def bench_track_transitions(args):
+    """/play, tracks ending on their own, and /next: time to the first frame, and the silence between tracks."""
+    cog = Music(FakeBot())
+    guild, _ = await _music_guild(cog, 50, speed=args.speed)
+    voice_client = await guild.voice_channel.connect()
+    timeout = 10 + args.track_seconds / args.speed * (args.transitions + 1) * 2
+    started = time.perf_counter()
+    await Music.play.callback(cog, FakeInteraction(guild), "bench")
+    first_audio = await _wait_for_frames(voice_client, 1, timeout) - started
+    await _wait_for_frames(voice_client, args.transitions + 1, timeout)
+    gaps = _track_gaps(list(voice_client.events))
+    skips = []
+    for _ in range(args.transitions):
+        tracks = sum(1 for event, _ in list(voice_client.events) if event == 'first_frame')
+        began = time.perf_counter()
+        await Music.next.callback(cog, FakeInteraction(guild))
+        skips.append(await _wait_for_frames(voice_client, tracks + 1, timeout) - began)
+    await Music.stop.callback(cog, FakeInteraction(guild))
+    cog.cog_unload()
+    return {
+        'first_audio_ms': round(first_audio * 1000, 3),
+        'track_gap': latency_summary(gaps),
+        'next': latency_summary(skips),
+    }
+
+
+async def bench_bulk_import(args):
+    """/add_songs_from_playlist with a playlist of --import-size songs, and writing the result out."""
+    cog = Music(FakeBot())
+    guild, data = await _music_guild(cog, 0)
+    seconds = await _timed(Music.add_songs_from_playlist.callback(cog, FakeInteraction(guild), "bench", bench_playlist_url()))
+    flush = await _timed(playlist_writer.flush())
+    songs = data.song_count("bench")
+    cog.cog_unload()
+    return {
+        'songs': songs,
+        'seconds': round(seconds, 4),
+        'songs_per_second': round(songs / seconds),
+        'flush_seconds': round(flush, 4),
+    }
+
+
+async def bench_dice(args):
+    """/roll over a spread of expressions, then a big /multiroll and an /odds."""
+    cog = Dice(FakeBot())
+    guild = FakeGuild()
+    # load d20 and numpy and start the worker pool, so the first timed roll doesn't pay for them
+    await cog.warm_up()
+    await Dice.roll.callback(cog, FakeInteraction(guild), dice=DICE_EXPRESSIONS[-1])
+    results = {}
+    for expression in DICE_EXPRESSIONS:
+        latencies = [await _timed(Dice.roll.callback(cog, FakeInteraction(guild), dice=expression)) for _ in range(args.rolls)]
+        results[expression] = {**latency_summary(latencies), 'rolls_per_second': round(len(latencies) / sum(latencies))}
+    results['multiroll_100000'] = {'seconds': round(await _timed(Dice.multiroll.callback(cog, FakeInteraction(guild), 100_000, dice="4d6kh3")), 4)}
+    results['odds_8d6kh3'] = {'seconds': round(await _timed(Dice.odds.callback(cog, FakeInteraction(guild), "8d6kh3", 15)), 4)}
+    cog.cog_unload()
+    return results
+
+
+BENCHMARKS = {
+    'playlist_mutations': bench_playlist_mutations,
+    'song_listing': bench_song_listing,
+    'track_transitions': bench_track_transitions,
+    'bulk_import': bench_bulk_import,
+    'dice': bench_dice,
+}
+
+
+async def run(args):
+    results = {}
+    for name in args.only or BENCHMARKS:
+        started = time.perf_counter()
+        results[name] = await BENCHMARKS[name](args)
+        print(f"{name} ({time.perf_counter() - started:.1f}s)")
+        print(json.dumps(results[name], indent=2))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Toby's music, dice and playlist code paths offline.")
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help="run just these benchmarks")
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds each fake extraction takes, on average")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="share of fake extractions that fail")
+    parser.add_argument('--songs', type=int, default=1000, help="songs to add and remove in playlist_mutations")
+    parser.add_argument('--listing-songs', type=int, default=200, help="songs in the playlist song_listing lists")
+    parser.add_argument('--import-size', type=int, default=500, help="songs in the playlist bulk_import imports")
+    parser.add_argument('--track-seconds', type=float, default=2.0, help="length of each fake track")
+    parser.add_argument('--speed', type=float, default=1.0, help="how much faster than real time the fake voice client plays")
+    parser.add_argument('--transitions', type=int, default=5, help="track changes to time, both natural and /next")
+    parser.add_argument('--rolls', type=int, default=200, help="rolls of each expression in the dice benchmark")
+    parser.add_argument('--audio', default=None, help="play this local file through FFmpeg instead of fake silence")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', default=None, help="write the results to this file")
+    parser.add_argument('--baseline', default=None, help="results file from an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="how much worse than the baseline counts as a regression")
+    args = parser.parse_args()
+
+    configure_logging(os.getenv('TOBY_LOG_LEVEL', 'WARNING'))
+    with offline(args.latency, args.failure_rate, args.track_seconds, args.import_size, args.audio, args.seed):
+        results = asyncio.run(run(args))
+    if args.json:
+        write_json(args.json, results, vars(args))
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for name, before, now in regressions:
+            print(f"REGRESSION {name}: {before} -> {now}")
+        if regressions:
+            sys.exit(1)
+        print(f"no regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
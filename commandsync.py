@@ -0,0 +1,88 @@
+import asyncio
+import hashlib
+import json
+import os
+import nextcord
+from logs import get_logger
+
+log = get_logger(__name__)
+
+
+class CommandSync(object):
+    """
+    Syncs slash commands with Discord only where they've changed.  After each successful sync a hash of the command
+    payloads for that guild (or for the global commands) is saved; on the next boot a guild whose hash still matches is
+    skipped, and nextcord associates its commands lazily when they're first used.  The guilds that do need syncing go
+    concurrently, a few at a time.
+    """
+
+    LOCATION = './cache/command_sync.json'
+    CONCURRENCY = 4
+
+    def __init__(self, client: nextcord.Client, location=None):
+        self.client = client
+        self.location = location or os.getenv('TOBY_COMMAND_SYNC_FILE', self.LOCATION)
+        self.concurrency = int(os.getenv('TOBY_COMMAND_SYNC_CONCURRENCY', self.CONCURRENCY))
+        # set after someone edits commands by hand in the developer portal, to make every guild sync once
+        self.force = os.getenv('TOBY_FORCE_COMMAND_SYNC', '0').lower() in ('1', 'true', 'yes')
+        self.synced = 0
+        self.skipped = 0
+        self.failed = 0
+        self._limit = None
+        self._hashes = self._load()
+
+    async def sync(self, guild_id=None):
+        """Syncs the commands for *guild_id* (None for the global ones) if they've changed.  Returns whether it did."""
+        if guild_id is None:
+            commands = self.client._connection.get_global_application_commands(rollout=True)
+        else:
+            commands = self.client._connection.get_guild_application_commands(guild_id, rollout=True)
+        if not commands and guild_id is not None and not self.client._rollout_all_guilds:
+            return False
+        key = str(guild_id or 'global')
+        digest = self.schema_hash(commands, guild_id)
+        if not self.force and self._hashes.get(key) == digest:
+            self.skipped += 1
+            return False
+        if self._limit is None:
+            self._limit = asyncio.Semaphore(self.concurrency)
+        async with self._limit:
+            try:
+                await self.client.sync_application_commands(
+                    guild_id=guild_id,
+                    associate_known=self.client._rollout_associate_known,
+                    delete_unknown=self.client._rollout_delete_unknown,
+                    update_known=self.client._rollout_update_known,
+                    register_new=self.client._rollout_register_new,
+                )
+            except nextcord.HTTPException as e:
+                # leave the old hash, so we try again next boot
+                log.error("command_sync_failed", scope=key, error=e)
+                self.failed += 1
+                return False
+        self._hashes[key] = digest
+        self._save()
+        self.synced += 1
+        return True
+
+    def schema_hash(self, commands, guild_id):
+        payloads = sorted((command.get_payload(guild_id) for command in commands), key=lambda payload: (payload['name'], payload.get('type', 1)))
+        schema = json.dumps({'application': self.client.application_id, 'commands': payloads}, sort_keys=True, default=str)
+        return hashlib.sha256(schema.encode()).hexdigest()
+
+    def stats(self):
+        return {'synced': self.synced, 'skipped': self.skipped, 'failed': self.failed}
+
+    def _load(self):
+        try:
+            with open(self.location) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.location), exist_ok=True)
+        tmp = f"{self.location}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self._hashes, f, indent=2)
+        os.replace(tmp, self.location)
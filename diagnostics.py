@@ -0,0 +1,155 @@
+import asyncio
+import collections
+import os
+import sys
+import threading
+import time
+import traceback
+import metrics
+from logs import get_logger
+
+log = get_logger(__name__)
+
+LOOP_LAG_SECONDS = metrics.Histogram('toby_event_loop_lag_seconds', "How late the event loop woke a task that asked to sleep",
+                                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+LOOP_STALLS = metrics.Counter('toby_event_loop_stalls_total', "Times the event loop was blocked for longer than the lag threshold")
+
+
+class LoopMonitor(object):
+    """
+    Watches the event loop for blocking code.  A task on the loop wakes every INTERVAL and records how late it woke;
+    a watchdog thread checks that task's heartbeat, and once the loop has been stuck for more than THRESHOLD it logs
+    a snapshot of the loop thread's stack, which is the code doing the blocking.
+    """
+
+    INTERVAL = 0.1
+    THRESHOLD = 0.25
+    # at most one stack snapshot this often, so a loop that keeps stalling doesn't flood the log
+    SNAPSHOT_COOLDOWN = 30.0
+
+    def __init__(self, interval=None, threshold=None):
+        self.interval = interval or float(os.getenv('TOBY_LOOP_LAG_INTERVAL', self.INTERVAL))
+        self.threshold = threshold or float(os.getenv('TOBY_LOOP_LAG_THRESHOLD', self.THRESHOLD))
+        self.max_lag = 0.0
+        self.stalls = 0
+        self._heartbeat = None
+        self._loop_thread = None
+        self._task = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.ensure_future(self._beat())
+        self._watchdog = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _beat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self._heartbeat = now
+            LOOP_LAG_SECONDS.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.threshold:
+                self.stalls += 1
+                LOOP_STALLS.inc()
+                log.warning("event_loop_stalled", lag=f"{lag:.3f}s")
+
+    def _watch(self):
+        last_snapshot = -self.SNAPSHOT_COOLDOWN
+        snapshotted = None
+        while not self._stopped.wait(self.threshold / 2):
+            heartbeat = self._heartbeat
+            stuck = time.monotonic() - heartbeat - self.interval
+            if stuck <= self.threshold or snapshotted == heartbeat:
+                continue
+            # once per stall: the heartbeat won't move again until the loop gets going
+            snapshotted = heartbeat
+            if time.monotonic() - last_snapshot < self.SNAPSHOT_COOLDOWN:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            last_snapshot = time.monotonic()
+            log.warning("event_loop_blocked", blocked_for=f"{stuck:.3f}s", stack="".join(traceback.format_stack(frame)))
+
+    def stats(self):
+        return {'max_lag_ms': round(self.max_lag * 1000), 'stalls': self.stalls}
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stacks of the running process every INTERVAL seconds for a while and counts where they were, without
+    tracing hooks, so it's cheap enough to run against the live bot.
+    """
+
+    INTERVAL = 0.005
+    MAX_SECONDS = 60
+    # frames of each call path to keep, counted from the innermost
+    DEPTH = 6
+
+    def __init__(self, interval=None):
+        self.interval = interval or self.INTERVAL
+        self._lock = threading.Lock()
+
+    def busy(self):
+        return self._lock.locked()
+
+    def profile(self, seconds, thread_ids=None):
+        """
+        Blocks for *seconds* sampling *thread_ids* (every thread but this one if None).  Returns (samples, paths), where
+        paths counts each call path, a tuple of "file:line function" innermost first.
+        """
+        seconds = min(seconds, self.MAX_SECONDS)
+        with self._lock:
+            me = threading.get_ident()
+            paths = collections.Counter()
+            samples = 0
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                for ident, frame in sys._current_frames().items():
+                    if ident == me or (thread_ids is not None and ident not in thread_ids):
+                        continue
+                    paths[self._path(frame)] += 1
+                    samples += 1
+                time.sleep(self.interval)
+            return samples, paths
+
+    def _path(self, frame):
+        path = []
+        while frame is not None and len(path) < self.DEPTH:
+            code = frame.f_code
+            path.append(f"{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}")
+            frame = frame.f_back
+        return tuple(path)
+
+
+def format_profile(samples, paths, top=10, max_length=1800):
+    """
+    The *top* call paths as a code block: share of samples, then the innermost frame and who called it.  Stops early
+    rather than go over *max_length*, so the block fits in one message.
+    """
+    if not samples:
+        return "No samples."
+    lines = [f"{samples} samples, top call paths:"]
+    length = len(lines[0])
+    for path, count in paths.most_common(top):
+        entry = [f"{count / samples:6.1%}  {path[0]}"] + [f"         <- {frame}" for frame in path[1:]]
+        length += sum(len(line) + 1 for line in entry)
+        if length > max_length:
+            break
+        lines.extend(entry)
+    return "```\n" + "\n".join(lines) + "\n```"
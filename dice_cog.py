@@ -1,9 +1,20 @@
 
+import asyncio
+import functools
+import os
 import re
-import d20
 import nextcord
 from nextcord.ext import commands
-from utils import BladesStringifier, VerboseMDStringifier, PersistentRollContext, safe_send, get_register_guilds
+from logs import get_logger
+from utils import lazy_import, safe_send, get_register_guilds
+
+# d20's grammar and numpy are slow to import, so they load on the first roll (or the warm up after connecting)
+d20 = lazy_import('d20')
+dicepool = lazy_import('dicepool')
+dicestats = lazy_import('dicestats')
+dicestrings = lazy_import('dicestrings')
+
+log = get_logger(__name__)
 
 
 ADV_WORD_RE = re.compile(r"(?:^|\s+)(adv|dis)(?:\s+|$)")
@@ -27,8 +38,37 @@ def string_search_adv(dice_str: str):
 class Dice(commands.Cog):
     """Dice and math related commands."""
 
+    # up to this many iterations every roll is listed; past it we only report statistics
+    LIST_ITERATIONS = 100
+    MAX_ITERATIONS = 1_000_000
+    # how many times we roll with d20 when the batch roller can't handle an expression
+    FALLBACK_ITERATIONS = 1000
+
     def __init__(self, bot):
         self.bot = bot
+        self.max_iterations = int(os.getenv('TOBY_DICE_MAX_ITERATIONS', self.MAX_ITERATIONS))
+
+    @functools.cached_property
+    def batch_roller(self):
+        return dicestats.BatchRoller()
+
+    @functools.cached_property
+    def odds_calculator(self):
+        return dicestats.OddsCalculator()
+
+    @functools.cached_property
+    def parse_cache(self):
+        return dicepool.ParseCache()
+
+    @functools.cached_property
+    def dice_pool(self):
+        return dicepool.DicePool()
+
+    async def warm_up(self):
+        self.parse_cache.parse("1d20")
+        await asyncio.sleep(0)
+        self.batch_roller
+        self.odds_calculator
 
 # This is straight up stolen from avrae!
     @nextcord.slash_command(guild_ids=get_register_guilds())
@@ -77,27 +117,51 @@ class Dice(commands.Cog):
 
         dice, adv = string_search_adv(dice)
 
-        res = d20.roll(dice, advantage=adv, allow_comments=True, stringifier=VerboseMDStringifier())
-        out = f"{interaction.user.mention}  :game_die:\n{str(res)}"
+        ast = self.parse_cache.parse(dice, allow_comments=True)
+        try:
+            text, total = await self.dice_pool.run(dicepool.roll_one, ast, adv, dicestrings.VerboseMDStringifier, cost=dicepool.roll_cost(ast))
+        except dicepool.RollBudgetExceeded as e:
+            return await self._budget_exceeded(interaction, e)
+        out = f"{interaction.user.mention}  :game_die:\n{text}"
         if len(out) > 1999:
-            out = f"{interaction.user.mention}  :game_die:\n{str(res)[:100]}...\n**Total**: {res.total}"
+            out = f"{interaction.user.mention}  :game_die:\n{text[:100]}...\n**Total**: {total}"
 
         await safe_send(interaction, out, allowed_mentions=nextcord.AllowedMentions(users=[interaction.user]))
 
     @nextcord.slash_command(guild_ids=get_register_guilds())
     async def multiroll(self, interaction: nextcord.Interaction, iterations: int, *, dice):
-        """Rolls dice in xdy format a given number of times.
+        """Rolls dice in xdy format a given number of times.  Over 100 iterations, reports statistics instead.
         Usage: multiroll <iterations> <dice>"""
         dice, adv = string_search_adv(dice)
         await self._roll_many(interaction, iterations, dice, adv=adv)
 
     @nextcord.slash_command(guild_ids=get_register_guilds())
     async def iterroll(self, interaction: nextcord.Interaction, iterations: int, dice, dc: int = None, *, args=""):
-        """Rolls dice in xdy format, given a set dc.
+        """Rolls dice in xdy format, given a set dc.  Over 100 iterations, reports the success rate and statistics.
         Usage: iterroll <iterations> <xdy> <DC> [args]"""
         _, adv = string_search_adv(args)
         await self._roll_many(interaction, iterations, dice, dc, adv)
 
+    @nextcord.slash_command(guild_ids=get_register_guilds())
+    async def odds(self, interaction: nextcord.Interaction, dice: str, dc: int = None):
+        """Works out the exact odds of a roll: its average, spread and chance to meet a DC.
+        Usage: odds <dice> [dc], e.g. `/odds dice:1d20+5 adv dc:15` or `/odds dice:4d6kh3`"""
+        dice, adv = string_search_adv(dice)
+        ast = self.parse_cache.parse(dice, allow_comments=True)
+        try:
+            distribution = await asyncio.get_running_loop().run_in_executor(None, self.odds_calculator.distribution, ast, adv)
+        except dicestats.UnsupportedRoll as e:
+            await safe_send(interaction, f"I can't work out exact odds for that ({e}).  Try /iterroll instead.", ephemeral=True)
+            return
+        header = f"Odds for {dice.strip()}"
+        if adv != d20.AdvType.NONE:
+            header = f"{header} at {'advantage' if adv == d20.AdvType.ADV else 'disadvantage'}"
+        if dc is not None:
+            header = f"{header}, DC {dc}"
+        if ast.comment:
+            header = f"{ast.comment}: {header}"
+        await safe_send(interaction, f"{header}\n{dicestats.format_summary(distribution.summary(dc))}")
+
     @nextcord.slash_command(guild_ids=get_register_guilds())
     async def bladesroll(self, interaction: nextcord.Interaction, numdice: int):
         """Rolls dice for blades in the dark.  Rolls a number of dice,
@@ -111,45 +175,75 @@ class Dice(commands.Cog):
         else:
             await safe_send(interaction, "You can't roll a negative number of dice!")
             return
-        res = d20.roll(rollexpr, stringifier=BladesStringifier())
-        out = f"{interaction.user.mention}  :crossed_swords::game_die:\n{str(res)}"
+        ast = self.parse_cache.parse(rollexpr)
+        try:
+            text, total = await self.dice_pool.run(dicepool.roll_one, ast, d20.AdvType.NONE, dicestrings.BladesStringifier, cost=dicepool.roll_cost(ast))
+        except dicepool.RollBudgetExceeded as e:
+            return await self._budget_exceeded(interaction, e)
+        out = f"{interaction.user.mention}  :crossed_swords::game_die:\n{text}"
         if len(out) > 1999:
-            out = f"{interaction.user.mention}  :game_die:\n{str(res)[:100]}...\n**Total**: {res.total}"
+            out = f"{interaction.user.mention}  :game_die:\n{text[:100]}...\n**Total**: {total}"
         await safe_send(interaction, out, allowed_mentions=nextcord.AllowedMentions(users=[interaction.user]))
 
-    @staticmethod
-    async def _roll_many(interaction: nextcord.Interaction, iterations, roll_str, dc=None, adv=None):
-        if iterations < 1 or iterations > 100:
+    async def _roll_many(self, interaction: nextcord.Interaction, iterations, roll_str, dc=None, adv=None):
+        if iterations < 1 or iterations > self.max_iterations:
             return await safe_send(interaction, "Too many or too few iterations.")
         if adv is None:
             adv = d20.AdvType.NONE
-        results = []
-        successes = 0
-        ast = d20.parse(roll_str, allow_comments=True)
-        roller = d20.Roller(context=PersistentRollContext())
-
-        for _ in range(iterations):
-            res = roller.roll(ast, advantage=adv)
-            if dc is not None and res.total >= dc:
-                successes += 1
-            results.append(res)
+        ast = self.parse_cache.parse(roll_str, allow_comments=True)
+        try:
+            if iterations > self.LIST_ITERATIONS:
+                out = await self._roll_stats(iterations, ast, dc, adv)
+                await safe_send(interaction, f"{interaction.user.mention}\n{out}", allowed_mentions=nextcord.AllowedMentions(users=[interaction.user]))
+                return
+            results = await self.dice_pool.run(dicepool.roll_many, ast, adv, iterations, d20.MarkdownStringifier, cost=iterations * dicepool.roll_cost(ast))
+        except dicepool.RollBudgetExceeded as e:
+            return await self._budget_exceeded(interaction, e)
+        successes = sum(1 for _, total in results if dc is not None and total >= dc)
 
         if dc is None:
             header = f"Rolling {iterations} iterations..."
-            footer = f"{sum(o.total for o in results)} total."
+            footer = f"{sum(total for _, total in results)} total."
         else:
             header = f"Rolling {iterations} iterations, DC {dc}..."
-            footer = f"{successes} successes, {sum(o.total for o in results)} total."
+            footer = f"{successes} successes, {sum(total for _, total in results)} total."
 
         if ast.comment:
             header = f"{ast.comment}: {header}"
 
-        result_strs = "\n".join(str(o) for o in results)
+        result_strs = "\n".join(text for text, _ in results)
 
         out = f"{header}\n{result_strs}\n{footer}"
 
         if len(out) > 1500:
-            one_result = str(results[0])
+            one_result = results[0][0]
             out = f"{header}\n{one_result}\n[{len(results) - 1} results omitted for output size.]\n{footer}"
 
         await safe_send(interaction, f"{interaction.user.mention}\n{out}", allowed_mentions=nextcord.AllowedMentions(users=[interaction.user]))
+
+    async def _roll_stats(self, iterations, ast, dc, adv):
+        """Rolls *ast* *iterations* times with the batch roller and describes the totals, falling back to d20 if need be."""
+        try:
+            # numpy lets go of the GIL for the heavy lifting, so keep it off the event loop
+            totals = await asyncio.get_running_loop().run_in_executor(None, self.batch_roller.roll, ast, iterations, adv)
+        except dicestats.UnsupportedRoll as e:
+            log.info("batch_roll_unsupported", roll=ast, reason=e, fallback_iterations=self.FALLBACK_ITERATIONS)
+            requested, iterations = iterations, min(iterations, self.FALLBACK_ITERATIONS)
+            totals = await self.dice_pool.run(dicepool.roll_totals, ast, adv, iterations, cost=iterations * dicepool.roll_cost(ast))
+        else:
+            requested = iterations
+        header = f"Rolling {iterations} iterations..." if dc is None else f"Rolling {iterations} iterations, DC {dc}..."
+        if ast.comment:
+            header = f"{ast.comment}: {header}"
+        if iterations < requested:
+            # say so, rather than have a summary of fewer rolls pass for the one that was asked for
+            header = f"{header}\n(Rolls like this one are capped at {iterations} iterations, not {requested}.)"
+        return f"{header}\n{dicestats.format_summary(dicestats.summarize(totals, dc))}"
+
+    @staticmethod
+    async def _budget_exceeded(interaction: nextcord.Interaction, error):
+        await safe_send(interaction, f"That roll is too big for me to work out: {error}.  Try fewer dice, sorry!", ephemeral=True)
+
+    def cog_unload(self):
+        if 'dice_pool' in self.__dict__:
+            self.dice_pool.close()
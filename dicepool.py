@@ -0,0 +1,162 @@
+import asyncio
+import concurrent.futures
+import math
+import multiprocessing
+import os
+import re
+import signal
+import weakref
+from collections import OrderedDict
+import d20
+from d20 import diceast
+from dicestrings import PersistentRollContext
+
+
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+class RollBudgetExceeded(Exception):
+    pass
+
+
+class ParseCache(object):
+    """An LRU of parsed d20 expressions, keyed by the expression with its whitespace normalized."""
+
+    MAX_ENTRIES = 1024
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries or int(os.getenv('TOBY_DICE_PARSE_CACHE', self.MAX_ENTRIES))
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def parse(self, expr: str, allow_comments=False):
+        """Returns the parsed AST for *expr*.  The tree is shared, so treat it as read-only (d20.Roller does)."""
+        normalized = WHITESPACE_RE.sub(" ", expr.strip())
+        key = (normalized, allow_comments)
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        self.misses += 1
+        ast = d20.parse(normalized, allow_comments=allow_comments)
+        self._entries[key] = ast
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return ast
+
+    def stats(self):
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+def roll_cost(node):
+    """A rough count of the dice *node* rolls.  Exploding and reroll-until-it-stops have no bound, so cost infinity."""
+    if isinstance(node, diceast.OperatedSet) and any(op.op in ('e', 'rr') for op in node.operations):
+        return math.inf
+    cost = node.num if isinstance(node, diceast.Dice) else 0
+    return cost + sum(roll_cost(child) for child in node.children)
+
+
+def roll_one(ast, adv, stringifier):
+    """Rolls *ast* once.  Returns (text, total) rather than the RollResult so it crosses a process boundary cheaply."""
+    res = d20.Roller().roll(ast, advantage=adv, stringifier=stringifier())
+    return str(res), res.total
+
+
+def roll_many(ast, adv, iterations, stringifier):
+    """Rolls *ast* *iterations* times with one roll budget between them.  Returns a list of (text, total)."""
+    roller = d20.Roller(context=PersistentRollContext())
+    results = []
+    for _ in range(iterations):
+        res = roller.roll(ast, advantage=adv, stringifier=stringifier())
+        results.append((str(res), res.total))
+    return results
+
+
+def roll_totals(ast, adv, iterations):
+    """Like roll_many, but only the totals."""
+    roller = d20.Roller(context=PersistentRollContext(max_total_rolls=iterations * 1000))
+    return [roller.roll(ast, advantage=adv).total for _ in range(iterations)]
+
+
+def _run_with_budget(cpu_budget, fn, *args):
+    # runs in the worker process: SIGPROF arrives once this process has spent cpu_budget seconds on CPU
+    def over_budget(signum, frame):
+        raise RollBudgetExceeded(f"it needed more than {cpu_budget:g}s of CPU")
+    signal.signal(signal.SIGPROF, over_budget)
+    signal.setitimer(signal.ITIMER_PROF, cpu_budget)
+    try:
+        return fn(*args)
+    finally:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+
+
+class DicePool(object):
+    """
+    Evaluates rolls.  Cheap ones run inline; anything that might roll a lot of dice runs in a worker process with a
+    CPU budget and a wall-clock deadline, so a pathological roll can't stall the event loop, and voice with it.
+    """
+
+    WORKERS = 2
+    INLINE_DICE = 100
+    CPU_BUDGET = 2.0
+    DEADLINE = 5.0
+
+    def __init__(self):
+        self.workers = int(os.getenv('TOBY_DICE_WORKERS', self.WORKERS))
+        self.inline_dice = int(os.getenv('TOBY_DICE_INLINE_DICE', self.INLINE_DICE))
+        self.cpu_budget = float(os.getenv('TOBY_DICE_CPU_BUDGET', self.CPU_BUDGET))
+        self.deadline = float(os.getenv('TOBY_DICE_DEADLINE', self.DEADLINE))
+        self._pool = None
+        self._killed = weakref.WeakSet()
+
+    async def run(self, fn, *args, cost):
+        """
+        Returns fn(*args), run in a worker process if *cost* (see roll_cost) is more than we're happy to roll inline.
+        Raises RollBudgetExceeded if it rolls more dice than d20 allows, runs out of CPU budget or misses the deadline.
+        """
+        try:
+            if cost <= self.inline_dice:
+                return fn(*args)
+            return await self._submit(fn, args)
+        except d20.TooManyRolls:
+            raise RollBudgetExceeded("it rolls too many dice")
+
+    async def _submit(self, fn, args, retry=True):
+        pool = self._start()
+        future = pool.submit(_run_with_budget, self.cpu_budget, fn, *args)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.deadline)
+        except asyncio.TimeoutError:
+            # the CPU timer should have fired first, so the worker is stuck or starved; don't let it linger
+            self._kill(pool)
+            raise RollBudgetExceeded(f"it took more than {self.deadline:g}s")
+        except concurrent.futures.process.BrokenProcessPool:
+            if retry and pool in self._killed:
+                # collateral: we took the pool down over someone else's roll, so this one gets another go
+                return await self._submit(fn, args, retry=False)
+            if self._pool is pool:
+                self._pool = None
+            raise RollBudgetExceeded("the dice worker died")
+
+    def _start(self):
+        if self._pool is None:
+            # spawn, not fork: the bot process has threads (voice, executors) that a fork would copy mid-flight
+            self._pool = concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+    def _kill(self, pool):
+        if self._pool is pool:
+            self._pool = None
+        self._killed.add(pool)
+        # ProcessPoolExecutor can't interrupt a running task, so take its processes down with it.  Every other roll on
+        # the pool then fails with BrokenProcessPool, which _submit retries once on a fresh pool
+        processes = list((pool._processes or {}).values())
+        pool.shutdown(wait=False)
+        for process in processes:
+            process.kill()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
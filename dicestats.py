@@ -0,0 +1,567 @@
+import os
+import threading
+from collections import OrderedDict
+import d20
+import numpy as np
+from d20 import diceast
+
+
+BINARY_OPS = {
+    '+': np.add,
+    '-': np.subtract,
+    '*': np.multiply,
+    '/': np.true_divide,
+    '//': np.floor_divide,
+    '%': np.mod,
+    '<': np.less,
+    '>': np.greater,
+    '==': np.equal,
+    '>=': np.greater_equal,
+    '<=': np.less_equal,
+    '!=': np.not_equal,
+}
+
+
+class UnsupportedRoll(Exception):
+    """Raised when an expression uses something the batch roller can't vectorize; roll it with d20.Roller instead."""
+    pass
+
+
+class BatchRoller(object):
+    """
+    Rolls a parsed d20 expression many times at once, one numpy array element per trial.
+
+    Every dice node becomes an (iterations x dice) matrix of face values plus a matching mask of which dice are still
+    kept, so the set operators (k, p, rr, ro, ra, e, mi, ma) and selectors (X, lX, hX, <X, >X) behave as they do in
+    d20.Roller, just for every trial in one go.
+    """
+
+    MAX_CELLS = 20_000_000
+    MAX_REROLL_ROUNDS = 100
+
+    def __init__(self, seed=None):
+        self.rng = np.random.default_rng(seed)
+        self.max_cells = int(os.getenv('TOBY_DICE_MAX_CELLS', self.MAX_CELLS))
+        self._nodes = {
+            diceast.Expression: self._eval_expression,
+            diceast.AnnotatedNumber: self._eval_annotatednumber,
+            diceast.Literal: self._eval_literal,
+            diceast.Parenthetical: self._eval_parenthetical,
+            diceast.UnOp: self._eval_unop,
+            diceast.BinOp: self._eval_binop,
+            diceast.OperatedSet: self._eval_operatedset,
+            diceast.OperatedDice: self._eval_operatedset,
+            diceast.NumberSet: self._eval_set,
+            diceast.Dice: self._eval_set,
+        }
+
+    def roll(self, expr: diceast.Node, iterations: int, advantage=d20.AdvType.NONE):
+        """Returns an array of *iterations* totals for *expr*.  Raises UnsupportedRoll if it can't be vectorized."""
+        if advantage != d20.AdvType.NONE:
+            expr = d20.utils.ast_adv_copy(expr, advantage)
+        # like RollResult.total, only the final result is truncated to a whole number
+        return np.trunc(np.asarray(self._eval(expr, iterations), dtype=np.float64))
+
+    def _eval(self, node, n):
+        handler = self._nodes.get(type(node))
+        if handler is None:
+            raise UnsupportedRoll(f"can't vectorize {type(node).__name__}")
+        return handler(node, n)
+
+    def _eval_expression(self, node, n):
+        return self._eval(node.roll, n)
+
+    def _eval_annotatednumber(self, node, n):
+        return self._eval(node.value, n)
+
+    def _eval_literal(self, node, n):
+        return np.full(n, node.value)
+
+    def _eval_parenthetical(self, node, n):
+        return self._eval(node.value, n)
+
+    def _eval_unop(self, node, n):
+        value = self._eval(node.value, n)
+        return -value if node.op == '-' else value
+
+    def _eval_binop(self, node, n):
+        left = self._eval(node.left, n)
+        right = self._eval(node.right, n)
+        if node.op in ('/', '//', '%') and not np.all(right):
+            # let d20 raise its own divide by zero error
+            raise UnsupportedRoll("division by zero")
+        result = BINARY_OPS[node.op](left, right)
+        if result.dtype == bool:
+            result = result.astype(np.int64)
+        return result
+
+    def _eval_set(self, node, n):
+        values, kept = self._eval_operands(node, n)
+        return np.where(kept, values, 0).sum(axis=1)
+
+    def _eval_operatedset(self, node, n):
+        values, kept = self._eval_operands(node.value, n)
+        size = node.value.size if isinstance(node.value, diceast.Dice) else None
+        for op in node.operations:
+            if size is None and op.op not in ('k', 'p'):
+                raise UnsupportedRoll(f"{op.op} only works on dice")
+            values, kept = self._operate(op, values, kept, size)
+        return np.where(kept, values, 0).sum(axis=1)
+
+    def _eval_operands(self, node, n):
+        """Returns the (values, kept) matrices for a Dice or NumberSet node."""
+        if isinstance(node, diceast.Dice):
+            self._check_cells(n, node.num)
+            return self._roll_dice(node.size, (n, node.num)), np.ones((n, node.num), dtype=bool)
+        if isinstance(node, diceast.NumberSet):
+            if not node.values:
+                return np.zeros((n, 0)), np.zeros((n, 0), dtype=bool)
+            values = np.stack([self._eval(child, n) for child in node.values], axis=1)
+            return values, np.ones(values.shape, dtype=bool)
+        raise UnsupportedRoll(f"can't vectorize a set of {type(node).__name__}")
+
+    def _roll_dice(self, size, shape):
+        if size == '%':
+            return self.rng.integers(0, 10, size=shape) * 10
+        if size < 1:
+            # d20 has the error message for this
+            raise UnsupportedRoll("0-sided die")
+        return self.rng.integers(1, size + 1, size=shape)
+
+    def _check_cells(self, n, columns):
+        if n * columns > self.max_cells:
+            raise UnsupportedRoll(f"{n} x {columns} dice is too many to roll at once")
+
+    def _operate(self, op, values, kept, size):
+        if op.op == 'k':
+            return values, kept & self._select(op.sels, values, kept)
+        if op.op == 'p':
+            return values, kept & ~self._select(op.sels, values, kept)
+        if op.op in ('mi', 'ma'):
+            selector = op.sels[-1]
+            if selector.cat is not None:
+                raise UnsupportedRoll(f"{op.op} needs a literal selector")
+            clamp = np.maximum if op.op == 'mi' else np.minimum
+            return np.where(kept, clamp(values, selector.num), values), kept
+        if op.op == 'ro':
+            to_reroll = self._select(op.sels, values, kept)
+            return np.where(to_reroll, self._roll_dice(size, values.shape), values), kept
+        if op.op == 'rr':
+            values = values.copy()
+            for _ in range(self.MAX_REROLL_ROUNDS):
+                to_reroll = self._select(op.sels, values, kept)
+                if not to_reroll.any():
+                    return values, kept
+                values[to_reroll] = self._roll_dice(size, (int(to_reroll.sum()),))
+            raise UnsupportedRoll("rerolls never settle")
+        if op.op == 'ra':
+            selected = self._select(op.sels, values, kept)
+            return self._add_dice(values, kept, selected.any(axis=1).astype(np.int64), size)
+        if op.op == 'e':
+            exploded = np.zeros(kept.shape, dtype=bool)
+            for _ in range(self.MAX_REROLL_ROUNDS):
+                to_explode = self._select(op.sels, values, kept) & ~exploded
+                if not to_explode.any():
+                    return values, kept
+                exploded |= to_explode
+                values, kept = self._add_dice(values, kept, to_explode.sum(axis=1), size)
+                exploded = np.pad(exploded, ((0, 0), (0, values.shape[1] - exploded.shape[1])))
+            raise UnsupportedRoll("explosions never settle")
+        raise UnsupportedRoll(f"unknown operator {op.op}")
+
+    def _add_dice(self, values, kept, counts, size):
+        """Rolls *counts[i]* more dice onto the end of trial *i*."""
+        extra = int(counts.max(initial=0))
+        if not extra:
+            return values, kept
+        self._check_cells(values.shape[0], values.shape[1] + extra)
+        new_values = self._roll_dice(size, (values.shape[0], extra))
+        new_kept = np.arange(extra) < counts[:, None]
+        return np.hstack([values, np.where(new_kept, new_values, 0)]), np.hstack([kept, new_kept])
+
+    def _select(self, sels, values, kept):
+        """The union of what each selector picks out of the kept values, as a mask."""
+        selected = np.zeros(kept.shape, dtype=bool)
+        for sel in sels:
+            if sel.cat is None:
+                selected |= kept & (values == sel.num)
+            elif sel.cat == '<':
+                selected |= kept & (values < sel.num)
+            elif sel.cat == '>':
+                selected |= kept & (values > sel.num)
+            else:
+                # rank the kept dice, dropped ones last, and take the first num of them
+                key = np.where(kept, values, -np.inf if sel.cat == 'h' else np.inf)
+                order = np.argsort(-key if sel.cat == 'h' else key, axis=1, kind='stable')
+                ranks = np.argsort(order, axis=1)
+                selected |= kept & (ranks < sel.num)
+        return selected
+
+
+PERCENTILES = (5, 25, 50, 75, 95)
+
+
+def summarize(totals, dc=None, bins=12):
+    """
+    Summary statistics for an array of roll totals: mean, stddev, min, max, PERCENTILES, a histogram of
+    (low, high, fraction) buckets and, given a *dc*, the fraction of totals that meet it.
+    """
+    totals = np.asarray(totals, dtype=np.float64)
+    values, counts = np.unique(totals, return_counts=True)
+    stats = {
+        'iterations': int(totals.size),
+        'mean': float(totals.mean()),
+        'stddev': float(totals.std()),
+        'min': float(totals.min()),
+        'max': float(totals.max()),
+        'percentiles': dict(zip(PERCENTILES, (float(p) for p in np.percentile(totals, PERCENTILES)))),
+        'histogram': histogram(values, counts / totals.size, bins),
+    }
+    if dc is not None:
+        stats['success_rate'] = float(np.count_nonzero(totals >= dc)) / totals.size
+    return stats
+
+
+def histogram(values, fractions, bins=12):
+    """
+    Buckets sorted, distinct *values* with the given *fractions* into at most *bins* (low, high, fraction) rows.
+    Whole numbers get one row each when they fit.
+    """
+    low, high = values[0], values[-1]
+    whole = np.all(values == np.round(values))
+    if whole and high - low < bins:
+        return [(float(v), float(v), float(f)) for v, f in zip(values, fractions)]
+    if whole:
+        # integer-aligned buckets so no bucket straddles half a value
+        width = int(np.ceil((high - low + 1) / bins))
+        edges = np.arange(low, high + width + 1, width)
+        counts, _ = np.histogram(values, edges, weights=fractions)
+        return [(float(edges[i]), float(edges[i + 1] - 1), float(c)) for i, c in enumerate(counts)]
+    counts, edges = np.histogram(values, bins, weights=fractions)
+    return [(float(edges[i]), float(edges[i + 1]), float(c)) for i, c in enumerate(counts)]
+
+
+def format_number(value):
+    return f"{value:g}" if value == int(value) else f"{value:.2f}"
+
+
+def format_summary(stats, width=20):
+    """Renders *summarize* (or *Distribution.summary*) output as a few lines of text with a bar chart in a code block."""
+    percentiles = ", ".join(f"p{p} {format_number(v)}" for p, v in stats['percentiles'].items())
+    lines = [
+        f"**Mean**: {stats['mean']:.2f}  **Std dev**: {stats['stddev']:.2f}  "
+        f"**Range**: {format_number(stats['min'])}-{format_number(stats['max'])}",
+        f"**Percentiles**: {percentiles}",
+    ]
+    if 'success_rate' in stats:
+        lines.append(f"**Success rate**: {stats['success_rate']:.2%}")
+    peak = max(fraction for _, _, fraction in stats['histogram']) or 1
+    labels = [format_number(lo) if lo == hi else f"{format_number(lo)}-{format_number(hi)}" for lo, hi, _ in stats['histogram']]
+    label_width = max(len(label) for label in labels)
+    chart = [f"{label:>{label_width}} | {'█' * round(width * fraction / peak):<{width}} {fraction:6.2%}"
+             for label, (_, _, fraction) in zip(labels, stats['histogram'])]
+    lines.append("```\n" + "\n".join(chart) + "\n```")
+    return "\n".join(lines)
+
+
+def convolve(a, b):
+    """The distribution of the sum of two independent dense distributions, using an FFT once they get large."""
+    if len(a) * len(b) <= 1_000_000:
+        return np.convolve(a, b)
+    n = len(a) + len(b) - 1
+    size = 1 << (n - 1).bit_length()
+    return np.clip(np.fft.irfft(np.fft.rfft(a, size) * np.fft.rfft(b, size), size)[:n], 0, None)
+
+
+class Distribution(object):
+    """The exact chance of every outcome of a roll, as sorted distinct *values* and their *probs*."""
+
+    def __init__(self, values, probs):
+        self.values = np.asarray(values, dtype=np.float64)
+        self.probs = np.asarray(probs, dtype=np.float64)
+
+    @classmethod
+    def of(cls, values, probs):
+        """Builds a distribution from unsorted, possibly repeated outcomes, merging duplicates and dropping impossibilities."""
+        values, inverse = np.unique(np.asarray(values, dtype=np.float64), return_inverse=True)
+        probs = np.bincount(inverse.ravel(), weights=np.asarray(probs, dtype=np.float64).ravel(), minlength=len(values))
+        possible = probs > 0
+        return cls(values[possible], probs[possible])
+
+    @classmethod
+    def constant(cls, value):
+        return cls([value], [1.0])
+
+    @classmethod
+    def dense(cls, offset, probs):
+        """*probs[i]* is the chance of rolling *offset* + i."""
+        return cls.of(np.arange(len(probs)) + offset, probs)
+
+    def whole(self):
+        return bool(np.all(self.values == np.round(self.values)))
+
+    def span(self):
+        return int(self.values[-1] - self.values[0]) + 1
+
+    def to_dense(self):
+        offset = int(self.values[0])
+        probs = np.zeros(self.span())
+        probs[(self.values - offset).astype(np.int64)] = self.probs
+        return offset, probs
+
+    def combine(self, other, op, max_outcomes):
+        """The distribution of *self* *op* *other*, for independent rolls."""
+        if op in ('+', '-') and self.whole() and other.whole() and self.span() + other.span() <= max_outcomes:
+            right = other if op == '+' else other.negated()
+            (left_offset, left), (right_offset, right) = self.to_dense(), right.to_dense()
+            return Distribution.dense(left_offset + right_offset, convolve(left, right))
+        if len(self.values) * len(other.values) > max_outcomes:
+            raise UnsupportedRoll("too many possible outcomes")
+        if op in ('/', '//', '%') and not np.all(other.values):
+            raise UnsupportedRoll("Cannot divide by zero.")
+        values = BINARY_OPS[op](self.values[:, None], other.values[None, :]).astype(np.float64)
+        return Distribution.of(values, self.probs[:, None] * other.probs[None, :])
+
+    def negated(self):
+        return Distribution(-self.values[::-1], self.probs[::-1])
+
+    def truncated(self):
+        return Distribution.of(np.trunc(self.values), self.probs)
+
+    def mean(self):
+        return float(np.dot(self.values, self.probs))
+
+    def stddev(self):
+        return float(np.sqrt(max(np.dot((self.values - self.mean()) ** 2, self.probs), 0)))
+
+    def at_least(self, dc):
+        return float(self.probs[self.values >= dc].sum())
+
+    def percentile(self, p):
+        index = np.searchsorted(np.cumsum(self.probs), p / 100 - 1e-12)
+        return float(self.values[min(index, len(self.values) - 1)])
+
+    def summary(self, dc=None, bins=12):
+        """The same shape of dict as *summarize*, but exact."""
+        stats = {
+            'mean': self.mean(),
+            'stddev': self.stddev(),
+            'min': float(self.values[0]),
+            'max': float(self.values[-1]),
+            'percentiles': {p: self.percentile(p) for p in PERCENTILES},
+            'histogram': histogram(self.values, self.probs / self.probs.sum(), bins),
+        }
+        if dc is not None:
+            stats['success_rate'] = self.at_least(dc)
+        return stats
+
+
+class OddsCalculator(object):
+    """
+    Works out the exact distribution of a parsed d20 expression.  Dice sums are convolutions, keep/drop highest and
+    lowest come from the order statistics of the dice, and everything else combines independent sub-distributions.
+    Sub-expressions are memoized by their text, so 2d20kh1 + 5 and 2d20kh1 + 7 share the work for 2d20kh1.
+    """
+
+    MAX_CACHED = 512
+    MAX_OUTCOMES = 1_000_000
+    MAX_KEEP_DICE = 50
+
+    def __init__(self):
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._nodes = {
+            diceast.Expression: self._eval_expression,
+            diceast.AnnotatedNumber: self._eval_annotatednumber,
+            diceast.Literal: self._eval_literal,
+            diceast.Parenthetical: self._eval_parenthetical,
+            diceast.UnOp: self._eval_unop,
+            diceast.BinOp: self._eval_binop,
+            diceast.OperatedSet: self._eval_operatedset,
+            diceast.OperatedDice: self._eval_operatedset,
+            diceast.NumberSet: self._eval_numberset,
+            diceast.Dice: self._eval_dice,
+        }
+
+    def distribution(self, expr: diceast.Node, advantage=d20.AdvType.NONE):
+        """Returns the Distribution of *expr*'s total.  Raises UnsupportedRoll if it can't be worked out exactly."""
+        if advantage != d20.AdvType.NONE:
+            expr = d20.utils.ast_adv_copy(expr, advantage)
+        with self._lock:
+            # like RollResult.total, only the final result is truncated to a whole number
+            return self._eval(expr).truncated()
+
+    def _eval(self, node):
+        if isinstance(node, diceast.Expression):
+            # the comment doesn't change the odds
+            return self._eval_expression(node)
+        key = (type(node).__name__, str(node))
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        handler = self._nodes.get(type(node))
+        if handler is None:
+            raise UnsupportedRoll(f"can't work out the odds of {type(node).__name__}")
+        result = handler(node)
+        self._cache[key] = result
+        while len(self._cache) > self.MAX_CACHED:
+            self._cache.popitem(last=False)
+        return result
+
+    def _eval_expression(self, node):
+        return self._eval(node.roll)
+
+    def _eval_annotatednumber(self, node):
+        return self._eval(node.value)
+
+    def _eval_literal(self, node):
+        return Distribution.constant(node.value)
+
+    def _eval_parenthetical(self, node):
+        return self._eval(node.value)
+
+    def _eval_unop(self, node):
+        value = self._eval(node.value)
+        return value.negated() if node.op == '-' else value
+
+    def _eval_binop(self, node):
+        return self._eval(node.left).combine(self._eval(node.right), node.op, self.MAX_OUTCOMES)
+
+    def _eval_numberset(self, node):
+        total = Distribution.constant(0)
+        for value in node.values:
+            total = total.combine(self._eval(value), '+', self.MAX_OUTCOMES)
+        return total
+
+    def _eval_dice(self, node):
+        return self._sum_dice(node.num, self._face(node.size))
+
+    def _eval_operatedset(self, node):
+        if not isinstance(node.value, diceast.Dice):
+            raise UnsupportedRoll("can't work out the odds of keeping or dropping from a set")
+        num, face = node.value.num, self._face(node.value.size)
+        operations = list(node.operations)
+        # minimums, maximums and rerolls before any keep or drop change each die on its own
+        while operations and operations[0].op in ('mi', 'ma', 'ro', 'rr'):
+            face = self._per_die(operations.pop(0), face)
+        if not operations:
+            return self._sum_dice(num, face)
+        if len(operations) > 1 or operations[0].op not in ('k', 'p'):
+            raise UnsupportedRoll(f"can't work out the odds of {node}")
+        op = operations[0]
+        if all(sel.cat in (None, '<', '>') for sel in op.sels):
+            # keeping or dropping by value also looks at each die on its own; a dropped die counts as 0
+            selected = self._matches(op.sels, face.values)
+            kept = selected if op.op == 'k' else ~selected
+            return self._sum_dice(num, Distribution.of(np.where(kept, face.values, 0), face.probs))
+        if len(op.sels) != 1:
+            raise UnsupportedRoll(f"can't work out the odds of {node}")
+        keep, highest = min(op.sels[0].num, num), op.sels[0].cat == 'h'
+        if op.op == 'p':
+            # dropping the highest few is keeping the lowest rest
+            keep, highest = num - keep, not highest
+        return self._keep(num, keep, face, highest)
+
+    @staticmethod
+    def _face(size):
+        if size == '%':
+            return Distribution(np.arange(0, 100, 10), np.full(10, 0.1))
+        if size < 1:
+            raise UnsupportedRoll("Cannot roll a 0-sided die.")
+        return Distribution(np.arange(1, size + 1), np.full(size, 1 / size))
+
+    @staticmethod
+    def _matches(sels, values):
+        selected = np.zeros(len(values), dtype=bool)
+        for sel in sels:
+            if sel.cat is None:
+                selected |= values == sel.num
+            elif sel.cat == '<':
+                selected |= values < sel.num
+            elif sel.cat == '>':
+                selected |= values > sel.num
+            else:
+                raise UnsupportedRoll(f"can't work out the odds of {sel} here")
+        return selected
+
+    def _per_die(self, op, face):
+        if op.op in ('mi', 'ma'):
+            selector = op.sels[-1]
+            if selector.cat is not None:
+                raise UnsupportedRoll(f"{selector} is not a valid selector for {op.op}.")
+            clamp = np.maximum if op.op == 'mi' else np.minimum
+            return Distribution.of(clamp(face.values, selector.num), face.probs)
+        selected = self._matches(op.sels, face.values)
+        if op.op == 'ro':
+            # a selected face is rolled again, once
+            return Distribution(face.values, np.where(selected, 0, face.probs) + face.probs[selected].sum() * face.probs)
+        if selected.all():
+            raise UnsupportedRoll("rerolls never settle")
+        # rerolling until nothing matches leaves the other faces, rescaled
+        probs = np.where(selected, 0, face.probs)
+        return Distribution.of(face.values, probs / probs.sum())
+
+    def _sum_dice(self, num, face):
+        if num == 0:
+            return Distribution.constant(0)
+        if num * face.span() > self.MAX_OUTCOMES:
+            raise UnsupportedRoll("too many possible outcomes")
+        # exponentiation by squaring: log2(num) convolutions instead of num
+        total, power = None, face
+        while num:
+            if num & 1:
+                total = power if total is None else total.combine(power, '+', self.MAX_OUTCOMES)
+            num >>= 1
+            if num:
+                power = power.combine(power, '+', self.MAX_OUTCOMES)
+        return total
+
+    def _keep(self, num, keep, face, highest):
+        """The total of the *keep* highest (or lowest) of *num* dice, each rolled from *face*."""
+        if keep <= 0:
+            return Distribution.constant(0)
+        if keep >= num:
+            return self._sum_dice(num, face)
+        if num > self.MAX_KEEP_DICE or not face.whole() or face.values[0] < 0:
+            raise UnsupportedRoll(f"can't work out the odds of keeping from {num} dice")
+        faces = face.values.astype(np.int64)
+        probs = face.probs
+        if highest:
+            faces, probs = faces[::-1], probs[::-1]
+        length = keep * int(faces.max()) + 1
+        # states[m][s]: the chance that the m dice showing the best faces so far have kept a total of s.  Faces go
+        # best first, so the first *keep* dice placed are exactly the ones kept.
+        states = [np.zeros(length) for _ in range(num + 1)]
+        states[0][0] = 1.0
+        for value, prob in zip(faces, probs):
+            placed = [np.zeros(length) for _ in range(num + 1)]
+            for m, state in enumerate(states):
+                if not state.any():
+                    continue
+                weight = 1.0
+                for count in range(num - m + 1):
+                    if count:
+                        # C(num - m, count) * prob ** count, built up as we go
+                        weight *= prob * (num - m - count + 1) / count
+                    if weight == 0:
+                        break
+                    shift = value * max(0, min(count, keep - m))
+                    placed[m + count][shift:] += weight * state[:length - shift]
+            states = placed
+        return Distribution.dense(0, states[num])
+
+
+def test_odds_means():
+    calculator = OddsCalculator()
+    # exact means: 4d6kh3 is 15869/1296, and keeping the best of 2d20 is the same roll as 1d20 at advantage
+    for expr, advantage, mean in (("4d6kh3", d20.AdvType.NONE, 15869 / 1296),
+                                  ("2d20kh1", d20.AdvType.NONE, 13.825),
+                                  ("1d20", d20.AdvType.ADV, 13.825),
+                                  ("1d20", d20.AdvType.DIS, 7.175),
+                                  ("2d6+3", d20.AdvType.NONE, 10.0)):
+        assert abs(calculator.distribution(d20.parse(expr), advantage).mean() - mean) < 1e-9, expr
+    assert abs(calculator.distribution(d20.parse("1d20+5")).at_least(15) - 0.55) < 1e-9
+
+
+if __name__ == "__main__":
+    test_odds_means()
@@ -1,4 +1,12 @@
+import time
+# taken before the heavy imports below, so they show up in the startup report
+started = time.perf_counter()
+
+import asyncio
+import datetime
 import os
+import sys
+import threading
 
 import nextcord
 from xcard_cog import XCardHandler
@@ -6,63 +14,282 @@ from music_cog import Music
 from dice_cog import Dice
 from dotenv import load_dotenv
 from utils import send, get_version, safe_send, get_register_guilds
-import time
-import traceback
+from playlist import default_store, playlist_writer
+from commandsync import CommandSync
+from logs import configure_logging, get_logger
+from diagnostics import LoopMonitor, SamplingProfiler, format_profile
+import metrics
+
+log = get_logger(__name__)
+
+COMMAND_SECONDS = metrics.Histogram('toby_command_seconds', "Time to handle a slash command", ['command'])
+COMMAND_ERRORS = metrics.Counter('toby_command_errors_total', "Slash commands that raised", ['command'])
+VOICE_CONNECTIONS = metrics.Gauge('toby_voice_connections', "Voice channels the bot is connected to")
+
+
+class StartupReport(object):
+    """Times each phase of startup, and logs the breakdown once the gateway is ready."""
+
+    def __init__(self, started):
+        self.started = started
+        self.last = started
+        self.phases = []
+        self.reported = False
 
+    def mark(self, phase):
+        if self.reported:
+            # reconnects go through on_connect again; they aren't startup
+            return
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
 
-class TobyTrack(nextcord.ext.commands.Bot):
+    def report(self):
+        if self.reported:
+            return
+        self.reported = True
+        log.info("startup", seconds=f"{self.last - self.started:.2f}", **{phase.replace(' ', '_'): f"{seconds:.2f}" for phase, seconds in self.phases})
+
+
+startup_report = StartupReport(started)
+startup_report.mark("imports")
+
+
+class TobyTrack(nextcord.ext.commands.AutoShardedBot):
+    """
+    The bot.  It runs every shard Discord recommends by default; given *shard_ids* and *shard_count* it runs just those
+    shards, so that several processes can split the guilds between them (see supervisor.py).
+    """
 
     prefix_map = {}
     default_prefix = '+'
 
-    def __init__(self):
+    CLEANUP_SCAN_DEPTH = 200
+    CLEANUP_MAX_SCAN_DEPTH = 5000
+    CLEANUP_PROGRESS_INTERVAL = 1.0
+    # Discord won't bulk delete more than 100 messages at once, or anything older than 14 days
+    BULK_DELETE_MAX = 100
+    BULK_DELETE_WINDOW = datetime.timedelta(days=14, minutes=-5)
+
+    def __init__(self, shard_ids=None, shard_count=None):
         intents = nextcord.Intents.default()
         intents.message_content = True
-        super().__init__(intents=intents, case_insensitive=True)
+        super().__init__(intents=intents, case_insensitive=True, shard_ids=shard_ids, shard_count=shard_count)
         self.add_cog(Music(self))
         self.add_cog(XCardHandler(self))
         self.add_cog(Dice(self))
         self.add_general_commands()
+        self.command_sync = CommandSync(self)
+        self.metrics_server = metrics.MetricsServer()
+        self.loop_monitor = LoopMonitor()
+        self.profiler = SamplingProfiler()
+        self._warmed_up = False
+        VOICE_CONNECTIONS.set_function(lambda: len(self.voice_clients))
+        self.application_command_before_invoke(self._before_command)
+        self.application_command_after_invoke(self._after_command)
+        startup_report.mark("cog registration")
+
+    async def start(self, *args, **kwargs):
+        await self.metrics_server.start()
+        self.loop_monitor.start()
+        await super().start(*args, **kwargs)
+
+    async def on_connect(self):
+        startup_report.mark("login and gateway connect")
+        self.add_all_application_commands()
+        # global commands are the same for every process, so only the one running shard 0 syncs them
+        if self.shard_ids is None or 0 in self.shard_ids:
+            await self.command_sync.sync(None)
+            startup_report.mark("global command sync")
+
+    async def on_guild_available(self, guild):
+        # guilds arrive in a burst on connect; each event is its own task, and CommandSync bounds how many sync at once
+        await self.command_sync.sync(guild.id)
 
     async def on_ready(self):
-        print(f'Logged on as {self.user}!')
+        log.info("ready", user=self.user, guilds=len(self.guilds))
+        startup_report.mark("guilds and gateway ready")
+        startup_report.report()
+        log.info("command_sync", **self.command_sync.stats())
+        if not self._warmed_up and os.getenv('TOBY_WARM_UP', '1').lower() in ('1', 'true', 'yes'):
+            self._warmed_up = True
+            asyncio.ensure_future(self._warm_up())
+
+    async def _warm_up(self):
+        """Loads what startup put off (yt-dlp, d20, numpy, a YoutubeDL), so the first /play or /roll doesn't pay for it."""
+        began = time.perf_counter()
+        for cog in list(self.cogs.values()):
+            warm_up = getattr(cog, 'warm_up', None)
+            if warm_up is None:
+                continue
+            try:
+                await warm_up()
+            except Exception as e:
+                log.warning("warm_up_failed", cog=cog.qualified_name, error=e)
+            # let anything that came in meanwhile have the loop
+            await asyncio.sleep(0)
+        log.info("warmed_up", seconds=f"{time.perf_counter() - began:.2f}")
+
+    @staticmethod
+    async def _before_command(interaction: nextcord.Interaction):
+        interaction.attached.started = time.perf_counter()
+
+    @staticmethod
+    async def _after_command(interaction: nextcord.Interaction):
+        # called whether or not the command raised
+        COMMAND_SECONDS.observe(time.perf_counter() - interaction.attached.started, command=interaction.application_command.qualified_name)
+
+    async def on_application_command_error(self, interaction: nextcord.Interaction, exception):
+        command = interaction.application_command.qualified_name if interaction.application_command else 'unknown'
+        COMMAND_ERRORS.inc(command=command)
+        await super().on_application_command_error(interaction, exception)
+
+    async def close(self):
+        await playlist_writer.close()
+        await default_store().flush(None)
+        await self.metrics_server.close()
+        self.loop_monitor.stop()
+        await super().close()
 
     def add_general_commands(self):
         @self.slash_command(guild_ids=get_register_guilds())
-        async def cleanup(interaction: nextcord.Interaction):
-            """Clean up commands sent by Toby, as well as any commands sent by players to Toby"""
-            await safe_send(interaction, "Cleaning up old messages...")
-            async for message in interaction.channel.history(limit=200):
-                if message.author == self.user:
-                    try:
-                        await message.delete()
-                    except nextcord.HTTPException:
-                        pass
+        async def cleanup(interaction: nextcord.Interaction, depth: int = None):
+            """(opt: how far back to look, default 200) Clean up messages from Toby, and messages mentioning or replying to Toby"""
+            depth = min(depth or int(os.getenv('TOBY_CLEANUP_SCAN_DEPTH', self.CLEANUP_SCAN_DEPTH)), self.CLEANUP_MAX_SCAN_DEPTH)
+            await interaction.response.send_message(f"Cleaning up old messages, looking back {depth}...", ephemeral=True)
+            deleted, scanned = await self._cleanup(interaction.channel, depth, interaction)
+            await interaction.edit_original_message(content=f"Cleaned up {deleted} messages out of the last {scanned}.")
 
         @self.slash_command(guild_ids=get_register_guilds())
         async def version(interaction: nextcord.Interaction):
             """Get Toby's build version."""
             await safe_send(interaction, f"Version: {get_version()}")
 
+        @self.slash_command(guild_ids=get_register_guilds())
+        async def profile(interaction: nextcord.Interaction, seconds: int = 10, all_threads: bool = False):
+            """(owner only) Sample what the bot is busy doing for a few seconds, and show the top call paths"""
+            if not await self.is_owner(interaction.user):
+                await safe_send(interaction, "Only Toby's owner can do that.", ephemeral=True)
+                return
+            if self.profiler.busy():
+                await safe_send(interaction, "Already profiling, try again in a minute.", ephemeral=True)
+                return
+            seconds = max(1, min(seconds, self.profiler.MAX_SECONDS))
+            await interaction.response.defer(ephemeral=True)
+            # the sampler runs on its own thread, so the loop it's watching carries on as normal
+            thread_ids = None if all_threads else {threading.get_ident()}
+            samples, paths = await asyncio.get_running_loop().run_in_executor(None, self.profiler.profile, seconds, thread_ids)
+            lag = self.loop_monitor.stats()
+            header = f"Profiled {seconds}s of {'every thread' if all_threads else 'the event loop'}.  Worst loop lag so far {lag['max_lag_ms']}ms, {lag['stalls']} stalls."
+            await safe_send(interaction, f"{header}\n{format_profile(samples, paths)}", ephemeral=True)
+
         @self.event
         async def on_command_error(ctx, error):
             if isinstance(error, nextcord.ext.commands.CommandNotFound):
                 await send(ctx, "I don't know that command, sorry :(")
             raise error
 
+    async def _cleanup(self, channel, depth, interaction):
+        """
+        Deletes the eligible messages among the last *depth* in *channel*, in bulk where Discord allows it, reporting
+        progress on *interaction*.  Returns (deleted, scanned).
+        """
+        cutoff = nextcord.utils.utcnow() - self.BULK_DELETE_WINDOW
+        # bulk delete needs manage messages (even for our own), and so does deleting anyone else's message; without it
+        # we only delete our own, one by one, rather than spend the rate limit on requests that are sure to be refused
+        can_bulk = hasattr(channel, 'delete_messages')
+        batch, old = [], []
+        deleted = scanned = 0
+        last_progress = time.monotonic()
+        async for message in channel.history(limit=depth):
+            scanned += 1
+            if not self._cleanup_eligible(message) or (not can_bulk and message.author != self.user):
+                continue
+            if can_bulk and message.created_at > cutoff:
+                batch.append(message)
+            else:
+                old.append(message)
+            if len(batch) == self.BULK_DELETE_MAX:
+                count, can_bulk = await self._bulk_delete(channel, batch)
+                deleted += count
+                batch = []
+            if time.monotonic() - last_progress >= self.CLEANUP_PROGRESS_INTERVAL:
+                await interaction.edit_original_message(content=f"Cleaning up... deleted {deleted} so far, looked at {scanned} of {depth}.")
+                last_progress = time.monotonic()
+        if batch:
+            count, can_bulk = await self._bulk_delete(channel, batch)
+            deleted += count
+        for index, message in enumerate(old):
+            if message.author == self.user:
+                deleted += await self._delete_one(message)
+            elif can_bulk:
+                try:
+                    await message.delete()
+                    deleted += 1
+                except nextcord.Forbidden:
+                    log.warning("delete_forbidden", channel=channel.id)
+                    can_bulk = False
+                except nextcord.HTTPException:
+                    pass
+            if time.monotonic() - last_progress >= self.CLEANUP_PROGRESS_INTERVAL:
+                await interaction.edit_original_message(content=f"Cleaning up... deleted {deleted}, {len(old) - index - 1} older messages left to go one by one.")
+                last_progress = time.monotonic()
+        return deleted, scanned
+
+    def _cleanup_eligible(self, message):
+        """Our own messages, and messages that mention us or reply to us."""
+        if message.author == self.user or self.user in message.mentions:
+            return True
+        reference = message.reference
+        return reference is not None and isinstance(reference.resolved, nextcord.Message) and reference.resolved.author == self.user
+
+    async def _bulk_delete(self, channel, messages):
+        """Returns how many of *messages* were deleted, and whether we still look able to delete others' messages."""
+        try:
+            await channel.delete_messages(messages)
+            return len(messages), True
+        except nextcord.Forbidden:
+            log.warning("bulk_delete_forbidden", channel=channel.id)
+            own = [message for message in messages if message.author == self.user]
+            return sum([await self._delete_one(message) for message in own]), False
+        except nextcord.HTTPException as e:
+            log.warning("bulk_delete_failed", channel=channel.id, error=e)
+            return sum([await self._delete_one(message) for message in messages]), True
+
+    @staticmethod
+    async def _delete_one(message):
+        try:
+            await message.delete()
+            return 1
+        except nextcord.HTTPException:
+            return 0
+
+
+def shard_options():
+    """shard_ids and shard_count from TOBY_SHARD_IDS ("0,2") and TOBY_SHARD_COUNT, None where they aren't set."""
+    shard_ids = os.getenv('TOBY_SHARD_IDS')
+    shard_count = os.getenv('TOBY_SHARD_COUNT')
+    return {
+        'shard_ids': [int(shard_id) for shard_id in shard_ids.split(",")] if shard_ids else None,
+        'shard_count': int(shard_count) if shard_count else None,
+    }
+
 
 def main():
     """run the toby tracker.  This Method blocks"""
-    print(f'running code built on {get_version()}')
+    load_dotenv()
+    configure_logging()
+    options = shard_options()
+    log.info("starting", version=get_version().strip(), **{key: value for key, value in options.items() if value is not None})
     try:
-        load_dotenv()
-        client = TobyTrack()
+        client = TobyTrack(**options)
         TOKEN = os.getenv('DISCORD_TOKEN')
         client.run(TOKEN)
     except Exception as e:
-        print("There was an exception starting Toby.")
-        print(e)
-        traceback.print_exc()
+        log.exception("start_failed", error=e)
+        if os.getenv('TOBY_WORKER') is not None:
+            # the supervisor restarts us, backing off
+            sys.exit(1)
         while True:
             time.sleep(10)
 
@@ -0,0 +1,104 @@
+import datetime
+import json
+import logging
+import os
+import sys
+
+
+class StructuredLogger(object):
+    """
+    Logs an event name plus key=value fields, rather than a sentence, so the output can be grepped and parsed:
+    log.info("track_over", guild=guild_id, error=error)
+    """
+
+    def __init__(self, name):
+        self._logger = logging.getLogger(name)
+
+    def debug(self, event, **fields):
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self._log(logging.INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event, **fields):
+        self._log(logging.ERROR, event, fields)
+
+    def exception(self, event, **fields):
+        """Logs at error level, with the traceback of the exception being handled."""
+        self._log(logging.ERROR, event, fields, exc_info=True)
+
+    def _log(self, level, event, fields, exc_info=False):
+        if self._logger.isEnabledFor(level):
+            self._logger.log(level, event, extra={'fields': fields}, exc_info=exc_info)
+
+
+def _quote(value):
+    text = str(value)
+    if not text or any(c.isspace() or c in '"=' for c in text):
+        return json.dumps(text)
+    return text
+
+
+class KeyValueFormatter(logging.Formatter):
+    """time level logger event key=value ..., one line per record.  Tracebacks and other multi-line fields follow it."""
+
+    def format(self, record):
+        fields = getattr(record, 'fields', {})
+        blocks = {key: value for key, value in fields.items() if isinstance(value, str) and "\n" in value}
+        line = " ".join([self.formatTime(record), record.levelname.lower(), record.name, record.getMessage()]
+                        + [f"{key}={_quote(value)}" for key, value in fields.items() if key not in blocks])
+        for key, value in blocks.items():
+            line = f"{line}\n{key}:\n{value.rstrip()}"
+        if record.exc_info:
+            line = f"{line}\n{self.formatException(record.exc_info)}"
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for shipping to a log store."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'event': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['traceback'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class WorkerFilter(logging.Filter):
+    """Adds worker=N to every record, so the interleaved output of the supervisor's workers can be told apart."""
+
+    def __init__(self, worker):
+        super().__init__()
+        self.worker = worker
+
+    def filter(self, record):
+        record.fields = {'worker': self.worker, **getattr(record, 'fields', {})}
+        return True
+
+
+def configure_logging(level=None, fmt=None):
+    """Sends every log record to stdout, as key=value lines or (TOBY_LOG_FORMAT=json) JSON."""
+    level = (level or os.getenv('TOBY_LOG_LEVEL', 'INFO')).upper()
+    fmt = fmt or os.getenv('TOBY_LOG_FORMAT', 'text')
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if fmt == 'json' else KeyValueFormatter())
+    if os.getenv('TOBY_WORKER') is not None:
+        handler.addFilter(WorkerFilter(os.getenv('TOBY_WORKER')))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    # nextcord logs every gateway event at debug; that's only wanted when debugging nextcord itself
+    logging.getLogger('nextcord').setLevel(max(root.level, logging.INFO))
+
+
+def get_logger(name):
+    return StructuredLogger(name)
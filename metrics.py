@@ -0,0 +1,242 @@
+import math
+import os
+import threading
+import time
+from aiohttp import web
+from logs import get_logger
+
+log = get_logger(__name__)
+
+
+class Registry(object):
+    """Every metric the bot keeps, rendered together in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"duplicate metric {metric.name}")
+            self._metrics[metric.name] = metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric(object):
+    """
+    A named family of values, one per combination of label values.  Labels are passed as keyword arguments, e.g.
+    EXTRACTION_SECONDS.observe(elapsed, kind='stream').  Safe to update from any thread.
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labels=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes labels {self.labels}, not {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in sorted(values)]
+
+
+class Counter(_Metric):
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that goes up and down.  Given a *function*, the gauge is whatever that returns when scraped."""
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), registry=REGISTRY, function=None):
+        super().__init__(name, documentation, labels, registry)
+        self._function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        """Makes the (unlabelled) gauge report function() when scraped."""
+        self._function = function
+
+    def value(self, **labels):
+        if self._function is not None:
+            return self._function()
+        return super().value(**labels)
+
+    def samples(self):
+        if self._function is None:
+            return super().samples()
+        try:
+            value = self._function()
+        except Exception as e:
+            log.warning("gauge_failed", metric=self.name, error=e)
+            return []
+        return [f"{self.name} {_format_value(value)}"]
+
+
+class Histogram(_Metric):
+    """Observations counted into cumulative buckets, plus their count and sum, as Prometheus expects."""
+
+    type = 'histogram'
+    # seconds; from a cache hit up to a slow extraction
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, name, documentation, labels=(), registry=REGISTRY, buckets=None):
+        super().__init__(name, documentation, labels, registry)
+        self.buckets = tuple(sorted(buckets or self.BUCKETS)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0.0)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def time(self, **labels):
+        """A context manager that observes how long its block took."""
+        return _Timer(self, labels)
+
+    def count(self, **labels):
+        counts, _ = self._values.get(self._key(labels)) or ([0], 0.0)
+        return sum(counts)
+
+    def value(self, **labels):
+        """The sum of every observation."""
+        _, total = self._values.get(self._key(labels)) or ([], 0.0)
+        return total
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        lines = []
+        for key, counts, total in sorted(values):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', _format_value(float(bound)))])} {cumulative}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+        return lines
+
+
+class _Timer(object):
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class MetricsServer(object):
+    """
+    Serves the registry at http://HOST:PORT/metrics for Prometheus to scrape.  Bound to localhost by default; set
+    TOBY_METRICS_HOST to expose it further, or TOBY_METRICS=0 to not serve it at all.
+    """
+
+    HOST = '127.0.0.1'
+    PORT = 9108
+
+    def __init__(self, registry=REGISTRY, host=None, port=None):
+        self.registry = registry
+        self.host = host or os.getenv('TOBY_METRICS_HOST', self.HOST)
+        self.port = int(port if port is not None else os.getenv('TOBY_METRICS_PORT', self.PORT))
+        self.enabled = os.getenv('TOBY_METRICS', '1').lower() in ('1', 'true', 'yes')
+        self._runner = None
+
+    async def start(self):
+        if not self.enabled or self._runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        try:
+            await web.TCPSite(self._runner, self.host, self.port).start()
+        except OSError as e:
+            # metrics are nice to have; a port clash shouldn't keep the bot from starting
+            log.error("metrics_server_failed", host=self.host, port=self.port, error=e)
+            await self.close()
+            return
+        log.info("metrics_server_started", url=f"http://{self.host}:{self.port}/metrics")
+
+    async def close(self):
+        runner, self._runner = self._runner, None
+        if runner is not None:
+            await runner.cleanup()
+
+    async def _handle(self, request):
+        return web.Response(text=self.registry.render(), content_type='text/plain', charset='utf-8')
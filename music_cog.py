@@ -1,17 +1,33 @@
 import asyncio
+import os
+import time
 import nextcord
 from nextcord.ext import commands
-from ytwrapper import YTDLException, YTDLSource
+from logs import get_logger
+from ytwrapper import YTDLException, YTDLSource, extraction_scheduler, metadata_cache
 from utils import safe_send, get_register_guilds
+from player import GuildPlayer
 
 import playlist
 
+log = get_logger(__name__)
+
 
 class Music(commands.Cog):
+
+    SONG_LOOKUP_CONCURRENCY = 8
+    SONG_LOOKUP_TIMEOUT = 15
+    SONG_PAGE_SIZE = 1900
+    # songs read from the playlist store at a time
+    SONG_FETCH_SIZE = 50
+    SONG_PROGRESS_INTERVAL = 1.0
+
     def __init__(self, bot):
         self.bot = bot
-        self.server_playlists = {}
-        self._now_playing = None
+        self.guild_playlists = playlist.PlaylistRegistry()
+        self.players = {}
+        self.song_lookup_concurrency = int(os.getenv('TOBY_SONG_LOOKUP_CONCURRENCY', self.SONG_LOOKUP_CONCURRENCY))
+        self.song_lookup_timeout = float(os.getenv('TOBY_SONG_LOOKUP_TIMEOUT', self.SONG_LOOKUP_TIMEOUT))
 
     @nextcord.slash_command(guild_ids=get_register_guilds())
     async def join(self, interaction: nextcord.Interaction):
@@ -25,8 +41,7 @@ class Music(commands.Cog):
                 await channel.connect()
                 await safe_send(interaction, "Joined! :musical_note::notes:")
             except Exception as e:
-                print(f"error connecting to channel {channel.name}.")
-                print(e)
+                log.error("voice_connect_failed", guild=interaction.guild_id, channel=channel.name, error=e)
                 await safe_send(interaction, "Had a problem joining voice.  Please check out the logs :sob:")
                 try:
                     await interaction.guild.voice_client.disconnect()
@@ -39,29 +54,17 @@ class Music(commands.Cog):
     @nextcord.slash_command(guild_ids=get_register_guilds())
     async def leave(self, interaction: nextcord.Interaction):
         """Stops and disconnects the bot from voice"""
-        self._now_playing = None
-        if interaction.guild.voice_client:
-            await interaction.guild.voice_client.disconnect()
-        await safe_send(interaction, ":wave:")
+        await safe_send(interaction, await self._get_player(interaction).submit('leave', channel=interaction.channel))
 
     @nextcord.slash_command(guild_ids=get_register_guilds())
     async def stop(self, interaction: nextcord.Interaction):
         """Stops playing the current playlist or stream without leaving the channel"""
-        self._stop(interaction)
-        await safe_send(interaction, ":stop_button:")
-
-    def _stop(self, interaction: nextcord.Interaction):
-        print("in _stop")
-        self._now_playing = None
-        data = self._get_data(interaction)
-        data.stop()
-        if interaction.guild.voice_client and interaction.guild.voice_client.is_playing():
-            interaction.guild.voice_client.stop()
+        await safe_send(interaction, await self._get_player(interaction).submit('stop', channel=interaction.channel))
 
     @nextcord.slash_command(guild_ids=get_register_guilds())
     async def playlists(self, interaction: nextcord.Interaction):
         """list the existing playlists"""
-        data = self._get_data(interaction)
+        data = await self._get_data(interaction)
         lists = data.list_playlists()
         output = "Here's the playlists that I currently have:\n"
         if lists:
@@ -72,7 +75,7 @@ class Music(commands.Cog):
     @nextcord.slash_command(guild_ids=get_register_guilds())
     async def create_playlist(self, interaction: nextcord.Interaction, name: str):
         """(name): create a new playlist by name"""
-        data = self._get_data(interaction)
+        data = await self._get_data(interaction)
         success = data.add_playlist(name)
         if success:
             await safe_send(interaction, f"Created new playlist with name \"{name}\"", ephemeral=True)
@@ -82,10 +85,9 @@ class Music(commands.Cog):
     @nextcord.slash_command(guild_ids=get_register_guilds())
     async def delete_playlist(self, interaction: nextcord.Interaction, name: str):
         """(name): Delete an existing playlist by name"""
-        data = self._get_data(interaction)
+        data = await self._get_data(interaction)
         if data.current_playlist() == name:
-            # this should finish the current song then stop playing.
-            await self._stop(interaction)
+            await self._get_player(interaction).submit('stop')
         success = data.remove_playlist(name)
         if success:
             await safe_send(interaction, f"Removed the playlist called \"{name}\"", ephemeral=True)
@@ -95,26 +97,53 @@ class Music(commands.Cog):
     @nextcord.slash_command(guild_ids=get_register_guilds())
     async def songs(self, interaction: nextcord.Interaction, name: str, urls: str = None):
         """(playlist name) (opt: print urls?): Get the list of songs in a playlist"""
-        data = self._get_data(interaction)
-        songurls = data.songs_in_list(name)
-        songs = []
-        await interaction.response.defer()
-        await interaction.followup.send(f"Retrieving the song data for {name}...", ephemeral=True)
-        async with interaction.channel.typing():
-            for url in songurls:
-                song_meta = await YTDLSource.meta_from_url(url)
-                if urls:
-                    songs.append(f"\t**{song_meta['title']}**  Uploaded by {song_meta['uploader']} ({url})")
-                else:
-                    songs.append(f"\t**{song_meta['title']}**  Uploaded by {song_meta['uploader']}")
-        songs = '\n'.join(songs)
-        output = f"Here's what's in {name}:\n{songs}"
-        await safe_send(interaction, output, ephemeral=True)
+        data = await self._get_data(interaction)
+        total = data.song_count(name)
+        await interaction.response.defer(ephemeral=True)
+        page = f"Here's what's in {name}:"
+        message = await interaction.followup.send(f"{page}\n*Retrieving the song data for {total} songs...*", ephemeral=True, wait=True)
+        # fetch the list a chunk at a time, look each chunk's songs up concurrently, and post them in playlist order as
+        # soon as each prefix of the chunk is ready
+        limit = asyncio.Semaphore(self.song_lookup_concurrency)
+        posted = 0
+        last_edit = 0
+        for offset in range(0, total, self.SONG_FETCH_SIZE):
+            songurls = await data.songs_in_list(name, offset, self.SONG_FETCH_SIZE)
+            lookups = [self._song_line(interaction.guild_id, index, url, urls, limit) for index, url in enumerate(songurls)]
+            lines = [None] * len(songurls)
+            ready = 0
+            for lookup in asyncio.as_completed(lookups):
+                index, line = await lookup
+                lines[index] = line
+                while ready < len(lines) and lines[ready] is not None:
+                    if len(page) + len(lines[ready]) + 1 > self.SONG_PAGE_SIZE:
+                        # this page is full, finish it and carry on in a new message
+                        await message.edit(content=page)
+                        page = ""
+                        message = await interaction.followup.send(f"*{total - posted} more songs coming...*", ephemeral=True, wait=True)
+                    page = f"{page}\n{lines[ready]}" if page else lines[ready]
+                    ready += 1
+                    posted += 1
+                if posted < total and time.monotonic() - last_edit >= self.SONG_PROGRESS_INTERVAL:
+                    await message.edit(content=f"{page}\n*{total - posted} more songs coming...*")
+                    last_edit = time.monotonic()
+        await message.edit(content=page)
+        log.info("songs_listed", guild=interaction.guild_id, metadata_cache=metadata_cache.stats())
+
+    async def _song_line(self, guild_id, index, url, show_url, limit):
+        async with limit:
+            try:
+                song_meta = await asyncio.wait_for(YTDLSource.meta_from_url(url, guild=guild_id), self.song_lookup_timeout)
+            except (YTDLException, asyncio.TimeoutError):
+                return index, f"\t*Couldn't get the song data for {url}*"
+        if show_url:
+            return index, f"\t**{song_meta.get('title')}**  Uploaded by {song_meta.get('uploader')} ({url})"
+        return index, f"\t**{song_meta.get('title')}**  Uploaded by {song_meta.get('uploader')}"
 
     @nextcord.slash_command(guild_ids=get_register_guilds())
     async def add_song(self, interaction: nextcord.Interaction, playlist_name: str, song_url: str):
         """(playlist) (song url): add a song to a playlist"""
-        data = self._get_data(interaction)
+        data = await self._get_data(interaction)
         if data.add_to_playlist(playlist_name, song_url):
             await safe_send(interaction, ":thumbsup:", ephemeral=True)
         else:
@@ -123,15 +152,16 @@ class Music(commands.Cog):
     @nextcord.slash_command(guild_ids=get_register_guilds())
     async def add_songs_from_playlist(self, interaction: nextcord.Interaction, playlist_name: str, playlist_url: str):
         """(playlist) (playlist url): add a song to a playlist"""
-        data = self._get_data(interaction)
         await interaction.response.defer()
         await interaction.followup.send("One minute while I pull song data from that playlist...", ephemeral=True)
         async with interaction.channel.typing():
             try:
-                playlist_songs = await YTDLSource.playlist_from_url(playlist_url)
+                playlist_songs = await YTDLSource.playlist_from_url(playlist_url, guild=interaction.guild_id)
             except YTDLException:
                 await safe_send(interaction, "There was an error extracting one or more songs from this playlist, sorry.")
                 return
+            # fetched after the extraction, since the guild may have been evicted while we waited for it
+            data = await self._get_data(interaction)
             all_success = True
             for song in playlist_songs:
                 all_success = data.add_to_playlist(playlist_name, song) and all_success
@@ -143,7 +173,7 @@ class Music(commands.Cog):
     @nextcord.slash_command(guild_ids=get_register_guilds())
     async def remove_song(self, interaction: nextcord.Interaction, playlist_name: str, song_url: str):
         """(playlist) (song url): remove a song from a playlist"""
-        data = self._get_data(interaction)
+        data = await self._get_data(interaction)
         if data.remove_from_playlist(playlist_name, song_url):
             await safe_send(interaction, "Song removed!", ephemeral=True)
         else:
@@ -152,84 +182,49 @@ class Music(commands.Cog):
     @nextcord.slash_command(guild_ids=get_register_guilds())
     async def stream(self, interaction: nextcord.Interaction, url: str):
         """(url): Immediately streams from a url, does not modify playlists."""
-        data = self._get_data(interaction)
-        old_stream = data.current_stream()
-        data.stream(url)
-        try:
-            player = await YTDLSource.from_url(url, loop=self.bot.loop, stream=True)
-        except YTDLException:
-            await safe_send(interaction, "There was an error getting data to stream this, sorry.")
-            return
-        interaction.guild.voice_client.play(player, after=lambda e: self._stream_over_callback(error=e, interaction=interaction))
-        if old_stream != url:
-            self._now_playing = f"Now streaming {player.title}"
-            await safe_send(interaction, self._now_playing)
-
-    def _stream_over_callback(self, error=None, interaction: nextcord.Interaction = None):
-        # check if channel empty, and stop/leave if it is
-        print("stream over callback")
-        if error:
-            print(f"Player Error: {error}")
-        else:
-            if interaction.guild.voice_client and (len(interaction.guild.voice_client.channel.voice_states) == 1):
-                asyncio.run_coroutine_threadsafe(self.leave(interaction), loop=self.bot.loop)
-            stream = self._get_data(interaction).current_stream()
-            print(f"currently streaming {stream}")
-            if stream:
-                asyncio.run_coroutine_threadsafe(self.stream(interaction, stream), loop=self.bot.loop)
+        await interaction.response.defer()
+        await safe_send(interaction, await self._get_player(interaction).submit('stream', url, channel=interaction.channel))
 
     @nextcord.slash_command(guild_ids=get_register_guilds())
     async def play(self, interaction: nextcord.Interaction, playlist_name: str):
-        print(f"DEBUG: play called, playlist {playlist_name}, interaction {interaction}")
         """(playlist): Play a playlist.  Loops randomly through songs in the list."""
-        data = self._get_data(interaction)
-        if interaction.guild.voice_client.is_playing():
-            self._stop(interaction)
-        song = data.play(playlist_name)
-        if song:
-            try:
-                player = await YTDLSource.from_url(song, loop=self.bot.loop, stream=True)
-            except YTDLException:
-                await safe_send(interaction, "There was an error getting the song to play.")
-                return
-            interaction.guild.voice_client.play(player, after=lambda e: self._song_over_callback(error=e, interaction=interaction))
-            self._now_playing = f"Now playing {player.title} in playlist {data.current_playlist()}"
-            await safe_send(interaction, self._now_playing)
-        else:
-            self._now_playing = None
-            await safe_send(interaction, "No more songs to play.  Did the playlist get deleted?")
-
-    def _song_over_callback(self, error=None, interaction: nextcord.Interaction = None):
-        if error:
-            print(f"Player Error: {error}")
-        else:
-            if interaction.guild.voice_client and (len(interaction.guild.voice_client.channel.voice_states) == 1):
-                asyncio.run_coroutine_threadsafe(self.leave(interaction), loop=self.bot.loop)
-            pl = self._get_data(interaction).current_playlist()
-            if pl:
-                asyncio.run_coroutine_threadsafe(self.play(interaction, pl), loop=self.bot.loop)
+        log.debug("play", guild=interaction.guild_id, playlist=playlist_name)
+        await interaction.response.defer()
+        await safe_send(interaction, await self._get_player(interaction).submit('play', playlist_name, channel=interaction.channel))
 
     @nextcord.slash_command(guild_ids=get_register_guilds())
     async def nowplaying(self, interaction: nextcord.Interaction):
         """get the currently playing song and playlist"""
-        if self._now_playing:
-            await safe_send(interaction, self._now_playing)
+        now_playing = self._get_player(interaction).now_playing
+        if now_playing:
+            await safe_send(interaction, now_playing)
         else:
             await safe_send(interaction, "Not currently playing!")
 
     @nextcord.slash_command(guild_ids=get_register_guilds())
     async def next(self, interaction: nextcord.Interaction):
         """Go to the next song in the playlist.  If streaming, restarts the song."""
-        print("next called")
-        if interaction.guild.voice_client.is_playing():
-            interaction.guild.voice_client.stop()
-        await safe_send(interaction, ":track_next:", ephemeral=True)
+        log.debug("next", guild=interaction.guild_id)
+        await safe_send(interaction, await self._get_player(interaction).submit('next', channel=interaction.channel), ephemeral=True)
 
-    def _get_data(self, interaction):
+    def _get_player(self, interaction):
         id = interaction.guild_id
-        if id in self.server_playlists:
-            return self.server_playlists[id]
-        else:
-            data = playlist.ServerPlaylist(id)
-            self.server_playlists[id] = data
-            return data
+        if id not in self.players:
+            self.players[id] = GuildPlayer(interaction.guild, self.guild_playlists, on_idle=self._drop_player)
+        return self.players[id]
+
+    def _drop_player(self, player):
+        # idle and out of voice, so there's nothing worth keeping; the guild's next command starts a fresh one
+        if self.players.get(player.guild.id) is player:
+            del self.players[player.guild.id]
+        player.close()
+
+    async def warm_up(self):
+        await extraction_scheduler.warm_up()
+
+    def cog_unload(self):
+        for player in self.players.values():
+            player.close()
+
+    async def _get_data(self, interaction):
+        return await self.guild_playlists.get(interaction.guild_id)
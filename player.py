@@ -0,0 +1,250 @@
+import asyncio
+import enum
+import os
+import time
+import nextcord
+import metrics
+from logs import get_logger
+from ytwrapper import YTDLException, YTDLSource, audio_cache
+from utils import send
+from playlist import PlaylistRegistry
+
+log = get_logger(__name__)
+
+FIRST_AUDIO_SECONDS = metrics.Histogram('toby_first_audio_seconds', "Time from a /play or /stream to its first audio frame", ['command'])
+TRACK_GAP_SECONDS = metrics.Histogram('toby_track_gap_seconds', "Silence between one track ending and the next one's first frame", ['state'])
+
+
+class PlayerState(enum.Enum):
+    IDLE = "idle"
+    PLAYING = "playing"
+    STREAMING = "streaming"
+
+
+class GuildPlayer(object):
+    """
+    Owns playback for a single guild.  Slash commands and the voice client's track-over callbacks both become messages
+    on one queue, and a long-lived task works through them in order, so playback state is only ever touched here.
+    """
+
+    PREFETCH_FFMPEG = False
+
+    def __init__(self, guild: nextcord.Guild, playlists: PlaylistRegistry, on_idle=None):
+        self.guild = guild
+        self.playlists = playlists
+        # called with the player once it's idle, out of voice and has nothing queued, so its owner can drop it
+        self.on_idle = on_idle
+        # only held while we need it, so an idle guild's playlists can be evicted
+        self.data = None
+        self.state = PlayerState.IDLE
+        self.now_playing = None
+        self.channel = None
+        self.prefetch_ffmpeg = os.getenv('TOBY_PREFETCH_FFMPEG', str(self.PREFETCH_FFMPEG)).lower() in ('1', 'true', 'yes')
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        # bumped whenever we stop or replace a track on purpose, so its after= callback can be told apart
+        self._generation = 0
+        self._prefetch = None
+        # (command, when it was queued) for the message being handled, to time how long until we're playing again
+        self._handling = (None, None)
+        self._task = asyncio.ensure_future(self._run())
+
+    async def submit(self, command, *args, channel=None):
+        """
+        Queues *command* (play, stream, next, stop or leave) and waits for the player to get to it.
+        Returns the message the slash command should reply with.
+        """
+        future = self._loop.create_future()
+        self._queue.put_nowait((command, args, channel, future, time.perf_counter()))
+        return await future
+
+    def close(self):
+        self._halt()
+        self._task.cancel()
+
+    async def _run(self):
+        while True:
+            command, args, channel, future, queued = await self._queue.get()
+            if channel is not None:
+                self.channel = channel
+            self._handling = (command, queued)
+            try:
+                # pinned before loading, so another guild's load can't evict ours while the command is mid-await
+                self.playlists.pin(self.guild.id)
+                self.data = await self.playlists.get(self.guild.id)
+                result = await getattr(self, f"_on_{command}")(*args)
+            except Exception as e:
+                log.exception("player_command_failed", guild=self.guild.id, command=command)
+                if future is not None and not future.done():
+                    future.set_exception(e)
+            else:
+                if future is not None and not future.done():
+                    future.set_result(result)
+            finally:
+                self.playlists.pin(self.guild.id, self.state != PlayerState.IDLE)
+                if self.state == PlayerState.IDLE:
+                    self.data = None
+                    if self.on_idle is not None and self.guild.voice_client is None and self._queue.empty():
+                        self.on_idle(self)
+
+    def _track_over(self, generation, error):
+        # called from the voice client's player thread
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, ('track_over', (generation, error), None, None, time.perf_counter()))
+
+    async def _on_play(self, playlist_name):
+        self._halt()
+        song = self.data.play(playlist_name)
+        if not song:
+            return "No more songs to play.  Did the playlist get deleted?"
+        self.state = PlayerState.PLAYING
+        return await self._play_song(song)
+
+    async def _on_stream(self, url):
+        self._halt()
+        self.data.stream(url)
+        self.state = PlayerState.STREAMING
+        return await self._stream(url)
+
+    async def _on_next(self):
+        voice_client = self.guild.voice_client
+        if voice_client and voice_client.is_playing():
+            # the after= callback moves us on, exactly as if the track had ended
+            voice_client.stop()
+        return ":track_next:"
+
+    async def _on_stop(self):
+        self._halt()
+        return ":stop_button:"
+
+    async def _on_leave(self):
+        self._halt()
+        if self.guild.voice_client:
+            await self.guild.voice_client.disconnect()
+        return ":wave:"
+
+    async def _on_track_over(self, generation, error):
+        if generation != self._generation:
+            # a track we stopped or replaced ourselves
+            return
+        if error:
+            log.error("player_error", guild=self.guild.id, error=error)
+            self._halt()
+            return
+        voice_client = self.guild.voice_client
+        if voice_client and len(voice_client.channel.voice_states) == 1:
+            # nobody left to listen
+            await self._on_leave()
+            return
+        if self.state == PlayerState.PLAYING:
+            song = self.data.get_next_song()
+            if song:
+                message = await self._play_song(song)
+            else:
+                self._halt()
+                message = "No more songs to play.  Did the playlist get deleted?"
+            await self._announce(message)
+        elif self.state == PlayerState.STREAMING:
+            log.info("stream_restart", guild=self.guild.id, url=self.data.current_stream())
+            await self._announce(await self._stream(self.data.current_stream()))
+
+    async def _play_song(self, song):
+        try:
+            player = await self._take_prefetch(song)
+            if player is None:
+                player = await YTDLSource.from_url(song, stream=True, guild=self.guild.id)
+        except YTDLException:
+            self._halt()
+            return "There was an error getting the song to play."
+        if not self._start(player):
+            return "I'm not in a voice channel!  Use /join first."
+        self._start_prefetch()
+        await audio_cache.record_play(song, guild=self.guild.id)
+        self.now_playing = f"Now playing {player.title} in playlist {self.data.current_playlist()}"
+        return self.now_playing
+
+    async def _stream(self, url):
+        """Starts streaming *url*.  Returns a message only when that is news: a new stream or an error."""
+        try:
+            player = await YTDLSource.from_url(url, stream=True, guild=self.guild.id)
+        except YTDLException:
+            self._halt()
+            return "There was an error getting data to stream this, sorry."
+        if not self._start(player):
+            return "I'm not in a voice channel!  Use /join first."
+        await audio_cache.record_play(url, guild=self.guild.id)
+        now_playing = f"Now streaming {player.title}"
+        if now_playing != self.now_playing:
+            self.now_playing = now_playing
+            return now_playing
+        return None
+
+    def _start(self, player):
+        voice_client = self.guild.voice_client
+        if voice_client is None:
+            player.cleanup()
+            self._halt()
+            return False
+        self._generation += 1
+        generation = self._generation
+        command, queued = self._handling
+        if command == 'track_over':
+            state = self.state.value
+            player.on_first_frame = lambda: TRACK_GAP_SECONDS.observe(time.perf_counter() - queued, state=state)
+        elif command is not None:
+            player.on_first_frame = lambda: FIRST_AUDIO_SECONDS.observe(time.perf_counter() - queued, command=command)
+        voice_client.play(player, after=lambda e: self._track_over(generation, e))
+        return True
+
+    def _halt(self):
+        self._generation += 1
+        self._discard_prefetch()
+        if self.data is not None:
+            self.data.stop()
+        self.state = PlayerState.IDLE
+        self.now_playing = None
+        voice_client = self.guild.voice_client
+        if voice_client and voice_client.is_playing():
+            voice_client.stop()
+
+    async def _announce(self, message):
+        if message and self.channel is not None:
+            try:
+                await send(self.channel, message)
+            except nextcord.HTTPException as e:
+                log.warning("announce_failed", guild=self.guild.id, channel=self.channel, error=e)
+
+    def _start_prefetch(self):
+        """Resolve the next song of the current playlist while this one is still playing, so the handover is instant."""
+        self._discard_prefetch()
+        song = self.data.peek_next_song()
+        if song:
+            self._prefetch = (song, asyncio.ensure_future(self._resolve_ahead(song)))
+
+    async def _resolve_ahead(self, song):
+        data = await YTDLSource.resolve(song, stream=True, guild=self.guild.id)
+        if self.prefetch_ffmpeg:
+            return YTDLSource.from_data(data)
+        return data
+
+    async def _take_prefetch(self, song):
+        """Returns a player for *song* from the lookahead, or None if the lookahead was for something else."""
+        prefetched, task = self._prefetch or (None, None)
+        if task is None or prefetched != song:
+            self._discard_prefetch()
+            return None
+        self._prefetch = None
+        result = await task
+        if isinstance(result, nextcord.AudioSource):
+            return result
+        return YTDLSource.from_data(result)
+
+    def _discard_prefetch(self):
+        _, task = self._prefetch or (None, None)
+        self._prefetch = None
+        if task is None:
+            return
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled() and task.exception() is None and isinstance(task.result(), nextcord.AudioSource):
+            # kill the FFmpeg process we started early
+            task.result().cleanup()
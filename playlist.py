@@ -1,26 +1,58 @@
+import asyncio
+import atexit
+import concurrent.futures
+import heapq
 import random
 import os
 import json
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+import metrics
+from logs import get_logger
+from videoid import canonical_video_id, video_url
+
+log = get_logger(__name__)
+
+PLAYLIST_SAVE_SECONDS = metrics.Histogram('toby_playlist_save_seconds', "Time to write a guild's playlist changes to disk", ['store'])
+RESIDENT_GUILDS = metrics.Gauge('toby_playlist_resident_guilds', "Guilds whose playlists are held in memory")
+PINNED_GUILDS = metrics.Gauge('toby_playlist_pinned_guilds', "Guilds whose playlists can't be evicted while the player uses them")
+RESIDENT_BYTES = metrics.Gauge('toby_playlist_resident_bytes', "Approximate memory held by the resident playlists")
+PLAYLIST_EVICTIONS = metrics.Counter('toby_playlist_evictions_total', "Guilds whose playlists were dropped from memory")
 
 
 class ServerPlaylist(object):
 
     DATA_FILE_LOCATION = "./playlists/"
-    CURRENT_DATA_VERSION = 0
+    CURRENT_DATA_VERSION = 1
 
-    def __init__(self, guild_id):
+    def __init__(self, guild_id, store=None, load=True):
+        self._store = store or default_store()
         self._currentPlaylist = None
         self._currentSong = None
         self._currentStream = None
+        self._nextSong = None
+        self._bags = {}
         self._playlists = {}
         self.guild_id = guild_id
-        self._load_data()
+        if load:
+            self._load_data()
+
+    @classmethod
+    async def open(cls, guild_id, store=None):
+        """Like the constructor, but reads the stored data on an executor thread instead of blocking the event loop."""
+        playlist = cls(guild_id, store, load=False)
+        imported_data = await asyncio.get_running_loop().run_in_executor(None, playlist._store.load, playlist)
+        playlist._apply_data(imported_data)
+        return playlist
 
     def add_playlist(self, playlist_name):
         lower_name = playlist_name.lower()
         if lower_name not in self._playlists:
-            self._playlists[lower_name] = {'songs': [], 'name': playlist_name}
-            self._save_data()
+            self._playlists[lower_name] = {'songs': {}, 'name': playlist_name}
+            self._store.add_playlist(self, lower_name, playlist_name)
             return True
         else:
             return False
@@ -29,7 +61,8 @@ class ServerPlaylist(object):
         lower_name = playlist_name.lower()
         if lower_name in self._playlists:
             self._playlists.pop(lower_name)
-            self._save_data()
+            self._bags.pop(lower_name, None)
+            self._store.remove_playlist(self, lower_name)
             return True
         else:
             return False
@@ -40,34 +73,46 @@ class ServerPlaylist(object):
             playlists.append(entry['name'])
         return sorted(playlists)
 
-    def songs_in_list(self, playlist_name):
+    def song_count(self, playlist_name):
         lower_name = playlist_name.lower()
         if lower_name in self._playlists:
-            songs = self._playlists[lower_name]['songs']
-            return sorted(songs)
+            return len(self._playlists[lower_name]['songs'])
+        return 0
+
+    async def songs_in_list(self, playlist_name, offset=0, limit=None):
+        """The urls of the songs in a playlist, in a stable order, *limit* at a time starting from *offset*."""
+        lower_name = playlist_name.lower()
+        if lower_name in self._playlists:
+            return [video_url(song) for song in await self._store.songs(self, lower_name, offset, limit)]
         return []
 
     def add_to_playlist(self, playlist_name, song_url):
-        song_url = self._rewrite_url(song_url)
+        song_id = canonical_video_id(song_url)
         lower_name = playlist_name.lower()
         if lower_name in self._playlists:
             songs = self._playlists[lower_name]['songs']
-            songs.append(song_url)
-            songs = list(dict.fromkeys(songs))
-            self._playlists[lower_name]['songs'] = songs
-            self._save_data()
+            if song_id not in songs:
+                songs[song_id] = None
+                if lower_name in self._bags:
+                    # joins the current shuffle cycle
+                    self._bags[lower_name].add(song_id)
+                self._store.add_songs(self, lower_name, [song_id])
             return True
         else:
             return False
 
     def remove_from_playlist(self, playlist_name, song_url):
-        song_url = self._rewrite_url(song_url)
+        song_id = canonical_video_id(song_url)
         lower_name = playlist_name.lower()
         if lower_name in self._playlists:
             songs = self._playlists[lower_name]['songs']
-            if song_url in songs:
-                songs.remove(song_url)
-            self._save_data()
+            if song_id in songs:
+                del songs[song_id]
+                if lower_name in self._bags:
+                    self._bags[lower_name].discard(song_id)
+                self._store.remove_song(self, lower_name, song_id)
+            if song_id == self._nextSong:
+                self._nextSong = None
             return True
         else:
             return False
@@ -81,6 +126,7 @@ class ServerPlaylist(object):
         return self._currentStream
 
     def stream(self, song_url):
+        self._drop_lookahead()
         self._currentStream = song_url
         self._currentPlaylist = None
 
@@ -88,95 +134,574 @@ class ServerPlaylist(object):
         self._currentStream = None
         lower_name = playlist_name.lower()
         if lower_name in self._playlists:
+            if lower_name != self._currentPlaylist:
+                self._drop_lookahead()
             self._currentPlaylist = lower_name
             return self.get_next_song()
         else:
             return None
 
+    def peek_next_song(self):
+        """Picks the song that the next call to get_next_song will return, without moving on to it yet."""
+        if self._nextSong is None:
+            self._nextSong = self._pick_song()
+        return video_url(self._nextSong) if self._nextSong is not None else None
+
     def get_next_song(self):
-        print(f"getting next song in playlist {self._currentPlaylist}.  Currently playing {self._currentSong}")
-        if not self._currentPlaylist:
+        nextsong = self._nextSong
+        self._nextSong = None
+        if nextsong is None or nextsong not in self._current_songs():
+            nextsong = self._pick_song()
+        log.info("next_song", guild=self.guild_id, playlist=self._currentPlaylist, previous=self._currentSong, picked=nextsong)
+        self._currentSong = nextsong
+        return video_url(nextsong) if nextsong is not None else None
+
+    def _current_songs(self):
+        if self._currentPlaylist and self._currentPlaylist in self._playlists:
+            return self._playlists[self._currentPlaylist]['songs']
+        return {}
+
+    def _pick_song(self):
+        if not self._currentPlaylist or self._currentPlaylist not in self._playlists:
             return None
-        if self._currentPlaylist in self._playlists:
-            songs = self._playlists[self._currentPlaylist]['songs']
-            if len(songs) == 0:
-                self._currentSong = None
-                return None
-            elif len(songs) == 1:
-                self._currentSong = songs[0]
-                return songs[0]
-            else:
-                nextsong = random.choice(songs)
-                while nextsong == self._currentSong:
-                    print(f"tried to repick {nextsong}, trying again")
-                    nextsong = random.choice(songs)
-                self._currentSong = nextsong
-                print(f"picked {nextsong}")
-                return nextsong
-        return None
+        bag = self._bags.setdefault(self._currentPlaylist, ShuffleBag())
+        return bag.pick(self._current_songs(), avoid=self._currentSong)
+
+    def _drop_lookahead(self):
+        # a lookahead that will never be played goes back in the bag, so it still gets its turn this cycle
+        if self._nextSong is not None and self._currentPlaylist in self._bags:
+            self._bags[self._currentPlaylist].add(self._nextSong)
+        self._nextSong = None
 
     def stop(self):
+        self._drop_lookahead()
         self._currentPlaylist = None
         self._currentStream = None
 
-    def _rewrite_url(self, song_url: str):
-        song_url = song_url.replace("https://youtube.com/shorts/", "https://www.youtube.com/watch?v=")
-        song_url = song_url.replace("feature=share", "")
-        return song_url
-
     def _load_data(self):
-        print(f"load data from {self._path()}")
-        if os.path.exists(self._path()):
-            with open(self._path()) as f:
-                text = f.read()
-                imported_data = json.loads(text)
-                imported_data = self._upgrade_data(imported_data)
-                self._playlists = imported_data
+        self._apply_data(self._store.load(self))
+
+    def _apply_data(self, imported_data):
+        if imported_data is not None:
+            in_ver = imported_data.get('version', 0)
+            self._playlists = self._upgrade_data(imported_data)
         else:
+            in_ver = None
             self._playlists = {}
+        self._store.loaded(self, in_ver)
 
     def _upgrade_data(self, input):
         in_ver = input.pop('version', 0)
-        print(f"Upgrading data.  Input version {in_ver}, current version {self.CURRENT_DATA_VERSION}")
-        print("cleaning up any duplicate songs...")
+        if in_ver != self.CURRENT_DATA_VERSION:
+            log.info("upgrade_playlists", guild=self.guild_id, version=in_ver, current_version=self.CURRENT_DATA_VERSION)
+        if in_ver == 0:
+            in_ver = 1
+            # version 1: songs are stored as canonical video ids
+            for maybe_pl in input.keys():
+                if 'songs' in input[maybe_pl]:
+                    input[maybe_pl]['songs'] = [canonical_video_id(song) for song in input[maybe_pl]['songs']]
+        # clean up any duplicate songs
         for maybe_pl in input.keys():
             if 'songs' in input[maybe_pl]:
-                input[maybe_pl]['songs'] = list(dict.fromkeys(input[maybe_pl]['songs']))
-        if in_ver == self.CURRENT_DATA_VERSION:
-            print("No upgrade needed!")
-            return input
-        print("Iteratively upgrading...")
-        print("no-op yet!")
+                # an insertion-ordered set: O(1) add, remove and membership
+                input[maybe_pl]['songs'] = dict.fromkeys(input[maybe_pl]['songs'])
         return input
-        """
-        if in_ver==0:
-            in_ver=1
-            print("Upgrade to version 1 - new feature")
-        """
 
-    def _save_data(self):
-        self._playlists['version'] = self.CURRENT_DATA_VERSION
-        exported_data = json.dumps(self._playlists)
-        self._playlists.pop('version')
-        print(exported_data)
-        print(f"save data to {self._path()}")
-        outputfile = self._path()
-        tmpfile = f"{outputfile}.tmp"
-        bakfile = f"{outputfile}.bak"
-        with open(tmpfile, "w") as f:
-            f.write(exported_data)
-        if os.path.exists(outputfile):
-            os.rename(outputfile, bakfile)
-        os.rename(tmpfile, outputfile)
-        os.remove(bakfile)
+    def _export_data(self):
+        exported_data = {key: {**entry, 'songs': list(entry['songs'])} for key, entry in self._playlists.items()}
+        exported_data['version'] = self.CURRENT_DATA_VERSION
+        return json.dumps(exported_data)
 
     def _path(self):
         return os.path.join(self.DATA_FILE_LOCATION, f"{self.guild_id}.json")
 
 
+class ShuffleBag(object):
+    """
+    Deals out every song of a playlist once, in random order, before any song comes round again.
+    The songs left in the current cycle are kept in a list alongside a map of their positions, so picking, adding and
+    removing a song are all O(1); refilling the bag at the end of a cycle is O(n), once every n picks.
+    """
+
+    def __init__(self):
+        self._remaining = []
+        self._positions = {}
+
+    def __len__(self):
+        return len(self._remaining)
+
+    def add(self, song):
+        if song not in self._positions:
+            self._positions[song] = len(self._remaining)
+            self._remaining.append(song)
+
+    def discard(self, song):
+        position = self._positions.pop(song, None)
+        if position is None:
+            return
+        # move the last song into the hole rather than shifting everything down
+        last = self._remaining.pop()
+        if position < len(self._remaining):
+            self._remaining[position] = last
+            self._positions[last] = position
+
+    def pick(self, songs, avoid=None):
+        """
+        Takes a random song that hasn't been dealt yet this cycle, starting a new cycle from *songs* when none are left.
+        *avoid*, the song that just played, only comes out if it is the only one in the bag.
+        """
+        if not self._remaining:
+            for song in songs:
+                self.add(song)
+            if not self._remaining:
+                return None
+        index = random.randrange(len(self._remaining))
+        if self._remaining[index] == avoid and len(self._remaining) > 1:
+            # draw from every other position instead, without retrying
+            index = random.randrange(len(self._remaining) - 1)
+            if self._remaining[index] == avoid:
+                index = len(self._remaining) - 1
+        song = self._remaining[index]
+        self.discard(song)
+        return song
+
+
+class JsonPlaylistStore(object):
+    """
+    One json file per guild under DATA_FILE_LOCATION.  Every change rewrites the guild's whole file, batched up by the
+    write-behind PlaylistWriter.
+    """
+
+    def load(self, playlist: ServerPlaylist):
+        log.debug("load_playlists", guild=playlist.guild_id, path=playlist._path())
+        if os.path.exists(playlist._path()):
+            with open(playlist._path()) as f:
+                return json.loads(f.read())
+        return None
+
+    def loaded(self, playlist: ServerPlaylist, version):
+        if version is not None and version != playlist.CURRENT_DATA_VERSION:
+            playlist_writer.mark_dirty(playlist)
+
+    async def flush(self, playlist: ServerPlaylist):
+        await playlist_writer.flush(playlist)
+
+    def add_playlist(self, playlist: ServerPlaylist, key, name):
+        playlist_writer.mark_dirty(playlist)
+
+    def remove_playlist(self, playlist: ServerPlaylist, key):
+        playlist_writer.mark_dirty(playlist)
+
+    def add_songs(self, playlist: ServerPlaylist, key, songs):
+        playlist_writer.mark_dirty(playlist)
+
+    def remove_song(self, playlist: ServerPlaylist, key, song):
+        playlist_writer.mark_dirty(playlist)
+
+    async def songs(self, playlist: ServerPlaylist, key, offset=0, limit=None):
+        songs = playlist._playlists[key]['songs']
+        if limit is None:
+            return sorted(songs)[offset:]
+        # only the songs up to the end of the page need sorting
+        return heapq.nsmallest(offset + limit, songs)[offset:]
+
+
+class SqlitePlaylistStore(object):
+    """
+    Every guild's playlists in one SQLite database in WAL mode.  Changes are single indexed inserts and deletes rather
+    than a rewrite of the guild's whole file.  They're queued to a single writer thread that commits them in order,
+    off the event loop; loads and song listings go through the same thread, so they see every change queued before
+    them.  Listings are read a page at a time, in the order of the songs index.
+    A guild that isn't in the database yet is migrated from its json file, through _upgrade_data, on first load.
+    Several bot processes can share the database (see supervisor.py).  A write that finds it locked by another process
+    waits BUSY_TIMEOUT seconds, then backs off and tries again, up to WRITE_ATTEMPTS times; only the writer thread waits.
+    """
+
+    DATABASE = "./playlists/playlists.db"
+    BUSY_TIMEOUT = 1.0
+    WRITE_ATTEMPTS = 10
+    RETRY_DELAY = 0.5
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS guilds (
+            guild_id TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS playlists (
+            guild_id TEXT NOT NULL,
+            playlist TEXT NOT NULL,
+            name TEXT NOT NULL,
+            PRIMARY KEY (guild_id, playlist)
+        );
+        CREATE TABLE IF NOT EXISTS songs (
+            guild_id TEXT NOT NULL,
+            playlist TEXT NOT NULL,
+            song TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, playlist, song)
+        );
+        CREATE INDEX IF NOT EXISTS songs_by_position ON songs (guild_id, playlist, position);
+    """
+
+    def __init__(self, path=None, busy_timeout=None):
+        self.path = path or os.getenv('TOBY_PLAYLIST_DATABASE', self.DATABASE)
+        self.busy_timeout = busy_timeout or float(os.getenv('TOBY_PLAYLIST_BUSY_TIMEOUT', self.BUSY_TIMEOUT))
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # one thread owns the connection, and runs every load and write in the order they were queued
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='playlist-db')
+        self._queued = None
+        # guilds already stored at CURRENT_DATA_VERSION, which need no migrating
+        self._current = set()
+        self._db = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(self.SCHEMA)
+
+    def load(self, playlist: ServerPlaylist):
+        # queued behind the guild's pending writes, so a guild evicted and loaded again sees all of them
+        return self._executor.submit(self._load, playlist).result()
+
+    def _load(self, playlist: ServerPlaylist):
+        guild = str(playlist.guild_id)
+        row = self._db.execute("SELECT version FROM guilds WHERE guild_id = ?", (guild,)).fetchone()
+        if row is None:
+            return JsonPlaylistStore().load(playlist)
+        log.debug("load_playlists", guild=guild, path=self.path)
+        if row[0] == playlist.CURRENT_DATA_VERSION:
+            self._current.add(guild)
+        data = {'version': row[0]}
+        for key, name in self._db.execute("SELECT playlist, name FROM playlists WHERE guild_id = ?", (guild,)):
+            data[key] = {'songs': [], 'name': name}
+        songs = self._db.execute("SELECT playlist, song FROM songs WHERE guild_id = ? ORDER BY playlist, position", (guild,))
+        for key, song in songs:
+            data[key]['songs'].append(song)
+        return data
+
+    def loaded(self, playlist: ServerPlaylist, version):
+        guild = str(playlist.guild_id)
+        if guild in self._current:
+            return
+        if version is not None:
+            log.info("migrate_playlists", guild=guild, source=playlist._path(), path=self.path)
+        # copied here, since the playlist carries on changing on the event loop while the writer migrates it
+        entries = [(key, entry['name'], list(entry['songs'])) for key, entry in playlist._playlists.items()]
+        self._write(guild, lambda db: self._replace_guild(db, guild, playlist.CURRENT_DATA_VERSION, entries))
+        self._current.add(guild)
+
+    async def flush(self, playlist: ServerPlaylist):
+        # writes commit one at a time in order, so once the last one queued is done they all are
+        if self._queued is not None:
+            await asyncio.wrap_future(self._queued)
+
+    def add_playlist(self, playlist: ServerPlaylist, key, name):
+        guild = str(playlist.guild_id)
+        self._write(guild, lambda db: db.execute("INSERT OR REPLACE INTO playlists (guild_id, playlist, name) VALUES (?, ?, ?)",
+                                                 (guild, key, name)))
+
+    def remove_playlist(self, playlist: ServerPlaylist, key):
+        guild = str(playlist.guild_id)
+
+        def write(db):
+            db.execute("DELETE FROM songs WHERE guild_id = ? AND playlist = ?", (guild, key))
+            db.execute("DELETE FROM playlists WHERE guild_id = ? AND playlist = ?", (guild, key))
+        self._write(guild, write)
+
+    def add_songs(self, playlist: ServerPlaylist, key, songs):
+        guild = str(playlist.guild_id)
+        songs = list(songs)
+
+        def write(db):
+            start = db.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM songs WHERE guild_id = ? AND playlist = ?",
+                               (guild, key)).fetchone()[0]
+            db.executemany("INSERT OR IGNORE INTO songs (guild_id, playlist, song, position) VALUES (?, ?, ?, ?)",
+                           [(guild, key, song, start + index) for index, song in enumerate(songs)])
+        self._write(guild, write)
+
+    def remove_song(self, playlist: ServerPlaylist, key, song):
+        guild = str(playlist.guild_id)
+        self._write(guild, lambda db: db.execute("DELETE FROM songs WHERE guild_id = ? AND playlist = ? AND song = ?",
+                                                 (guild, key, song)))
+
+    async def songs(self, playlist: ServerPlaylist, key, offset=0, limit=None):
+        guild = str(playlist.guild_id)
+
+        def read():
+            rows = self._db.execute("SELECT song FROM songs WHERE guild_id = ? AND playlist = ? ORDER BY song LIMIT ? OFFSET ?",
+                                    (guild, key, -1 if limit is None else limit, offset))
+            return [song for song, in rows]
+        # on the writer thread, so the page has every change queued before it, and the loop only waits for the result
+        return await asyncio.wrap_future(self._executor.submit(read))
+
+    def _write(self, guild, write):
+        """Queues write(db) to commit as one transaction on the writer thread, after everything queued before it."""
+        self._queued = self._executor.submit(self._commit, guild, write)
+
+    def _commit(self, guild, write):
+        for attempt in range(1, self.WRITE_ATTEMPTS + 1):
+            try:
+                with PLAYLIST_SAVE_SECONDS.time(store='sqlite'), self._db:
+                    write(self._db)
+                return
+            except sqlite3.OperationalError as e:
+                # "database is locked": another process is holding the write lock
+                if 'locked' not in str(e) or attempt == self.WRITE_ATTEMPTS:
+                    log.error("save_playlists_failed", guild=guild, path=self.path, attempts=attempt, error=e)
+                    return
+                log.warning("playlist_database_busy", guild=guild, path=self.path, attempt=attempt)
+                time.sleep(min(self.RETRY_DELAY * attempt, 5.0))
+            except sqlite3.Error as e:
+                log.error("save_playlists_failed", guild=guild, path=self.path, error=e)
+                return
+
+    @staticmethod
+    def _replace_guild(db, guild, version, entries):
+        db.execute("DELETE FROM songs WHERE guild_id = ?", (guild,))
+        db.execute("DELETE FROM playlists WHERE guild_id = ?", (guild,))
+        db.execute("INSERT OR REPLACE INTO guilds (guild_id, version) VALUES (?, ?)", (guild, version))
+        db.executemany("INSERT INTO playlists (guild_id, playlist, name) VALUES (?, ?, ?)",
+                       [(guild, key, name) for key, name, _ in entries])
+        db.executemany("INSERT INTO songs (guild_id, playlist, song, position) VALUES (?, ?, ?, ?)",
+                       [(guild, key, song, position) for key, _, songs in entries for position, song in enumerate(songs)])
+
+
+_default_store = None
+
+
+def default_store():
+    """The store picked by TOBY_PLAYLIST_STORE: 'json' (the default) or 'sqlite'."""
+    global _default_store
+    if _default_store is None:
+        if os.getenv('TOBY_PLAYLIST_STORE', 'json') == 'sqlite':
+            _default_store = SqlitePlaylistStore()
+        else:
+            _default_store = JsonPlaylistStore()
+    return _default_store
+
+
+class PlaylistRegistry(object):
+    """
+    The ServerPlaylists currently held in memory, capped at MAX_RESIDENT guilds.  Guilds are loaded off the event loop,
+    and once over the cap the least recently used guild is flushed and dropped, except for pinned (playing) guilds.
+    """
+
+    MAX_RESIDENT = 200
+    # measuring memory walks every resident playlist, so it's redone at most this often rather than on every scrape
+    MEMORY_SAMPLE_SECONDS = 60
+
+    def __init__(self, max_resident=None, store=None):
+        self.max_resident = max_resident or int(os.getenv('TOBY_MAX_RESIDENT_GUILDS', self.MAX_RESIDENT))
+        self.store = store
+        self.loads = 0
+        self.evictions = 0
+        self._resident = OrderedDict()
+        self._loading = {}
+        self._pinned = set()
+        self._bytes = 0
+        self._bytes_sampled = None
+        RESIDENT_GUILDS.set_function(lambda: len(self._resident))
+        PINNED_GUILDS.set_function(lambda: len(self._pinned))
+        RESIDENT_BYTES.set_function(self.resident_bytes)
+
+    async def get(self, guild_id):
+        data = self._resident.get(guild_id)
+        if data is not None:
+            self._resident.move_to_end(guild_id)
+            return data
+        loading = self._loading.get(guild_id)
+        if loading is None:
+            # a guild's first commands often arrive together, so they share one load
+            loading = self._loading[guild_id] = asyncio.ensure_future(ServerPlaylist.open(guild_id, self.store))
+            try:
+                data = await loading
+            finally:
+                self._loading.pop(guild_id, None)
+            self._resident[guild_id] = data
+            self.loads += 1
+            await self._evict()
+            return data
+        return await asyncio.shield(loading)
+
+    def pin(self, guild_id, pinned=True):
+        """Pinned guilds are never evicted; the music player pins its guild while it is playing."""
+        if pinned:
+            self._pinned.add(guild_id)
+        else:
+            self._pinned.discard(guild_id)
+
+    def stats(self):
+        return {
+            'resident': len(self._resident),
+            'pinned': len(self._pinned),
+            'max_resident': self.max_resident,
+            'loads': self.loads,
+            'evictions': self.evictions,
+            'bytes': self.resident_bytes(),
+        }
+
+    def resident_bytes(self):
+        """deep_sizeof of the resident playlists, as of at most MEMORY_SAMPLE_SECONDS ago."""
+        now = time.monotonic()
+        if self._bytes_sampled is None or now - self._bytes_sampled >= self.MEMORY_SAMPLE_SECONDS:
+            self._bytes = sum(deep_sizeof(data._playlists) for data in self._resident.values())
+            self._bytes_sampled = now
+        return self._bytes
+
+    async def _evict(self):
+        for guild_id in list(self._resident):
+            if len(self._resident) <= self.max_resident:
+                return
+            if guild_id in self._pinned:
+                continue
+            data = self._resident[guild_id]
+            await data._store.flush(data)
+            # the guild may have been used again while we were flushing it
+            if guild_id in self._pinned or guild_id not in self._resident or playlist_writer.is_dirty(data):
+                continue
+            del self._resident[guild_id]
+            self.evictions += 1
+            PLAYLIST_EVICTIONS.inc()
+            log.info("evict_playlists", guild=guild_id, resident=len(self._resident))
+
+
+def deep_sizeof(obj):
+    """Approximate memory held by *obj* and the dicts, lists and strings inside it."""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key) + deep_sizeof(value) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_sizeof(item) for item in obj)
+    return size
+
+
+class PlaylistWriter(object):
+    """
+    Write-behind persistence for playlist files.  Mutations only mark a guild dirty, a burst of them is merged into one
+    flush a short delay after the first, and the file I/O runs off the event loop, on a single thread so snapshots are
+    written in the order they were taken.  A file that fails to write stays dirty and is tried again on the next flush.
+    """
+
+    FLUSH_DELAY = 2.0
+
+    def __init__(self, flush_delay=None):
+        self.flush_delay = flush_delay or self.FLUSH_DELAY
+        self.flushes = 0
+        self.writes = 0
+        self._dirty = {}
+        self._timer = None
+        self._flush_task = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='playlist-writer')
+        # flush_sync runs on the caller's thread, so it can still overlap the executor at shutdown
+        self._write_lock = threading.Lock()
+
+    def mark_dirty(self, data: ServerPlaylist):
+        self._dirty[data._path()] = data
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no event loop (scripts, shutdown), so there is nothing to defer to
+            self.flush_sync()
+            return
+        if self._timer is None:
+            self._timer = loop.call_later(self.flush_delay, self._flush_later)
+
+    def is_dirty(self, data: ServerPlaylist):
+        return data._path() in self._dirty
+
+    async def flush(self, data: ServerPlaylist = None):
+        """Writes out every dirty guild, or just *data* if given."""
+        snapshot = self._take_snapshot(data)
+        if snapshot:
+            failed = await asyncio.get_running_loop().run_in_executor(self._executor, self._write_all, snapshot)
+            for path in failed:
+                # unless it has been changed again since, and is already waiting for the next flush
+                if path not in self._dirty:
+                    self.mark_dirty(snapshot[path][0])
+
+    def flush_sync(self):
+        snapshot = self._take_snapshot()
+        for path in self._write_all(snapshot):
+            # nothing left to retry it; leave it dirty for a later flush, if there is one
+            self._dirty.setdefault(path, snapshot[path][0])
+
+    async def close(self):
+        """Writes out every dirty guild, and waits for a flush that was already under way."""
+        await self.flush()
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+
+    def _flush_later(self):
+        self._timer = None
+        self._flush_task = asyncio.ensure_future(self.flush())
+
+    def _take_snapshot(self, data=None):
+        # serialize on the calling thread, so the writer never sees a playlist halfway through a mutation
+        if data is not None:
+            dirty = {data._path(): data} if self._dirty.pop(data._path(), None) else {}
+        else:
+            dirty, self._dirty = self._dirty, {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        return {path: (data, data._export_data()) for path, data in dirty.items()}
+
+    def _write_all(self, snapshot):
+        """Writes each (playlist, exported data) in *snapshot*.  Returns the paths that couldn't be written."""
+        failed = []
+        with self._write_lock:
+            for path, (_, exported_data) in snapshot.items():
+                # named for this process, so two processes writing the same file can't trample each other's half
+                tmpfile = f"{path}.{os.getpid()}.tmp"
+                started = time.perf_counter()
+                try:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with open(tmpfile, "w") as f:
+                        f.write(exported_data)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    # atomic, so a crash leaves either the old file or the new one, never half of either
+                    os.replace(tmpfile, path)
+                    self.writes += 1
+                    PLAYLIST_SAVE_SECONDS.observe(time.perf_counter() - started, store='json')
+                    log.debug("save_playlists", path=path)
+                except OSError as e:
+                    log.error("save_playlists_failed", path=path, error=e)
+                    failed.append(path)
+            self.flushes += 1
+        return failed
+
+
+playlist_writer = PlaylistWriter()
+atexit.register(playlist_writer.flush_sync)
+
+
 def test_upgrades():
-    ServerPlaylist("test_v0_playlist")
+    # upgrade in memory only, so the v0 file stays a v0 file
+    data = ServerPlaylist("test_v0_playlist", load=False)
+    data._playlists = data._upgrade_data(JsonPlaylistStore().load(data))
+    for entry in data._playlists.values():
+        assert all(song == canonical_video_id(song) for song in entry['songs'])
+    assert len(data._playlists['crtaldorei']['songs']) == 17
+
+
+def test_upgrade_dedup():
+    data = ServerPlaylist("test_dedup_playlist", JsonPlaylistStore(), load=False)
+    # every form of a link to one video becomes one entry, kept where it first appeared
+    upgraded = data._upgrade_data({'mix': {'name': "Mix", 'songs': [
+        "https://youtu.be/dQw4w9WgXcQ?t=10",
+        "https://soundcloud.com/artist/track",
+        "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+        "https://www.youtube.com/watch?v=9bZkp7q19f0",
+        "https://www.youtube.com/shorts/dQw4w9WgXcQ",
+        "https://soundcloud.com/artist/track",
+    ]}})
+    assert list(upgraded['mix']['songs']) == ["dQw4w9WgXcQ", "https://soundcloud.com/artist/track", "9bZkp7q19f0"]
+    # version 1 data is already canonical, but duplicates still go
+    upgraded = data._upgrade_data({'version': 1, 'mix': {'name': "Mix", 'songs': ["9bZkp7q19f0", "dQw4w9WgXcQ", "9bZkp7q19f0"]}})
+    assert list(upgraded['mix']['songs']) == ["9bZkp7q19f0", "dQw4w9WgXcQ"]
+    # and the ordered set round trips through the exported json
+    data._playlists = upgraded
+    assert json.loads(data._export_data())['mix']['songs'] == ["9bZkp7q19f0", "dQw4w9WgXcQ"]
 
 
 if __name__ == "__main__":
     test_upgrades()
+    test_upgrade_dedup()
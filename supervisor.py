@@ -0,0 +1,155 @@
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import nextcord
+from dotenv import load_dotenv
+from logs import configure_logging, get_logger
+from metrics import MetricsServer
+from ytwrapper import AudioCache
+
+log = get_logger(__name__)
+
+
+class Worker(object):
+    """One bot process, and the shards it runs."""
+
+    def __init__(self, index, shard_ids):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.process = None
+        self.started = None
+        # restarts since it last stayed up for STABLE_SECONDS
+        self.crashes = 0
+        self.restart_at = None
+
+
+class ShardSupervisor(object):
+    """
+    Runs Toby as WORKERS processes on one host, each running every WORKERS-th shard, so the voice, FFmpeg and command
+    work for different guilds lands on different cores instead of sharing one interpreter.  The workers share the
+    SQLite playlist store; each gets its own metrics port, command sync file and slice of the audio cache.  A worker
+    that exits is restarted, after a delay that grows while it keeps crashing.
+    TOBY_SHARD_COUNT overrides the shard count Discord recommends, which is 1 for a bot in fewer than 1000 guilds.
+    """
+
+    WORKERS = os.cpu_count() or 1
+    RESTART_BACKOFF = (1, 2, 5, 10, 30, 60)
+    # a worker that stays up this long is doing fine, and starts over at the shortest backoff if it crashes later
+    STABLE_SECONDS = 300
+    POLL_INTERVAL = 1.0
+    STOP_TIMEOUT = 20
+
+    def __init__(self, token, workers=None, shard_count=None, command=None):
+        self.token = token
+        self.workers = workers or int(os.getenv('TOBY_WORKERS', self.WORKERS))
+        self.shard_count = shard_count or (int(os.getenv('TOBY_SHARD_COUNT')) if os.getenv('TOBY_SHARD_COUNT') else None)
+        self.command = command or [sys.executable, '-u', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'discordbot.py')]
+        self.restarts = 0
+        self._workers = []
+        self._stopping = False
+
+    def run(self):
+        """Starts the workers and keeps them running until SIGTERM or SIGINT.  This Method blocks."""
+        if self.shard_count is None:
+            self.shard_count = asyncio.run(self._recommended_shards())
+        # more processes than shards would leave some with nothing to do
+        self.workers = max(1, min(self.workers, self.shard_count))
+        self._workers = [Worker(index, list(range(index, self.shard_count, self.workers))) for index in range(self.workers)]
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        log.info("supervisor_starting", workers=self.workers, shards=self.shard_count)
+        for worker in self._workers:
+            self._start(worker)
+        while not self._stopping:
+            time.sleep(self.POLL_INTERVAL)
+            self._check()
+        self._shutdown()
+
+    async def _recommended_shards(self):
+        http = nextcord.http.HTTPClient(dispatch=lambda *args: None)
+        try:
+            await http.static_login(self.token)
+            shards, _ = await http.get_bot_gateway()
+            return shards
+        finally:
+            await http.close()
+
+    def _check(self):
+        now = time.monotonic()
+        for worker in self._workers:
+            if self._stopping:
+                return
+            if worker.process is None:
+                if now >= worker.restart_at:
+                    self.restarts += 1
+                    self._start(worker)
+                continue
+            code = worker.process.poll()
+            if code is None:
+                continue
+            uptime = now - worker.started
+            if uptime >= self.STABLE_SECONDS:
+                worker.crashes = 0
+            delay = self.RESTART_BACKOFF[min(worker.crashes, len(self.RESTART_BACKOFF) - 1)]
+            worker.crashes += 1
+            worker.process = None
+            worker.restart_at = now + delay
+            log.warning("worker_exited", worker=worker.index, shards=worker.shard_ids, code=code,
+                        uptime=f"{uptime:.0f}s", restart_in=f"{delay}s")
+
+    def _start(self, worker):
+        worker.process = subprocess.Popen(self.command, env=self._environment(worker))
+        worker.started = time.monotonic()
+        log.info("worker_started", worker=worker.index, shards=worker.shard_ids, pid=worker.process.pid)
+
+    def _environment(self, worker):
+        metrics_port = int(os.getenv('TOBY_METRICS_PORT', MetricsServer.PORT))
+        audio_budget = int(os.getenv('TOBY_AUDIO_CACHE_BYTES', AudioCache.BUDGET_BYTES))
+        audio_location = os.getenv('TOBY_AUDIO_CACHE_DIR', AudioCache.CACHE_LOCATION)
+        return {
+            **os.environ,
+            'TOBY_WORKER': str(worker.index),
+            'TOBY_SHARD_IDS': ",".join(str(shard_id) for shard_id in worker.shard_ids),
+            'TOBY_SHARD_COUNT': str(self.shard_count),
+            # per-guild json files are only safe with one process; the SQLite store is shared by all of them
+            'TOBY_PLAYLIST_STORE': 'sqlite',
+            'TOBY_METRICS_PORT': str(metrics_port + worker.index),
+            'TOBY_COMMAND_SYNC_FILE': f"./cache/command_sync.worker-{worker.index}.json",
+            # each worker keeps its own index of what it downloaded, so each needs its own directory and budget
+            'TOBY_AUDIO_CACHE_DIR': os.path.join(audio_location, f"worker-{worker.index}", ""),
+            'TOBY_AUDIO_CACHE_BYTES': str(audio_budget // self.workers),
+        }
+
+    def _stop(self, signum, frame):
+        log.info("supervisor_stopping", signal=signal.Signals(signum).name)
+        self._stopping = True
+
+    def _shutdown(self):
+        running = [worker.process for worker in self._workers if worker.process is not None]
+        for process in running:
+            # the bot closes cleanly on SIGTERM, flushing playlists on the way out
+            process.terminate()
+        deadline = time.monotonic() + self.STOP_TIMEOUT
+        for process in running:
+            try:
+                process.wait(max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                log.warning("worker_killed", pid=process.pid)
+                process.kill()
+                process.wait()
+        log.info("supervisor_stopped", restarts=self.restarts)
+
+
+def main():
+    """run toby as sharded worker processes.  This Method blocks"""
+    load_dotenv()
+    configure_logging()
+    ShardSupervisor(os.getenv('DISCORD_TOKEN')).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,19 @@
+import asyncio
+import collections
+import functools
+import importlib.util
+import sys
+import time
 import nextcord
-import d20
+import metrics
+from logs import get_logger
+
+log = get_logger(__name__)
+
+
+MAX_MESSAGE_LENGTH = 2000
+
+SEND_SECONDS = metrics.Histogram('toby_outbound_send_seconds', "Time from queueing a message to Discord accepting it", ['destination'])
 
 
 def get_register_guilds():
@@ -8,27 +22,171 @@ def get_register_guilds():
 
 
 async def send(ctx, text='', **kwargs):
-    chunks = chunk_text(text)
-    for chunk in chunks:
-        return await ctx.send(chunk, **kwargs)
+    """Sends *text* to *ctx* (a channel or command context) in as few messages as it fits in.  Returns the messages."""
+    chunks = chunk_text(text, MAX_MESSAGE_LENGTH)
+    return await outbox.send_all(('channel', getattr(ctx, 'channel', ctx).id), ctx.send, chunks, **kwargs)
 
 
 async def safe_send(interaction, text='', **kwargs):
-    chunks = chunk_text(text)
-    followup = interaction.response.is_done()
-    for chunk in chunks:
-        if not followup:
-            await interaction.response.send_message(chunk, **kwargs)
-            followup = True
-        else:
-            await interaction.followup.send(chunk, **kwargs)
+    chunks = chunk_text(text, MAX_MESSAGE_LENGTH)
+    if not interaction.response.is_done():
+        # the initial response has a 3 second deadline and its own endpoint, so it never waits behind anything
+        await interaction.response.send_message(chunks.pop(0), **kwargs)
+    if chunks:
+        await outbox.send_all(('interaction', interaction.token), interaction.followup.send, chunks, **kwargs)
+
+
+class RateBucket(object):
+    """A token bucket allowing *rate* sends every *per* seconds, refilled continuously."""
+
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+        self.updated = now
+
+    def full(self):
+        self._refill()
+        return self.tokens >= self.rate
+
+    async def acquire(self):
+        self._refill()
+        while self.tokens < 1:
+            await asyncio.sleep((1 - self.tokens) * self.per / self.rate)
+            self._refill()
+        self.tokens -= 1
+
+
+class OutboundScheduler(object):
+    """
+    Every channel message and interaction followup goes out through here.  Each destination gets its own queue, worked
+    through in order by its own task.  A send first waits for a token from that destination's bucket and the global
+    one, so bursts are paced out ahead of Discord's 429s rather than retried after them.  Then whatever else has queued
+    up behind it meanwhile is merged in, up to Discord's 2000 characters, when it's going to the same place the same way.
+    """
+
+    # Discord allows 5 messages per 5 seconds in a channel and 50 requests a second overall
+    CHANNEL_RATE = (5, 5.0)
+    GLOBAL_RATE = (50, 1.0)
+    SLOW_SEND = 2.0
+    LATENCY_SAMPLES = 1000
+
+    def __init__(self):
+        self._queues = {}
+        self._buckets = {}
+        self._global = RateBucket(*self.GLOBAL_RATE)
+        self._latencies = collections.deque(maxlen=self.LATENCY_SAMPLES)
+        self.sent = 0
+        self.merged = 0
+
+    async def send_all(self, key, send, chunks, **kwargs):
+        """
+        Queues each of *chunks* for destination *key*, to be posted with ``send(text, **kwargs)``.
+        Waits until they're all out and returns the resulting messages, one per chunk (merged chunks share one).
+        """
+        loop = asyncio.get_running_loop()
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = collections.deque()
+            asyncio.ensure_future(self._drain(key, queue))
+        futures = []
+        # chunks of one text keep the whitespace they were split on, so only separate texts need a newline between them
+        group = object()
+        for chunk in chunks:
+            futures.append(loop.create_future())
+            queue.append((send, chunk, kwargs, futures[-1], time.monotonic(), group))
+        return await asyncio.gather(*futures)
+
+    async def _drain(self, key, queue):
+        bucket = self._buckets.setdefault(key, RateBucket(*self.CHANNEL_RATE))
+        try:
+            while queue:
+                await bucket.acquire()
+                await self._global.acquire()
+                batch = [queue.popleft()]
+                while queue and self._mergeable(batch, queue[0]):
+                    batch.append(queue.popleft())
+                send, _, kwargs, _, queued, _ = batch[0]
+                started = time.monotonic()
+                try:
+                    message = await send(self._merge(batch), **kwargs)
+                except Exception as e:
+                    for _, _, _, future, _, _ in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                finished = time.monotonic()
+                for _, _, _, future, enqueued, _ in batch:
+                    if not future.done():
+                        future.set_result(message)
+                    SEND_SECONDS.observe(finished - enqueued, destination=key[0])
+                self.sent += 1
+                self.merged += len(batch) - 1
+                self._latencies.append(finished - queued)
+                if finished - queued > self.SLOW_SEND:
+                    log.warning("slow_send", destination=key, queued=f"{started - queued:.2f}s", sent=f"{finished - started:.2f}s")
+        finally:
+            del self._queues[key]
+            if bucket.full():
+                # a full bucket is the same as a new one, so don't keep one around for every channel we ever saw
+                del self._buckets[key]
+
+    @staticmethod
+    def _mergeable(batch, pending):
+        send, _, kwargs, _, _, _ = batch[0]
+        length = sum(len(text) + 1 for _, text, _, _, _, _ in batch) + len(pending[1])
+        return pending[0] == send and pending[2] == kwargs and length <= MAX_MESSAGE_LENGTH
+
+    @staticmethod
+    def _merge(batch):
+        text = batch[0][1]
+        for previous, pending in zip(batch, batch[1:]):
+            text += pending[1] if pending[5] is previous[5] else f"\n{pending[1]}"
+        return text
+
+    def stats(self):
+        latencies = sorted(self._latencies)
+        def percentile(p):
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000) if latencies else None
+        return {
+            'sent': self.sent,
+            'merged': self.merged,
+            'queued': sum(len(queue) for queue in self._queues.values()),
+            'latency_p50_ms': percentile(0.5),
+            'latency_p95_ms': percentile(0.95),
+        }
 
 
+outbox = OutboundScheduler()
+
+
+def lazy_import(name):
+    """
+    Returns module *name*, but only really imports it the first time one of its attributes is used, so heavy
+    libraries don't slow down startup.  The first use should happen on the event loop thread: before 3.12 the lazy
+    module isn't safe to trigger from two threads at once.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+@functools.cache
 def get_version():
+    # the file is written at build time and never changes under a running bot
     with open('./version.txt') as f:
-        text = f.read()
-        print(f"build version {text}")
-        return text
+        return f.read()
 
 
 def chunk_text(text, max_chunk_size=1024, chunk_on=("\n\n", "\n", ". ", ", ", " "), chunker_i=0):
@@ -62,67 +220,3 @@ def chunk_text(text, max_chunk_size=1024, chunk_on=("\n\n", "\n", ". ", ", ", "
     # remove extra split_char from last chunk
     chunks[-1] = chunks[-1][: -len(split_char)]
     return chunks
-
-
-class VerboseMDStringifier(d20.MarkdownStringifier):
-    def _str_expression(self, node):
-        return f"**{node.comment or 'Result'}**: {self._stringify(node.roll)}\n**Total**: {int(node.total)}"
-
-
-class BladesStringifier(d20.MarkdownStringifier):
-    def _str_expression(self, node):
-        # determine if this is zero-dice roll
-        operation = node.children[0].operations[0]
-        if operation.op == "k":
-            normal_roll = True
-        else:
-            normal_roll = False
-        if normal_roll:
-            die_value = 0
-        else:
-            die_value = 7
-        critical = False
-        for child in node.children[0].values:
-            if normal_roll:
-                if child.values[0].total >= die_value:
-                    if die_value == 6 and child.values[0].total == 6:
-                        critical = True
-                    die_value = child.values[0].total
-            else:  # low roll
-                if child.values[0].total <= die_value:
-                    die_value = child.values[0].total
-        if critical:
-            resulttype = "Critical Success!"
-        elif die_value == 6:
-            resulttype = "Full Success!"
-        elif die_value > 3:
-            resulttype = "Partial Success"
-        else:
-            resulttype = "Bad Outcome"
-        # TODO: remove dice pattern from stringify below
-        return f"**Dice**: {self._stringify(node.roll)}\n**Result**: {resulttype}"
-
-    def _str_dice(self, node):
-        the_dice = [self._stringify(die) for die in node.values]
-        return f"({', '.join(the_dice)})"
-
-
-class PersistentRollContext(d20.RollContext):
-    """
-    A roll context that tracks lifetime rolls as well as individual rolls.
-    """
-
-    def __init__(self, max_rolls=1000, max_total_rolls=None):
-        """
-        :param max_rolls: The maximum number of rolls allowed in an individual roll.
-        :param max_total_rolls: The maximum number of rolls allowed throughout this object's lifetime.
-        """
-        super().__init__(max_rolls)
-        self.max_total_rolls = max_total_rolls or max_rolls
-        self.total_rolls = 0
-
-    def count_roll(self, n=1):
-        super().count_roll(n)
-        self.total_rolls += 1
-        if self.total_rolls > self.max_total_rolls:
-            raise d20.TooManyRolls("Too many dice rolled.")
@@ -0,0 +1,78 @@
+import re
+from urllib.parse import urlparse, parse_qs
+
+
+YOUTUBE_ID_RE = re.compile(r"^[A-Za-z0-9_-]{11}$")
+YOUTUBE_HOSTS = ("youtube.com", "www.youtube.com", "m.youtube.com", "music.youtube.com", "youtube-nocookie.com", "www.youtube-nocookie.com")
+YOUTUBE_PATH_PREFIXES = ("/shorts/", "/embed/", "/live/", "/v/")
+
+
+def canonical_video_id(url: str):
+    """
+    Returns the youtube video id for *url*, so that every form of a link to one video maps to the same key.
+    Anything that isn't a recognizable youtube video link is returned stripped but otherwise unchanged.
+    >>> canonical_video_id("https://youtu.be/dQw4w9WgXcQ?t=10")
+    'dQw4w9WgXcQ'
+    >>> canonical_video_id("https://music.youtube.com/watch?v=dQw4w9WgXcQ&feature=share")
+    'dQw4w9WgXcQ'
+    """
+    url = url.strip()
+    if YOUTUBE_ID_RE.match(url):
+        return url
+    parsed = urlparse(url if "//" in url else f"https://{url}")
+    host = (parsed.hostname or "").lower()
+    candidate = None
+    if host == "youtu.be":
+        candidate = parsed.path.lstrip("/").split("/")[0]
+    elif host in YOUTUBE_HOSTS:
+        if parsed.path == "/watch":
+            candidate = parse_qs(parsed.query).get("v", [None])[0]
+        else:
+            for prefix in YOUTUBE_PATH_PREFIXES:
+                if parsed.path.startswith(prefix):
+                    candidate = parsed.path[len(prefix):].split("/")[0]
+                    break
+    if candidate and YOUTUBE_ID_RE.match(candidate):
+        return candidate
+    return url
+
+
+def video_url(video_id: str):
+    """
+    The inverse of *canonical_video_id*: turns a stored id back into something yt-dlp can extract.
+    """
+    if YOUTUBE_ID_RE.match(video_id):
+        return f"https://www.youtube.com/watch?v={video_id}"
+    return video_id
+
+
+def test_canonical_video_id():
+    video_id = "dQw4w9WgXcQ"
+    for url in (video_id,
+                f"  {video_id}\n",
+                f"https://www.youtube.com/watch?v={video_id}",
+                f"https://youtube.com/watch?feature=share&v={video_id}&t=42",
+                f"https://m.youtube.com/watch?v={video_id}",
+                f"https://music.youtube.com/watch?v={video_id}&list=RDAMVM",
+                f"www.youtube.com/watch?v={video_id}",
+                f"https://youtu.be/{video_id}",
+                f"https://youtu.be/{video_id}?si=abc&t=10",
+                f"https://www.youtube.com/shorts/{video_id}",
+                f"https://www.youtube.com/embed/{video_id}",
+                f"https://www.youtube-nocookie.com/embed/{video_id}",
+                f"https://www.youtube.com/live/{video_id}?feature=share"):
+        assert canonical_video_id(url) == video_id, url
+    # not a youtube video: kept as is (stripped), so it still round trips through video_url
+    for url in ("https://soundcloud.com/artist/track",
+                f"https://example.com/watch?v={video_id}",
+                "https://www.youtube.com/playlist?list=PL0123456789",
+                "https://www.youtube.com/watch?v=tooshort",
+                "https://youtu.be/"):
+        assert canonical_video_id(url) == url, url
+        assert video_url(canonical_video_id(url)) == url, url
+    assert canonical_video_id(" https://soundcloud.com/artist/track ") == "https://soundcloud.com/artist/track"
+    assert video_url(video_id) == f"https://www.youtube.com/watch?v={video_id}"
+
+
+if __name__ == "__main__":
+    test_canonical_video_id()
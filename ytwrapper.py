@@ -1,11 +1,25 @@
 import asyncio
+import hashlib
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from weakref import WeakSet
 import nextcord
 #import youtube_dl
-import yt_dlp
+import metrics
+from logs import get_logger
+from utils import lazy_import
+from videoid import canonical_video_id
 
+log = get_logger(__name__)
 
-# Suppress noise about console usage from errors
-yt_dlp.utils.bug_reports_message = lambda: ''
+# yt-dlp is slow to import; it's loaded when the extraction pool starts (see ExtractionScheduler._start)
+yt_dlp = lazy_import('yt_dlp')
 
 
 ytdl_format_options = {
@@ -26,10 +40,569 @@ ffmpeg_options = {
     'options': '-vn',
 }
 
-ytdl = yt_dlp.YoutubeDL(ytdl_format_options)
+# extraction priorities, most urgent first
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BULK: 'bulk'}
 
+EXTRACTION_SECONDS = metrics.Histogram('toby_extraction_seconds', "Time yt-dlp spent extracting a video, not counting time queued", ['kind'])
+EXTRACTION_QUEUE_SECONDS = metrics.Histogram('toby_extraction_queue_seconds', "Time an extraction waited for a worker", ['priority'])
+EXTRACTION_QUEUED = metrics.Gauge('toby_extraction_queued', "Extractions waiting for a worker", ['priority'])
+EXTRACTION_ERRORS = metrics.Counter('toby_extraction_errors_total', "Extractions yt-dlp failed", ['kind'])
+FFMPEG_PROCESSES = metrics.Gauge('toby_ffmpeg_processes', "FFmpeg processes currently running")
+for name in PRIORITY_NAMES.values():
+    # both show up from the start, rather than once something has queued at that priority
+    EXTRACTION_QUEUED.set(0, priority=name)
+
+# every FFmpeg audio source we've started, so the gauge can count the ones whose process is still alive
+ffmpeg_sources = WeakSet()
+
+
+def _ffmpeg_alive(source):
+    process = getattr(source, '_process', None)
+    return isinstance(process, subprocess.Popen) and process.poll() is None
+
+
+FFMPEG_PROCESSES.set_function(lambda: sum(1 for source in list(ffmpeg_sources) if _ffmpeg_alive(source)))
+
+
+class ExtractionScheduler(object):
+    """
+    Runs yt-dlp work on a dedicated thread pool, each thread with its own YoutubeDL instance.
+    Interactive jobs always go ahead of bulk jobs, and within each priority the guilds take turns, so one guild
+    importing a huge playlist can't hold up everyone else.
+    """
+
+    WORKERS = 4
+    WAIT_SAMPLES = 200
+
+    def __init__(self, workers=None, ytdl_factory=None):
+        self.workers = workers
+        # builds each worker thread's YoutubeDL; the benchmarks swap in a fake one
+        self.ytdl_factory = ytdl_factory or (lambda: yt_dlp.YoutubeDL(ytdl_format_options))
+        self.submitted = 0
+        self.completed = 0
+        self.running = 0
+        self._queues = {INTERACTIVE: OrderedDict(), BULK: OrderedDict()}
+        self._waits = {INTERACTIVE: deque(maxlen=self.WAIT_SAMPLES), BULK: deque(maxlen=self.WAIT_SAMPLES)}
+        self._local = threading.local()
+        self._executor = None
+        self._ready = None
+        self._worker_tasks = []
+
+    async def run(self, fn, *, guild=None, priority=BULK):
+        """Queues fn(ytdl) for the extraction pool and returns its result once a worker gets to it."""
+        if self._executor is None:
+            self._start()
+        future = asyncio.get_running_loop().create_future()
+        self._queues[priority].setdefault(guild, deque()).append((future, fn, time.monotonic()))
+        EXTRACTION_QUEUED.inc(priority=PRIORITY_NAMES[priority])
+        self.submitted += 1
+        self._ready.release()
+        return await future
+
+    def queue_depth(self, priority):
+        return sum(len(jobs) for jobs in self._queues[priority].values())
+
+    def stats(self):
+        stats = {
+            'workers': self.workers,
+            'running': self.running,
+            'submitted': self.submitted,
+            'completed': self.completed,
+        }
+        for priority, name in PRIORITY_NAMES.items():
+            waits = self._waits[priority]
+            stats[f'{name}_queued'] = self.queue_depth(priority)
+            stats[f'{name}_wait_avg'] = sum(waits) / len(waits) if waits else 0
+            stats[f'{name}_wait_max'] = max(waits) if waits else 0
+        return stats
+
+    async def warm_up(self):
+        """Starts the pool and builds a YoutubeDL, so the first real extraction doesn't pay for either."""
+        await self.run(lambda ytdl: None, priority=BULK)
+
+    def _start(self):
+        # Suppress noise about console usage from errors.  Being the first touch, this also loads yt-dlp, here on the
+        # event loop rather than racing in from several worker threads.
+        yt_dlp.utils.bug_reports_message = lambda: ''
+        self.workers = self.workers or int(os.getenv('TOBY_EXTRACTION_WORKERS', self.WORKERS))
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='ytdl')
+        self._ready = asyncio.Semaphore(0)
+        # one worker coroutine per thread, so jobs wait in our queues rather than inside the executor
+        self._worker_tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    def _next_job(self):
+        for priority in (INTERACTIVE, BULK):
+            queue = self._queues[priority]
+            if queue:
+                guild, jobs = next(iter(queue.items()))
+                job = jobs.popleft()
+                if jobs:
+                    queue.move_to_end(guild)
+                else:
+                    del queue[guild]
+                EXTRACTION_QUEUED.dec(priority=PRIORITY_NAMES[priority])
+                return priority, job
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._ready.acquire()
+            priority, (future, fn, queued_at) = self._next_job()
+            if future.cancelled():
+                continue
+            waited = time.monotonic() - queued_at
+            self._waits[priority].append(waited)
+            EXTRACTION_QUEUE_SECONDS.observe(waited, priority=PRIORITY_NAMES[priority])
+            self.running += 1
+            try:
+                result = await loop.run_in_executor(self._executor, self._call, fn)
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+            finally:
+                self.running -= 1
+                self.completed += 1
+
+    def _call(self, fn):
+        ytdl = getattr(self._local, 'ytdl', None)
+        if ytdl is None:
+            ytdl = self._local.ytdl = self.ytdl_factory()
+        return fn(ytdl)
+
+
+extraction_scheduler = ExtractionScheduler()
+
+
+def timed_job(kind, job):
+    """Wraps an extraction *job* to observe EXTRACTION_SECONDS on the worker thread, so time spent queued isn't counted."""
+    def timed(ytdl):
+        started = time.perf_counter()
+        try:
+            return job(ytdl)
+        finally:
+            EXTRACTION_SECONDS.observe(time.perf_counter() - started, kind=kind)
+    return timed
+
+
+class ExpiringLRU(object):
+    """
+    An in-memory LRU mapping where every entry also carries an absolute expiry time.
+    Expired entries are dropped when they are looked up, and the least recently used entry is evicted once full.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def get(self, key, now=None):
+        """returns (expires, value) for *key*, or None if it is missing or expired."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= (now or time.time()):
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, value, expires):
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key):
+        return self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class MetadataCache(object):
+    """
+    Song metadata keyed by canonical video id.  Entries live in an in-memory LRU that is backed by json files on disk,
+    and concurrent lookups of the same video share a single extraction.
+    """
+
+    CACHE_LOCATION = "./cache/metadata/"
+    MAX_ENTRIES = 2048
+    TTL = 7 * 24 * 60 * 60
+    FIELDS = ('id', 'title', 'uploader', 'duration', 'webpage_url', 'thumbnail', 'is_live')
+
+    def __init__(self, location=None, max_entries=None, ttl=None):
+        self.location = location or self.CACHE_LOCATION
+        self.ttl = ttl or self.TTL
+        self._memory = ExpiringLRU(max_entries or self.MAX_ENTRIES)
+        self._pending = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @property
+    def evictions(self):
+        return self._memory.evictions
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'evictions': self.evictions,
+            'entries': len(self._memory),
+        }
+
+    async def get(self, url, extract, *, loop):
+        """
+        Returns the metadata for *url*, calling the coroutine function *extract* only when neither the memory nor the
+        disk cache has a live entry and no other caller is already extracting the same video.
+        """
+        key = canonical_video_id(url)
+        entry = self._memory.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry[1]
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(self._load(key, url, extract, loop), loop=loop)
+            self._pending[key] = pending
+            pending.add_done_callback(lambda task: self._load_done(key, task))
+        else:
+            self.coalesced += 1
+        # shield, so a caller timing out doesn't cancel the extraction for everyone else waiting on it
+        return await asyncio.shield(pending)
+
+    def invalidate(self, url):
+        key = canonical_video_id(url)
+        self._memory.pop(key)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    async def _load(self, key, url, extract, loop):
+        entry = await loop.run_in_executor(None, self._read, key)
+        if entry is not None:
+            self.disk_hits += 1
+            expires, data = entry
+        else:
+            self.misses += 1
+            data = {field: value for field, value in (await extract(url)).items() if field in self.FIELDS}
+            expires = time.time() + self.ttl
+            await loop.run_in_executor(None, self._write, key, data, expires)
+        self._memory.put(key, data, expires)
+        return data
+
+    def _load_done(self, key, task):
+        self._pending.pop(key, None)
+        if not task.cancelled():
+            # mark the exception retrieved; every waiter already gets it re-raised through the shield
+            task.exception()
+
+    def _read(self, key):
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        if entry.get('expires', 0) <= time.time():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return entry['expires'], entry['data']
+
+    def _write(self, key, data, expires):
+        path = self._path(key)
+        # worker processes share the cache directory, and may well look up the same song at once
+        tmpfile = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.location, exist_ok=True)
+            with open(tmpfile, "w") as f:
+                f.write(json.dumps({'key': key, 'expires': expires, 'data': data}))
+            os.replace(tmpfile, path)
+        except OSError as e:
+            log.warning("metadata_cache_write_failed", key=key, error=e)
+
+    def _path(self, key):
+        return os.path.join(self.location, f"{hashlib.sha1(key.encode()).hexdigest()}.json")
+
+
+class StreamCache(object):
+    """
+    Resolved stream data keyed by canonical video id, kept until shortly before its signed media url expires.
+    An entry that is getting close to expiry is still handed out while a fresh copy is extracted in the background.
+    """
+
+    MAX_ENTRIES = 256
+    DEFAULT_TTL = 30 * 60
+    SAFETY_MARGIN = 60
+    REFRESH_MARGIN = 10 * 60
+    FIELDS = ('id', 'title', 'url', 'duration', 'is_live', 'acodec', 'ext', 'webpage_url', 'http_headers')
+    EXPIRE_RE = re.compile(r"[?&/]expire[=/](\d+)")
+
+    def __init__(self, max_entries=None):
+        self._memory = ExpiringLRU(max_entries or self.MAX_ENTRIES)
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    @property
+    def evictions(self):
+        return self._memory.evictions
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'evictions': self.evictions,
+            'entries': len(self._memory),
+        }
+
+    async def get(self, url, extract, *, loop):
+        """
+        Returns stream data for *url*, calling the coroutine function *extract* only if there is no entry that will
+        stay valid for the whole track.
+        """
+        key = canonical_video_id(url)
+        entry = self._memory.get(key)
+        if entry is not None:
+            self.hits += 1
+            usable_until, data = entry
+            if usable_until - time.time() < self.REFRESH_MARGIN and key not in self._pending:
+                self.refreshes += 1
+                self._extract(key, url, extract, loop)
+            return data
+        self.misses += 1
+        return await asyncio.shield(self._extract(key, url, extract, loop))
+
+    def usable_until(self, data, now=None):
+        """The last moment *data* can be handed to FFmpeg and still play all the way through."""
+        now = now or time.time()
+        match = self.EXPIRE_RE.search(data.get('url') or '')
+        expires = int(match.group(1)) if match else now + self.DEFAULT_TTL
+        return expires - (data.get('duration') or 0) - self.SAFETY_MARGIN
+
+    def _extract(self, key, url, extract, loop):
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(self._load(key, url, extract), loop=loop)
+            self._pending[key] = pending
+            pending.add_done_callback(lambda task: self._load_done(key, task))
+        return pending
+
+    async def _load(self, key, url, extract):
+        data = {field: value for field, value in (await extract(url)).items() if field in self.FIELDS}
+        usable_until = self.usable_until(data)
+        if usable_until > time.time():
+            self._memory.put(key, data, usable_until)
+        return data
+
+    def _load_done(self, key, task):
+        self._pending.pop(key, None)
+        if not task.cancelled() and task.exception() is not None:
+            log.warning("stream_resolve_failed", key=key, error=task.exception())
+
+
+class AudioCache(object):
+    """
+    Frequently played songs, downloaded in the background and stored on disk as opus, ready to hand straight to FFmpeg.
+    The cache stays under a byte budget by evicting the least recently (or least frequently) played tracks.
+    """
+
+    CACHE_LOCATION = "./audio/"
+    INDEX_FILE = "index.json"
+    BUDGET_BYTES = 2 * 1024 * 1024 * 1024
+    DOWNLOAD_AFTER_PLAYS = 2
+    MAX_DURATION = 2 * 60 * 60
+    EVICTION_POLICY = 'lru'
+
+    def __init__(self, location=None, budget_bytes=None, download_after_plays=None, eviction_policy=None):
+        self.location = location or os.getenv('TOBY_AUDIO_CACHE_DIR', self.CACHE_LOCATION)
+        self.budget_bytes = budget_bytes
+        self.download_after_plays = download_after_plays
+        self.eviction_policy = eviction_policy
+        self.hits = 0
+        self.misses = 0
+        self.downloads = 0
+        self.evictions = 0
+        self._index = None
+        self._downloading = set()
+        # one thread, so index snapshots are written in the order they were taken and a newer one is never overwritten
+        self._index_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='audio-cache-index')
+
+    def stats(self):
+        cached = [entry for entry in (self._index or {}).values() if 'file' in entry]
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'downloads': self.downloads,
+            'evictions': self.evictions,
+            'tracks': len(cached),
+            'bytes': sum(entry['bytes'] for entry in cached),
+            'budget_bytes': self.budget_bytes,
+        }
+
+    async def lookup(self, url):
+        """Returns playable data pointing at the local copy of *url*, or None if it isn't cached."""
+        await self._ensure_loaded()
+        entry = self._index.get(canonical_video_id(url))
+        if entry and 'file' in entry:
+            path = os.path.join(self.location, entry['file'])
+            if os.path.exists(path):
+                self.hits += 1
+                return {'id': entry.get('id'), 'title': entry.get('title'), 'duration': entry.get('duration'), 'acodec': 'opus', 'filepath': path}
+            entry.pop('file')
+        self.misses += 1
+        return None
+
+    async def record_play(self, url, *, guild=None):
+        """Counts a play of *url*, and starts a background download once it has been played often enough."""
+        await self._ensure_loaded()
+        key = canonical_video_id(url)
+        entry = self._index.setdefault(key, {'plays': 0})
+        entry['plays'] += 1
+        entry['last_played'] = time.time()
+        if 'file' not in entry and entry['plays'] >= self.download_after_plays and key not in self._downloading:
+            self._downloading.add(key)
+            asyncio.ensure_future(self._download(key, url, guild))
+        self._save_index()
+
+    async def _ensure_loaded(self):
+        if self._index is None:
+            self.budget_bytes = self.budget_bytes or int(os.getenv('TOBY_AUDIO_CACHE_BYTES', self.BUDGET_BYTES))
+            self.download_after_plays = self.download_after_plays or int(os.getenv('TOBY_AUDIO_CACHE_AFTER_PLAYS', self.DOWNLOAD_AFTER_PLAYS))
+            self.eviction_policy = self.eviction_policy or os.getenv('TOBY_AUDIO_CACHE_POLICY', self.EVICTION_POLICY)
+            index = await asyncio.get_running_loop().run_in_executor(None, self._read_index)
+            # another caller may have finished loading while we were reading
+            if self._index is None:
+                self._index = index
+
+    async def _download(self, key, url, guild):
+        try:
+            entry = await extraction_scheduler.run(timed_job('cache', lambda ytdl: self._fetch(key, url)), guild=guild, priority=BULK)
+        except (yt_dlp.utils.DownloadError, yt_dlp.utils.ExtractorError, OSError) as e:
+            log.warning("audio_cache_download_failed", url=url, error=e)
+            EXTRACTION_ERRORS.inc(kind='cache')
+            entry = None
+        except Exception as e:
+            # nobody awaits this task, so anything else (a post-processing failure, info missing a field) ends here too
+            log.exception("audio_cache_download_failed", url=url, error=e)
+            EXTRACTION_ERRORS.inc(kind='cache')
+            entry = None
+        finally:
+            self._downloading.discard(key)
+        if entry:
+            self.downloads += 1
+            self._index.setdefault(key, {'plays': 0}).update(entry)
+            self._evict()
+            self._save_index()
+
+    def _fetch(self, key, url):
+        """Runs on an extraction thread: downloads *url* and converts it to opus, remuxing when it already is opus."""
+        tmpdir = os.path.join(self.location, 'tmp')
+        os.makedirs(tmpdir, exist_ok=True)
+        options = dict(
+            ytdl_format_options,
+            outtmpl=os.path.join(tmpdir, '%(id)s.%(ext)s'),
+            match_filter=yt_dlp.utils.match_filter_func(f"!is_live & duration < {self.MAX_DURATION}"),
+            postprocessors=[{'key': 'FFmpegExtractAudio', 'preferredcodec': 'opus'}],
+        )
+        with yt_dlp.YoutubeDL(options) as downloader:
+            data = downloader.extract_info(url, download=True)
+        if not data:
+            return None
+        if 'entries' in data:
+            data = data['entries'][0]
+        downloaded = os.path.join(tmpdir, f"{data['id']}.opus")
+        if not os.path.exists(downloaded):
+            # filtered out, e.g. a live stream
+            return None
+        filename = f"{hashlib.sha1(key.encode()).hexdigest()}.opus"
+        os.replace(downloaded, os.path.join(self.location, filename))
+        return {
+            'file': filename,
+            'bytes': os.path.getsize(os.path.join(self.location, filename)),
+            'id': data.get('id'),
+            'title': data.get('title'),
+            'duration': data.get('duration'),
+        }
+
+    def _evict(self):
+        cached = {key: entry for key, entry in self._index.items() if 'file' in entry}
+        total = sum(entry['bytes'] for entry in cached.values())
+        if self.eviction_policy == 'lfu':
+            order = sorted(cached, key=lambda key: (cached[key]['plays'], cached[key]['last_played']))
+        else:
+            order = sorted(cached, key=lambda key: cached[key]['last_played'])
+        for key in order:
+            if total <= self.budget_bytes:
+                break
+            entry = cached[key]
+            try:
+                os.remove(os.path.join(self.location, entry.pop('file')))
+            except OSError:
+                pass
+            total -= entry.pop('bytes')
+            self.evictions += 1
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.location, self.INDEX_FILE)) as f:
+                return json.loads(f.read())
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self):
+        exported_data = json.dumps(self._index)
+        asyncio.get_running_loop().run_in_executor(self._index_writer, self._write_index, exported_data)
+
+    def _write_index(self, exported_data):
+        path = os.path.join(self.location, self.INDEX_FILE)
+        try:
+            os.makedirs(self.location, exist_ok=True)
+            with open(f"{path}.tmp", "w") as f:
+                f.write(exported_data)
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            log.warning("audio_cache_index_write_failed", error=e)
+
+
+metadata_cache = MetadataCache()
+stream_cache = StreamCache()
+audio_cache = AudioCache()
+
+
+class FirstFrameMixin(object):
+    """Calls on_first_frame, if set, once the voice client has read the first frame.  That's on the voice thread."""
+
+    on_first_frame = None
+
+    def read(self):
+        data = super().read()
+        if self.on_first_frame is not None:
+            callback, self.on_first_frame = self.on_first_frame, None
+            callback()
+        return data
+
+
+class YTDLSource(FirstFrameMixin, nextcord.PCMVolumeTransformer):
+
+    PLAYBACK_MODE = 'pcm'
+    VOLUME = 0.5
 
-class YTDLSource(nextcord.PCMVolumeTransformer):
     def __init__(self, source, *, data, volume=0.5):
         super().__init__(source, volume)
 
@@ -39,25 +612,13 @@ class YTDLSource(nextcord.PCMVolumeTransformer):
         self.url = data.get('url')
 
     @classmethod
-    async def meta_from_url(cls, url, *, loop=None):
+    async def meta_from_url(cls, url, *, loop=None, guild=None, priority=BULK):
         loop = loop or asyncio.get_event_loop()
-        try:
-            data = await loop.run_in_executor(None, lambda: ytdl.extract_info(url, download=False))
-        except (yt_dlp.utils.DownloadError, yt_dlp.utils.ExtractorError):
-            raise YTDLException(url)
-
-        if 'entries' in data:
-            # take first item from a playlist
-            data = data['entries'][0]
-        return data
+        return await metadata_cache.get(url, lambda u: cls._extract(u, stream=True, guild=guild, priority=priority), loop=loop)
 
     @classmethod
-    async def playlist_meta_from_url(cls, url, *, loop=None):
-        loop = loop or asyncio.get_event_loop()
-        try:
-            data = await loop.run_in_executor(None, lambda: ytdl.extract_info(url, download=False))
-        except (yt_dlp.utils.DownloadError, yt_dlp.utils.ExtractorError):
-            raise YTDLException(url)
+    async def playlist_meta_from_url(cls, url, *, loop=None, guild=None, priority=BULK):
+        data = await cls._extract_info(url, guild=guild, priority=priority)
 
         if 'entries' in data:
             # un-nest entries
@@ -65,25 +626,70 @@ class YTDLSource(nextcord.PCMVolumeTransformer):
         return data
 
     @classmethod
-    async def from_url(cls, url, *, loop=None, stream=False):
-        loop = loop or asyncio.get_event_loop()
-        data = await loop.run_in_executor(None, lambda: ytdl.extract_info(url, download=not stream))
+    async def from_url(cls, url, *, loop=None, stream=False, guild=None, priority=INTERACTIVE):
+        data = await cls.resolve(url, loop=loop, stream=stream, guild=guild, priority=priority)
+        return cls.from_data(data)
 
-        if 'entries' in data:
-            # take first item from a playlist
-            data = data['entries'][0]
+    @classmethod
+    async def resolve(cls, url, *, loop=None, stream=False, guild=None, priority=INTERACTIVE):
+        """Extracts the playable data for *url* without starting FFmpeg, so it can be done ahead of time."""
+        loop = loop or asyncio.get_event_loop()
+        if stream:
+            local = await audio_cache.lookup(url)
+            if local:
+                return local
+            return await stream_cache.get(url, lambda u: cls._extract(u, stream=True, guild=guild, priority=priority), loop=loop)
+        return await cls._extract(url, stream=False, guild=guild, priority=priority)
 
-        filename = data['url'] if stream else ytdl.prepare_filename(data)
-        return cls(nextcord.FFmpegPCMAudio(filename, **ffmpeg_options), data=data)
+    @classmethod
+    async def _extract(cls, url, *, stream, guild, priority):
+        def extract(ytdl):
+            data = ytdl.extract_info(url, download=not stream)
+            if 'entries' in data:
+                # take first item from a playlist
+                data = data['entries'][0]
+            if not stream:
+                data['filepath'] = ytdl.prepare_filename(data)
+            return data
+        return await cls._timed('stream' if stream else 'download', url, extract, guild=guild, priority=priority)
 
     @classmethod
-    async def playlist_from_url(cls, url, *, loop=None):
-        loop = loop or asyncio.get_event_loop()
+    async def _extract_info(cls, url, *, guild, priority):
+        return await cls._timed('info', url, lambda ytdl: ytdl.extract_info(url, download=False), guild=guild, priority=priority)
+
+    @staticmethod
+    async def _timed(kind, url, job, *, guild, priority):
         try:
-            data = await loop.run_in_executor(None, lambda: ytdl.extract_info(url, download=False))
+            return await extraction_scheduler.run(timed_job(kind, job), guild=guild, priority=priority)
         except (yt_dlp.utils.DownloadError, yt_dlp.utils.ExtractorError):
+            EXTRACTION_ERRORS.inc(kind=kind)
             raise YTDLException(url)
 
+    @classmethod
+    def from_data(cls, data, *, mode=None, volume=None):
+        """
+        Builds the audio source for resolved *data*.  In 'pcm' mode FFmpeg decodes to PCM and the volume is scaled per
+        frame in python, in 'opus' mode FFmpeg hands the voice client opus packets directly.
+        TOBY_VOLUME overrides each mode's default volume; opus mode defaults to full volume so opus input can be
+        passed through without decoding, set TOBY_VOLUME=0.5 to match pcm mode's loudness instead.
+        """
+        # local files (downloads and the audio cache) take precedence over the remote stream url
+        filename = data.get('filepath') or data['url']
+        mode = mode or os.getenv('TOBY_PLAYBACK_MODE', cls.PLAYBACK_MODE)
+        if volume is None:
+            volume = float(os.getenv('TOBY_VOLUME', YTDLOpusSource.VOLUME if mode == 'opus' else cls.VOLUME))
+        if mode == 'opus':
+            source = YTDLOpusSource(filename, data=data, volume=volume)
+            ffmpeg_sources.add(source)
+            return source
+        audio = nextcord.FFmpegPCMAudio(filename, **ffmpeg_options)
+        ffmpeg_sources.add(audio)
+        return cls(audio, data=data, volume=volume)
+
+    @classmethod
+    async def playlist_from_url(cls, url, *, loop=None, guild=None, priority=BULK):
+        data = await cls._extract_info(url, guild=guild, priority=priority)
+
         retval = []
         if 'entries' in data:
             # un-nest entries
@@ -97,5 +703,27 @@ class YTDLSource(nextcord.PCMVolumeTransformer):
         return retval
 
 
+class YTDLOpusSource(FirstFrameMixin, nextcord.FFmpegOpusAudio):
+    """
+    The opus-native counterpart to YTDLSource.  Opus input at full volume is remuxed without being decoded at all,
+    anything else is adjusted and encoded inside FFmpeg, so the voice client never decodes, scales or re-encodes.
+    """
+
+    # anything but 1.0 makes FFmpeg decode and re-encode every packet
+    VOLUME = 1.0
+
+    def __init__(self, filename, *, data, volume=VOLUME):
+        if volume == 1.0 and data.get('acodec') == 'opus':
+            super().__init__(filename, codec='copy', **ffmpeg_options)
+        else:
+            super().__init__(filename, options=f"{ffmpeg_options['options']} -af volume={volume}")
+
+        self.data = data
+        self.volume = volume
+
+        self.title = data.get('title')
+        self.url = data.get('url')
+
+
 class YTDLException(Exception):
-    pass
\ No newline at end of file
+    pass